@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This script enriches the trip CSV files directly into newline-delimited JSON
+files for a BigQuery load job, for replaying historical data without going
+through Cloud Pub/Sub and streaming inserts.
+
+Trip files are streamed a chunk of CSV rows at a time through the push
+script's parser and enriched with the pull script's Enricher, with the same
+caches, Maps API quotas and settings from resources/setup.yaml. Each trip
+file becomes one .json file of rows matching resources/geocoded_journeys.json,
+checked against it as they are written. After every chunk, the CSV rows
+read so far are recorded in .checkpoint.json in the output folder, as are
+finished files, so an interrupted run picks up at the next unread chunk;
+a trip file that changed since is enriched again from the start.
+
+Usage:
+
+% python config_geo_backfill.py --fileloc resources/data --output backfill
+% python config_geo_backfill.py --check backfill
+
+Then load the files, for example:
+% bq load --source_format=NEWLINE_DELIMITED_JSON \
+    sandiego_freeways.geocoded_journeys 'backfill/Mobile-GPS-Trip1.json'
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy
+
+import config_geo_pubsub_pull as pull
+import config_geo_pubsub_push as push
+import geo_batch
+import geo_schema
+
+log = logging.getLogger('config_geo_backfill')
+
+CHECKPOINT_FILE = '.checkpoint.json'
+
+
+class BackfillError(Exception):
+    """A trip file couldn't be completely enriched."""
+
+
+class Checkpoint(object):
+    """The trip files written, or partly written, to an output folder.
+
+    Each is recorded with its size and modification time, so a file that
+    changes is no longer counted as done or resumed. A partly written file
+    also records the CSV rows read and the bytes of its temporary output
+    file holding their rows.
+    """
+
+    def __init__(self, output):
+        self.path = os.path.join(output, CHECKPOINT_FILE)
+        self.files = {}
+        if os.path.exists(self.path):
+            with open(self.path) as checkpoint_file:
+                self.files = json.load(checkpoint_file)
+
+    def _entry(self, trip_file):
+        # The entry of trip_file if the file hasn't changed since.
+        entry = self.files.get(os.path.abspath(trip_file))
+        stat = os.stat(trip_file)
+        if (entry is not None and entry['size'] == stat.st_size and
+                entry['mtime'] == stat.st_mtime):
+            return entry
+        return None
+
+    def done(self, trip_file):
+        entry = self._entry(trip_file)
+        return entry is not None and entry.get('done', True)
+
+    def progress(self, trip_file):
+        """The entry of a partly written trip_file, or None to start it
+        from the beginning."""
+        entry = self._entry(trip_file)
+        if entry is not None and not entry.get('done', True):
+            return entry
+        return None
+
+    def record(self, trip_file, output_file, rows, rejected, offset=None,
+               output_bytes=None):
+        """Record trip_file as done, or if offset is given, as read up to
+        offset CSV rows with output_bytes of rows written."""
+        stat = os.stat(trip_file)
+        entry = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'output': os.path.basename(output_file),
+            'rows': rows,
+            'rejected': rejected,
+            'done': offset is None,
+        }
+        if offset is not None:
+            entry['offset'] = offset
+            entry['output_bytes'] = output_bytes
+        self.files[os.path.abspath(trip_file)] = entry
+        # Replace the checkpoint in one step, so it is never half written.
+        with open(self.path + '.tmp', 'w') as checkpoint_file:
+            json.dump(self.files, checkpoint_file, indent=1, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
+
+
+def trip_chunks(trip_file, chunk_size, offset=0, first_index=0):
+    """The valid fixes of each chunk_size CSV rows of a trip file as a
+    FixBatch, starting after the first offset rows.
+
+    Yields the CSV rows read so far, the batch and the number of rows of
+    the chunk rejected. Fixes are numbered from first_index on.
+    """
+    vehicle = push.vehicle_id(trip_file)
+    name = os.path.basename(trip_file)
+    index = first_index
+    for offset, fixes, rejected in push.read_trip_chunks(
+            trip_file, chunk_size, offset):
+        count = len(fixes['epoch'])
+        batch = geo_batch.FixBatch(
+            [vehicle] * count, fixes['epoch'], fixes['latitude'],
+            fixes['longitude'], fixes['speed'], fixes['bearing'],
+            [name] * count, [None] * count,
+            numpy.arange(index, index + count))
+        index += count
+        yield offset, batch, rejected
+
+
+def enrich_chunk(enricher, chunk, max_attempts):
+    """Enrichments of every fix of chunk, trying failed ones again up to
+    max_attempts times in all."""
+    enrichments = [None] * len(chunk)
+    pending = numpy.arange(len(chunk))
+    for attempt in range(max_attempts):
+        if attempt:
+            time.sleep(2 ** attempt)
+        results = enricher.enrich(chunk.take(pending))
+        for position, result in zip(pending.tolist(), results):
+            enrichments[position] = result
+        pending = numpy.array([position for position in pending.tolist()
+                               if enrichments[position] is None], dtype=int)
+        if not len(pending):
+            return enrichments
+    raise BackfillError("{0} of {1} fixes couldn't be enriched".format(
+        len(pending), len(chunk)))
+
+
+def backfill_file(enricher, schema, trip_file, output_file, chunk_size,
+                  max_attempts, checkpoint):
+    """Write the enriched rows of trip_file to output_file; returns the
+    number of rows and of CSV rows rejected.
+
+    Rows go to a temporary file that replaces output_file once complete.
+    Only chunk_size CSV rows are read and held at a time, and the progress
+    is checkpointed after each chunk, so an interrupted file resumes at the
+    chunk it stopped in, dropping any of its rows already written.
+    """
+    temporary_file = output_file + '.tmp'
+    entry = checkpoint.progress(trip_file)
+    if entry is not None and os.path.exists(temporary_file):
+        offset = entry['offset']
+        rows_written = entry['rows']
+        rejected = entry['rejected']
+        rows_file = open(temporary_file, 'r+')
+        rows_file.truncate(entry['output_bytes'])
+        rows_file.seek(entry['output_bytes'])
+        log.info("%s: resuming after %d CSV rows", trip_file, offset)
+    else:
+        offset = rows_written = rejected = 0
+        rows_file = open(temporary_file, 'w')
+    with rows_file:
+        for offset, chunk, chunk_rejected in trip_chunks(
+                trip_file, chunk_size, offset, rows_written):
+            if len(chunk):
+                enrichments = enrich_chunk(enricher, chunk, max_attempts)
+                for fix, row in pull.build_rows(chunk, enrichments):
+                    problems = geo_schema.check_row(schema, row)
+                    if problems:
+                        raise BackfillError(
+                            "Row for {0} at {1} doesn't match the schema: "
+                            "{2}".format(trip_file, fix['UTCTime'],
+                                         "; ".join(problems)))
+                    rows_file.write(json.dumps(row) + '\n')
+                    rows_written += 1
+            rejected += chunk_rejected
+            # The rows must be on disk before the checkpoint says so.
+            rows_file.flush()
+            os.fsync(rows_file.fileno())
+            checkpoint.record(trip_file, output_file, rows_written, rejected,
+                              offset, rows_file.tell())
+    os.rename(temporary_file, output_file)
+    checkpoint.record(trip_file, output_file, rows_written, rejected)
+    return rows_written, rejected
+
+
+def backfill(trip_files, output, enricher, schema, chunk_size=500,
+             max_attempts=3, force=False):
+    """Backfill every trip file not yet done; returns how many failed."""
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    checkpoint = Checkpoint(output)
+    failed = 0
+    start = time.time()
+    total_rows = 0
+    for number, trip_file in enumerate(trip_files, 1):
+        if not force and checkpoint.done(trip_file):
+            log.info("[%d/%d] %s already done", number, len(trip_files),
+                     trip_file)
+            continue
+        output_file = os.path.join(output, os.path.splitext(
+            os.path.basename(trip_file))[0] + '.json')
+        file_start = time.time()
+        try:
+            rows, rejected = backfill_file(enricher, schema, trip_file,
+                                           output_file, chunk_size,
+                                           max_attempts, checkpoint)
+        except BackfillError as e:
+            log.error("[%d/%d] %s failed, run again to retry it: %s",
+                      number, len(trip_files), trip_file, e)
+            failed += 1
+            continue
+        total_rows += rows
+        log.info("[%d/%d] %s: %d rows, %d CSV rows rejected, %.1fs",
+                 number, len(trip_files), trip_file, rows, rejected,
+                 time.time() - file_start)
+    elapsed = max(time.time() - start, 1e-6)
+    log.info("Wrote %d rows in %.1fs, %.1f rows/s; %d files failed",
+             total_rows, elapsed, total_rows / elapsed, failed)
+    return failed
+
+
+def check_output(output, schema):
+    """Check every .json file in output against schema; returns how many
+    have rows that don't match."""
+    bad_files = 0
+    for path in sorted(glob.glob(os.path.join(output, '*.json'))):
+        rows, bad_rows, problems = geo_schema.check_file(schema, path)
+        if bad_rows:
+            bad_files += 1
+            log.error("%s: %d of %d rows don't match the schema", path,
+                      bad_rows, rows)
+            for number, problem in problems:
+                log.error("  line %d: %s", number, problem)
+        else:
+            log.info("%s: %d rows OK", path, rows)
+    return bad_files
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fileloc", default=push.ROOTDIR,
+                        help="input folder with csv files")
+    parser.add_argument("--output", default="backfill",
+                        help="Folder to write the newline-delimited JSON "
+                        "files to.")
+    parser.add_argument("--schema", default=geo_schema.SCHEMA_FILE,
+                        help="BigQuery schema the rows must match.")
+    parser.add_argument("--chunk-size", type=int, default=500,
+                        help="CSV rows read and enriched at a time.")
+    parser.add_argument("--max-attempts", type=int, default=3,
+                        help="Times a fix's enrichment is tried before its "
+                        "file is given up on for this run.")
+    parser.add_argument("--deadline", type=float, default=120.0,
+                        help="Seconds a chunk's Maps API calls may take "
+                        "before the fixes left are tried again.")
+    parser.add_argument("--force", action="store_true",
+                        help="Enrich every file again, even if done.")
+    parser.add_argument("--check", metavar="FOLDER",
+                        help="Only check the .json files in FOLDER against "
+                        "the schema.")
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+        format="%(asctime)s %(levelname)s %(message)s")
+    schema = geo_schema.load_schema(args.schema)
+
+    if args.check:
+        return 1 if check_output(args.check, schema) else 0
+
+    trip_files = push.find_trip_files(args.fileloc)
+    log.info("Backfilling %d trip files from %s to %s", len(trip_files),
+             args.fileloc, args.output)
+    # A chunk has many more fixes than a pull, so it gets a longer
+    # deadline, and each cache write is committed at once so the three
+    # caches sharing the cache file don't hold it locked from each other.
+    enricher = pull.create_enricher(cache_commit_every=1,
+                                    enrich_deadline=args.deadline)
+    try:
+        failed = backfill(trip_files, args.output, enricher, schema,
+                          args.chunk_size, args.max_attempts, args.force)
+    except KeyboardInterrupt:
+        log.info("Interrupted; run again to resume.")
+        return 1
+    finally:
+        pull.close_enricher(enricher)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
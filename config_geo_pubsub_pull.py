@@ -17,61 +17,173 @@
  calculates the elevation above sea level,
  and converts from UTC time to local time by querying which timezone the locations fall in.
  It then writes the data plus this added geographic context to the BigQuery table.
+
+ With --push-port, it instead serves an HTTP endpoint for a push subscription
+ (see geo_push.py) and answers each push once its rows have been written.
 """
 import sys
+import argparse
 import base64
 from apiclient import discovery
+from apiclient import errors
 from dateutil.parser import parse
+import httplib
 import httplib2
+import geo_batch
+import geo_cache
+import geo_clients
+import geo_dedup
+import geo_elevation
+import geo_leases
+import geo_message
+import geo_metrics
+import geo_postal
+import geo_push
+import geo_quota
+import geo_spatial
+import geo_timezone
+import geo_trajectory
+import geo_tuning
 import yaml
 import googlemaps
+from googlemaps import convert
 import time
 import datetime
+import itertools
 import uuid
 import json
+import logging
+import math
+import multiprocessing
+import os
 import signal
+import socket
 import sys
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
 # from oauth2client.client import GoogleCredentials
 from oauth2client import client as oauth2client
 
 with open("resources/setup.yaml", 'r') as  varfile:
     cfg = yaml.load(varfile)
 
+def env_flag(name, default):
+    """A true/false setting in setup.yaml: a YAML boolean, or 1, true or
+    yes in any case for true; default if it is unset or empty."""
+    value = cfg["env"].get(name)
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes')
+
 # Uses an environment variable by default. Change this value to the name of your traffic topic.
 # Can override on the command line.
 TRAFFIC_TOPIC = cfg["env"]["PUBSUB_TOPIC"]
 PUBSUB_SCOPES = ['https://www.googleapis.com/auth/pubsub']
+# Where caches of Maps API results are kept between runs.
+CACHE_DIR = cfg["env"].get("CACHE_DIR", "/tmp/creds/cache")
+# Optional GeoJSON file of timezone boundaries; if set, timezones are
+# resolved locally and the Time Zone API is only used for points outside it.
+TIMEZONE_BOUNDARIES = cfg["env"].get("TIMEZONE_BOUNDARIES")
+# Optional directory of SRTM .hgt elevation tiles; if set, elevations are
+# interpolated locally and the Elevation API is only used where tiles are missing.
+DEM_DIR = cfg["env"].get("DEM_DIR")
+# How addresses and postal codes are found: 'api' asks the Geocoding API,
+# 'offline' only uses the POSTAL_CODES polygons and ADDRESS_POINTS file,
+# and 'hybrid' uses the offline answer when it has one and the API otherwise.
+GEOCODE_MODE = cfg["env"].get("GEOCODE_MODE") or "api"
+POSTAL_CODES = cfg["env"].get("POSTAL_CODES")
+ADDRESS_POINTS = cfg["env"].get("ADDRESS_POINTS")
+# Whether Maps API results are cached per spatial cell, so nearby fixes
+# share one call.
+MAPS_CACHE = env_flag("MAPS_CACHE", True)
+# Whether a fix may reuse the results of its vehicle's previous fix.
+TRAJECTORY_REUSE = env_flag("TRAJECTORY_REUSE", False)
+# Queries per second and calls per day allowed for each Maps API, where a
+# daily limit of 0 means none. Workers sharing CACHE_DIR share these limits,
+# so set them for the whole API key.
+MAPS_QUOTAS = cfg["env"].get("MAPS_QUOTAS") or {
+    'geocode': {'qps': 50, 'daily': 0},
+    'elevation': {'qps': 50, 'daily': 0},
+    'timezone': {'qps': 50, 'daily': 0},
+}
+# Where messages that can't be decoded are written, one JSON object per
+# line, instead of being redelivered forever.
+QUARANTINE_FILE = cfg["env"].get("QUARANTINE_FILE") or os.path.join(
+    CACHE_DIR, "quarantine.jsonl")
+# Optional secret that push requests must carry as the token query
+# parameter; add it to the push endpoint URL of the subscription.
+PUSH_TOKEN = cfg["env"].get("PUSH_TOKEN") or None
+BIGQUERY_SCOPES = ['https://www.googleapis.com/auth/bigquery']
 running_proc = True
 
+log = logging.getLogger('config_geo_pubsub_pull')
+metrics = geo_metrics.METRICS
+metrics.describe('geo_stage_seconds', 'histogram',
+                 'Time spent in each stage of the pull worker.')
+metrics.describe('geo_maps_call_seconds', 'histogram',
+                 'Duration of Maps API calls.')
+metrics.describe('geo_maps_calls_total', 'counter',
+                 'Maps API calls by API and outcome.')
+metrics.describe('geo_messages_total', 'counter',
+                 'Pulled messages by what happened to them.')
+metrics.describe('geo_fixes_total', 'counter',
+                 'GPS fixes decoded from pulled messages.')
+metrics.describe('geo_fixes_skipped_total', 'counter',
+                 'Redelivered fixes skipped because their rows were written.')
+metrics.describe('geo_rows_total', 'counter', 'BigQuery rows by outcome.')
+metrics.describe('geo_queue_depth', 'gauge',
+                 'Batches waiting between pipeline stages.')
+metrics.describe('geo_outstanding_messages', 'gauge',
+                 'Messages pulled but not yet acked or nacked.')
+metrics.describe('geo_cache_hit_ratio', 'gauge', 'Hit rate of each cache.')
+metrics.describe('geo_maps_quota_used', 'gauge',
+                 'Maps API calls made today, by all workers.')
+
 def signal_term_handler(signal, frame):
     global running_proc
-    print "Exiting application"
+    if not running_proc:
+        # Already stopping; let the work in flight finish.
+        return
+    log.info("Exiting application")
     running_proc = False
     sys.exit(0)
 
 
 
 def create_pubsub_client(http=None):
-    credentials = oauth2client.GoogleCredentials.get_application_default()
-    if credentials.create_scoped_required():
-        credentials = credentials.create_scoped(PUBSUB_SCOPES)
-    if not http:
-        http = httplib2.Http()
-    credentials.authorize(http)
-    return discovery.build('pubsub', 'v1', http=http)
+    return geo_clients.build_client('pubsub', 'v1', PUBSUB_SCOPES, http=http)
 
 def create_bigquery_client():
-    credentials = oauth2client.GoogleCredentials.get_application_default()
     # Construct the service object for interacting with the BigQuery API.
-    return discovery.build('bigquery', 'v2', credentials=credentials)
+    return geo_clients.build_client('bigquery', 'v2', BIGQUERY_SCOPES)
+
+# BigQuery accepts up to 10,000 rows and 10MB per insertAll request, and
+# recommends about 500 rows per request.
+MAX_INSERT_ROWS = 500
+MAX_INSERT_BYTES = 5 * 1000 * 1000
+# Per-row insertErrors reasons that succeed if the row is sent again.
+# "stopped" rows were valid but skipped because another row failed.
+RETRYABLE_INSERT_REASONS = frozenset(['stopped', 'backendError', 'timeout',
+                                      'internalError'])
+# A Pub/Sub or BigQuery request that failed with one of these is given up
+# on or tried again; anything else is a bug and stops the worker.
+REQUEST_ERRORS = (errors.HttpError, socket.error, httplib.HTTPException)
 
-def stream_row_to_bigquery(bigquery, row,
-                           num_retries=5):
-    # Generate a unique row ID so retries
-    # don't accidentally insert duplicates.
+def row_insert_id(message_id, index=0):
+    # Derive the row ID from the Pub/Sub message ID so a redelivered
+    # message or a retried request doesn't insert duplicates. The pull
+    # worker also remembers these IDs to skip redelivered fixes.
+    return "{0}-{1}".format(message_id, index)
+
+def stream_rows_to_bigquery(bigquery, rows,
+                            num_retries=5):
+    # rows is a list of (insert_id, row) pairs.
     insert_all_data = {
-        'insertId': str(uuid.uuid4()),
-        'rows': [{'json': row}]
+        'rows': [{'insertId': insert_id, 'json': row}
+                 for insert_id, row in rows]
     }
     return bigquery.tabledata().insertAll(
         projectId=cfg["env"]["PROJECT_ID"],
@@ -79,6 +191,197 @@ def stream_row_to_bigquery(bigquery, row,
         tableId=cfg["env"]["TABLE_ID"],
         body=insert_all_data).execute(num_retries=num_retries)
 
+
+class BigQueryRowSink(object):
+    """Collects rows across messages and writes them with one insertAll.
+
+    Rows are flushed when there are max_rows of them, when they add up to
+    max_bytes, or when the oldest has waited max_age seconds; keep max_age
+    well under the subscription's ack deadline.
+
+    BigQuery fails a whole request when one of its rows can't be written
+    just then, reporting the others as "stopped". Those are sent again
+    straight away without the failing rows, in two halves, and so on up
+    to max_attempts requests deep, so one bad row holds up as few others
+    as possible. Rows that fail with another retryable reason, and
+    requests that fail outright, are kept and sent again by later flushes,
+    after a delay that doubles with each try of the row up to
+    max_retry_delay seconds, until retry_for seconds after they were
+    added; keep that within how long their messages stay leased. A
+    request BigQuery refuses as invalid or too large is split in half.
+
+    flush() returns the ack IDs of the messages whose rows are finished:
+    inserted, or rejected by BigQuery as invalid. Rows given up on are
+    not acked, so Pub/Sub redelivers their messages; their ack IDs are in
+    failed_ack_ids until the next flush, and the insert IDs of the
+    finished rows in finished_insert_ids.
+    """
+
+    def __init__(self, bigquery, max_rows=MAX_INSERT_ROWS,
+                 max_bytes=MAX_INSERT_BYTES, max_age=5.0, max_attempts=3,
+                 retry_for=60.0, max_retry_delay=10.0):
+        self.bigquery = bigquery
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_attempts = max_attempts
+        self.retry_for = retry_for
+        self.max_retry_delay = max_retry_delay
+        self.rows_inserted = 0
+        self.rows_rejected = 0
+        self.rows_failed = 0
+        self.requests = 0
+        self.failed_ack_ids = []
+        self.finished_insert_ids = []
+        # (insert ID, row, ack ID, POSIX time it was added)
+        self._pending = []
+        self._bytes = 0
+        self._oldest = None
+        # (row entry, times it failed, POSIX time to send it again)
+        self._retrying = []
+
+    def add(self, row, insert_id, ack_id=None):
+        now = time.time()
+        if not self._pending:
+            self._oldest = now
+        self._pending.append((insert_id, row, ack_id, now))
+        self._bytes += len(json.dumps(row)) + len(insert_id)
+
+    def __len__(self):
+        return len(self._pending) + len(self._retrying)
+
+    def time_left(self):
+        """Seconds until rows are due, or None if there are none."""
+        due = []
+        if self._pending:
+            due.append(self._oldest + self.max_age)
+        if self._retrying:
+            due.append(min(retry_at for _, _, retry_at in self._retrying))
+        if not due:
+            return None
+        return max(min(due) - time.time(), 0)
+
+    def due(self):
+        now = time.time()
+        return (bool(self._pending) and (
+            len(self._pending) >= self.max_rows or
+            self._bytes >= self.max_bytes or
+            now - self._oldest >= self.max_age)) or any(
+                now >= retry_at for _, _, retry_at in self._retrying)
+
+    def flush(self, final=False):
+        """Write the buffered rows, and the rows to retry whose delay is
+        over. With final, every row is sent and those that still fail are
+        given up on."""
+        self.failed_ack_ids = []
+        self.finished_insert_ids = []
+        now = time.time()
+        tries = {}
+        waiting = []
+        for entry, failures, retry_at in self._retrying:
+            if final or now >= retry_at:
+                tries[entry[0]] = failures
+            else:
+                waiting.append((entry, failures, retry_at))
+        rows = [entry for entry, _, _ in self._retrying
+                if entry[0] in tries] + self._pending
+        self._retrying = waiting
+        self._pending = []
+        self._bytes = 0
+        self._oldest = None
+
+        finished = []
+        retry = []
+        for start in range(0, len(rows), self.max_rows):
+            chunk_finished, chunk_retry = self._insert(
+                rows[start:start + self.max_rows])
+            finished.extend(chunk_finished)
+            retry.extend(chunk_retry)
+
+        now = time.time()
+        given_up = [entry for entry in retry
+                    if final or now - entry[3] >= self.retry_for]
+        retry = [entry for entry in retry
+                 if not final and now - entry[3] < self.retry_for]
+        for entry in retry:
+            failures = tries.get(entry[0], 0) + 1
+            self._retrying.append((entry, failures, now + min(
+                0.25 * 2 ** failures, self.max_retry_delay)))
+        metrics.inc('geo_rows_total', len(retry), outcome='retried')
+        if given_up:
+            log.warning("Giving up on %d rows BigQuery failed to write",
+                        len(given_up))
+            self.rows_failed += len(given_up)
+            metrics.inc('geo_rows_total', len(given_up), outcome='failed')
+            self.failed_ack_ids = [ack_id for _, _, ack_id, _ in given_up
+                                   if ack_id is not None]
+        self.finished_insert_ids = [insert_id
+                                    for insert_id, _, _, _ in finished]
+        return [ack_id for _, _, ack_id, _ in finished if ack_id is not None]
+
+    def _insert(self, pending, attempts=None):
+        """Send rows in up to attempts requests; returns those that are
+        finished and those to try again later."""
+        if attempts is None:
+            attempts = self.max_attempts
+        if not pending:
+            return [], []
+        if not attempts:
+            return [], pending
+        try:
+            with metrics.timer('geo_stage_seconds', stage='insert'):
+                resp = stream_rows_to_bigquery(
+                    self.bigquery,
+                    [(insert_id, row) for insert_id, row, _, _ in pending])
+        except REQUEST_ERRORS as e:
+            log.warning("insertAll of %d rows failed: %s", len(pending), e)
+            if (isinstance(e, errors.HttpError) and
+                    e.resp.status in (400, 413) and len(pending) > 1):
+                return self._insert_halves(pending, attempts - 1)
+            return [], pending
+        self.requests += 1
+
+        finished = []
+        later = []
+        stopped = []
+        failed = set()
+        for insert_error in resp.get('insertErrors', []):
+            entry = pending[insert_error['index']]
+            failed.add(insert_error['index'])
+            reasons = set(e.get('reason') for e in
+                          insert_error.get('errors', []))
+            if reasons == set(['stopped']):
+                # Valid, but held back by another row's failure.
+                stopped.append(entry)
+            elif reasons <= RETRYABLE_INSERT_REASONS:
+                later.append(entry)
+            else:
+                log.warning("Row %s rejected by BigQuery: %s",
+                            entry[0], insert_error.get('errors'))
+                metrics.inc('geo_rows_total', outcome='rejected')
+                self.rows_rejected += 1
+                finished.append(entry)
+        metrics.inc('geo_rows_total', len(pending) - len(failed),
+                    outcome='inserted')
+        for index, entry in enumerate(pending):
+            if index not in failed:
+                self.rows_inserted += 1
+                finished.append(entry)
+        # Smaller requests are less likely to be held back again.
+        stopped_finished, stopped_later = self._insert_halves(stopped,
+                                                              attempts - 1)
+        return finished + stopped_finished, later + stopped_later
+
+    def _insert_halves(self, pending, attempts):
+        middle = (len(pending) + 1) // 2
+        finished = []
+        later = []
+        for half in (pending[:middle], pending[middle:]):
+            half_finished, half_later = self._insert(half, attempts)
+            finished.extend(half_finished)
+            later.extend(half_later)
+        return finished, later
+
 # Use Maps API Geocoding service to convert lat,lng into a human readable address.
 def reverse_geocode(gmaps, latitude, longitude):
     return gmaps.reverse_geocode((latitude, longitude))
@@ -100,6 +403,41 @@ def extract_component(list, property):
                 break
     return val
 
+# Keep only what extract_address and extract_component read, for caching.
+def slim_address_list(list):
+    if len(list) == 0:
+        return []
+    return [{
+        "formatted_address": extract_address(list, "formatted_address"),
+        "address_components": [{
+            "types": ["postal_code"],
+            "long_name": extract_component(list, "postal_code"),
+        }],
+    }]
+
+# Shape an offline postal code and address like a slimmed Geocoding API response.
+def offline_address_list(zipcode, address):
+    return [{
+        "formatted_address": address or "",
+        "address_components": [{
+            "types": ["postal_code"],
+            "long_name": zipcode or "",
+        }],
+    }]
+
+# Reverse geocode and remember the result in a SpatialCache.
+def reverse_geocode_into_cache(cache, gmaps, latitude, longitude):
+    address_list = slim_address_list(reverse_geocode(gmaps, latitude, longitude))
+    cache.put(latitude, longitude, address_list)
+    return address_list
+
+# Reverse geocode through a SpatialCache, so fixes in the same cell share one API call.
+def cached_reverse_geocode(cache, gmaps, latitude, longitude):
+    address_list = cache.get(latitude, longitude)
+    if address_list is None:
+        address_list = reverse_geocode_into_cache(cache, gmaps, latitude, longitude)
+    return address_list
+
 # Calculate elevation using Google Maps Elevation API.
 def get_elevation(gmaps, latitude, longitude):
     elevation = gmaps.elevation((latitude, longitude))
@@ -108,10 +446,70 @@ def get_elevation(gmaps, latitude, longitude):
         elevation_metres = elevation[0]["elevation"]
     return elevation_metres
 
+# The Elevation API takes up to 512 locations per request, and the request
+# URL must stay under 8192 characters.
+MAX_ELEVATION_LOCATIONS = 512
+MAX_ELEVATION_PATH_CHARS = 7500
+
+# Split locations into (start, end) ranges that each fit one Elevation API request.
+def elevation_chunks(locations, max_locations=MAX_ELEVATION_LOCATIONS,
+                     max_chars=MAX_ELEVATION_PATH_CHARS):
+    chunks = []
+    start = 0
+    while start < len(locations):
+        size = min(max_locations, len(locations) - start)
+        # The client sends whichever of a polyline or a plain list is shorter.
+        while size > 1 and len(convert.shortest_path(
+                locations[start:start + size])) > max_chars:
+            size //= 2
+        chunks.append((start, start + size))
+        start += size
+    return chunks
+
+# Calculate elevation for many (latitude, longitude) pairs in one Elevation API request.
+# Returns one value per location; a location whose lookup failed gets the exception instead.
+def get_elevations(gmaps, locations):
+    try:
+        elevation = gmaps.elevation(list(locations))
+        if len(elevation) != len(locations):
+            raise googlemaps.exceptions.ApiError(
+                "INVALID_REQUEST", "Got {0} results for {1} locations".format(
+                    len(elevation), len(locations)))
+    except googlemaps.exceptions.ApiError as e:
+        # A request the API refuses outright may be down to one bad point,
+        # so retry each half on its own. Quota and transport errors are
+        # not split, they would only multiply the failing calls.
+        if e.status == "OVER_QUERY_LIMIT":
+            raise
+        if e.status != "INVALID_REQUEST" or len(locations) == 1:
+            return [e] * len(locations)
+        middle = len(locations) // 2
+        return (get_elevations(gmaps, locations[:middle]) +
+                get_elevations(gmaps, locations[middle:]))
+    except Exception as e:
+        return [e] * len(locations)
+    return [result["elevation"] for result in elevation]
+
+# get_elevations, remembering each elevation found in a SpatialCache.
+def get_elevations_into_cache(cache, gmaps, locations):
+    elevations = get_elevations(gmaps, locations)
+    for location, elevation in zip(locations, elevations):
+        if not isinstance(elevation, Exception):
+            cache.put(location[0], location[1], elevation)
+    return elevations
+
 # Get the timezone including any DST offset for the time the GPS position was recorded.
 def get_timezone(gmaps, latitude, longitude, posix_time):
     return gmaps.timezone((latitude, longitude), timestamp=posix_time)
 
+# Get the timezone and remember its ID in a SpatialCache. The offsets depend
+# on the time, so they are worked out again from the ID on a cache hit.
+def get_timezone_into_cache(cache, gmaps, latitude, longitude, posix_time):
+    timezone = get_timezone(gmaps, latitude, longitude, posix_time)
+    if timezone.get('timeZoneId'):
+        cache.put(latitude, longitude, timezone['timeZoneId'])
+    return timezone
+
 def get_local_time(timezone_response):
     # get offset from UTC
     rawOffset = float(timezone_response["rawOffset"])
@@ -121,24 +519,443 @@ def get_local_time(timezone_response):
     # combine for total offset from UTC
     return rawOffset + dstOffset
 
+
+class DeadlineExceeded(Exception):
+    pass
+
+def call_before(end, function, args, quota=None, api=None, limiter=None):
+    # Don't spend an API call on a batch that has already given up.
+    if time.time() >= end:
+        metrics.inc('geo_maps_calls_total', api=api, outcome='deadline')
+        raise DeadlineExceeded()
+    if quota is not None:
+        # Wait for a token until the deadline, or fail if today's quota is used up.
+        try:
+            quota.acquire(api, 1, timeout=end - time.time())
+        except geo_quota.QuotaExceeded:
+            metrics.inc('geo_maps_calls_total', api=api, outcome='quota')
+            raise
+    # Wait for one of the calls allowed at once to finish.
+    if limiter is not None and not limiter.acquire(
+            timeout=max(end - time.time(), 0)):
+        metrics.inc('geo_maps_calls_total', api=api, outcome='deadline')
+        raise DeadlineExceeded()
+    try:
+        with metrics.timer('geo_maps_call_seconds', api=api):
+            result = function(*args)
+    except googlemaps.exceptions.ApiError as e:
+        if e.status == "OVER_QUERY_LIMIT":
+            metrics.inc('geo_maps_calls_total', api=api, outcome='throttled')
+            if quota is not None:
+                # Our limits are set too high; back off before the next call.
+                quota.over_limit(api)
+        else:
+            metrics.inc('geo_maps_calls_total', api=api, outcome='error')
+        raise
+    except Exception as e:
+        # The client gives up with Timeout when the API keeps asking it to
+        # slow down, or doesn't answer.
+        throttled = (isinstance(e, googlemaps.exceptions.Timeout) or
+                     getattr(e, 'status_code', None) == 429)
+        metrics.inc('geo_maps_calls_total', api=api,
+                    outcome='throttled' if throttled else 'error')
+        raise
+    finally:
+        if limiter is not None:
+            limiter.release()
+    metrics.inc('geo_maps_calls_total', api=api, outcome='ok')
+    return result
+
+class Enricher(object):
+    """Runs the Maps API calls for a batch of GPS fixes concurrently.
+
+    The geocode and timezone calls of the batch run on a pool of threads,
+    `concurrency` at once (see set_concurrency()), and its elevations are
+    fetched in as few requests as the Elevation API allows. Calls that
+    fail or outlast `deadline` seconds leave their fix unenriched.
+
+    Each optional helper answers what it can before the API is called:
+    the caches reuse values looked up for the same cell, the
+    timezone_resolver and elevation_model answer locally, the
+    offline_geocoder fills addresses per geocode_mode ('offline' or
+    'hybrid'), and trajectories reuse a vehicle's nearby earlier fix.
+    With a quota, each call first takes a token for its API, and
+    call_rates tracks how many calls of each API a fix needs lately.
+    """
+
+    def __init__(self, gmaps, concurrency=20, deadline=4.0,
+                 geocode_cache=None, timezone_resolver=None,
+                 elevation_model=None, offline_geocoder=None,
+                 geocode_mode="api", quota=None, timezone_cache=None,
+                 elevation_cache=None, trajectories=None,
+                 max_concurrency=None):
+        self.gmaps = gmaps
+        self.deadline = deadline
+        self.quota = quota
+        self.call_rates = {}
+        self.geocode_cache = geocode_cache
+        self.timezone_cache = timezone_cache
+        self.elevation_cache = elevation_cache
+        self.trajectories = trajectories
+        self.timezone_resolver = timezone_resolver
+        self.elevation_model = elevation_model
+        self.offline_geocoder = offline_geocoder
+        self.geocode_mode = geocode_mode if offline_geocoder else "api"
+        self.max_concurrency = max(concurrency, max_concurrency or 0)
+        self.pool = ThreadPool(self.max_concurrency)
+        self.limiter = geo_tuning.Limiter(concurrency)
+
+    @property
+    def concurrency(self):
+        return self.limiter.limit
+
+    def set_concurrency(self, concurrency):
+        self.limiter.set_limit(min(concurrency, self.max_concurrency))
+
+    def enrich(self, fixes):
+        """Return one dict of API responses per fix, or None if incomplete."""
+        if self.trajectories is None:
+            results, calls_made = self.lookup(fixes)
+        else:
+            plans = self.trajectories.plan(fixes)
+            # Fixes that reuse every field need no lookup at all.
+            indexes = [index for index, plan in enumerate(plans)
+                       if len(plan) < len(self.trajectories.reuse_metres)]
+            looked_up, calls_made = self.lookup(
+                [fixes[index] for index in indexes],
+                [plans[index] for index in indexes])
+            results = self.trajectories.apply(fixes, plans,
+                                              dict(zip(indexes, looked_up)))
+        self.update_call_rates(calls_made, len(fixes))
+        return results
+
+    def lookup(self, fixes, skip=None):
+        """Look up every field of each fix except those in skip[index].
+
+        Returns the enrichments, None where incomplete, and the number of
+        calls made to each API.
+        """
+        if skip is None:
+            skip = [()] * len(fixes)
+        end = time.time() + self.deadline
+        results = [{} for _ in fixes]
+        # (fix index, result name, AsyncResult, position in the task's
+        # result list or None if the task belongs to this fix alone)
+        tasks = self.queue_elevations(end, fixes, results, skip)
+        calls_made = {'elevation': len(set(task[2] for task in tasks))}
+        offline = self.lookup_offline(fixes)
+        offline_timezones = self.lookup_offline_timezones(fixes, skip)
+        # Cache misses in the same cell share one reverse geocode call.
+        geocode_tasks = {}
+        for index, fix in enumerate(fixes):
+            latitude, longitude = fix['Latitude'], fix['Longitude']
+            calls = []
+            if 'timezone' in skip[index]:
+                pass
+            elif offline_timezones[index] is not None:
+                results[index]['timezone'] = offline_timezones[index]
+            elif self.timezone_cache is not None:
+                tzid = self.timezone_cache.get(latitude, longitude)
+                if tzid is not None:
+                    results[index]['timezone'] = geo_timezone.timezone_response(
+                        tzid, fix['posix_time'])
+                else:
+                    calls.append(('timezone', 'timezone', get_timezone_into_cache,
+                                  (self.timezone_cache, self.gmaps, latitude,
+                                   longitude, fix['posix_time'])))
+            else:
+                calls.append(('timezone', 'timezone', get_timezone,
+                              (self.gmaps, latitude, longitude, fix['posix_time'])))
+            if 'address_list' in skip[index]:
+                pass
+            elif offline[index] is not None:
+                results[index]['address_list'] = offline_address_list(
+                    *offline[index])
+            elif self.geocode_cache is None:
+                calls.append(('address_list', 'geocode', reverse_geocode,
+                              (self.gmaps, latitude, longitude)))
+            else:
+                address_list = self.geocode_cache.get(latitude, longitude)
+                cell = self.geocode_cache.key(latitude, longitude)
+                if address_list is not None:
+                    results[index]['address_list'] = address_list
+                elif cell in geocode_tasks:
+                    tasks.append((index, 'address_list', geocode_tasks[cell], None))
+                else:
+                    geocode_tasks[cell] = self.call(
+                        end, 'geocode', reverse_geocode_into_cache,
+                        (self.geocode_cache, self.gmaps, latitude, longitude))
+                    calls_made['geocode'] = calls_made.get('geocode', 0) + 1
+                    tasks.append((index, 'address_list', geocode_tasks[cell], None))
+            for name, api, function, args in calls:
+                tasks.append((index, name,
+                              self.call(end, api, function, args), None))
+                calls_made[api] = calls_made.get(api, 0) + 1
+
+        for index, name, task, position in tasks:
+            if results[index] is None:
+                continue
+            try:
+                value = task.get(max(end - time.time(), 0))
+                if position is not None:
+                    value = value[position]
+                    if isinstance(value, Exception):
+                        raise value
+                results[index][name] = value
+            except (multiprocessing.TimeoutError, DeadlineExceeded):
+                log.warning("%s for vehicle %s missed the %ss deadline",
+                            name, fixes[index]['VehicleID'], self.deadline)
+                results[index] = None
+            except geo_quota.QuotaExceeded as e:
+                log.warning("%s for vehicle %s not looked up: %s",
+                            name, fixes[index]['VehicleID'], e)
+                results[index] = None
+            except Exception as e:
+                log.warning("%s for vehicle %s failed: %s",
+                            name, fixes[index]['VehicleID'], e)
+                results[index] = None
+        return results, calls_made
+
+    def caches(self):
+        return [cache for cache in (self.geocode_cache, self.timezone_cache,
+                                    self.elevation_cache) if cache is not None]
+
+    def call(self, end, api, function, args):
+        return self.pool.apply_async(call_before,
+                                     (end, function, args, self.quota, api,
+                                      self.limiter))
+
+    def update_call_rates(self, calls_made, fix_count, weight=0.2):
+        # Exponentially weighted calls per fix, so the pull loop can tell
+        # how many messages the remaining quota is good for.
+        if not fix_count:
+            return
+        for api in set(self.call_rates) | set(calls_made):
+            rate = calls_made.get(api, 0) / float(fix_count)
+            if api in self.call_rates:
+                rate = (1 - weight) * self.call_rates[api] + weight * rate
+            self.call_rates[api] = rate
+
+    def lookup_offline(self, fixes):
+        # (zipcode, address) for the fixes answered offline, None for the rest.
+        if self.geocode_mode == "api":
+            return [None] * len(fixes)
+        answers = self.offline_geocoder.lookup(
+            [fix['Latitude'] for fix in fixes],
+            [fix['Longitude'] for fix in fixes])
+        if self.geocode_mode == "offline":
+            return answers
+        # Without address points, a postal code is a full answer.
+        need_address = self.offline_geocoder.address_tree is not None
+        return [answer if answer[0] and (answer[1] or not need_address)
+                else None for answer in answers]
+
+    def lookup_offline_timezones(self, fixes, skip):
+        # Timezone responses from the offline resolver, None for the fixes
+        # it can't answer or that skip their timezone.
+        if self.timezone_resolver is None:
+            return [None] * len(fixes)
+        return [None if 'timezone' in skip[index]
+                else self.timezone_resolver.timezone(
+                    fix['Latitude'], fix['Longitude'], fix['posix_time'])
+                for index, fix in enumerate(fixes)]
+
+    def queue_elevations(self, end, fixes, results, skip):
+        indexes = [index for index in range(len(fixes))
+                   if 'elevation' not in skip[index]]
+        if self.elevation_model is not None:
+            elevations = self.elevation_model.elevations(
+                [fixes[index]['Latitude'] for index in indexes],
+                [fixes[index]['Longitude'] for index in indexes]).tolist()
+            missing = []
+            for index, elevation in zip(indexes, elevations):
+                if math.isnan(elevation):
+                    missing.append(index)
+                else:
+                    results[index]['elevation'] = elevation
+            indexes = missing
+        if self.elevation_cache is not None:
+            missing = []
+            for index in indexes:
+                elevation = self.elevation_cache.get(fixes[index]['Latitude'],
+                                                     fixes[index]['Longitude'])
+                if elevation is None:
+                    missing.append(index)
+                else:
+                    results[index]['elevation'] = elevation
+            indexes = missing
+
+        locations = [(fixes[index]['Latitude'], fixes[index]['Longitude'])
+                     for index in indexes]
+        tasks = []
+        for start, stop in elevation_chunks(locations):
+            if self.elevation_cache is None:
+                function, args = get_elevations, (self.gmaps,
+                                                  locations[start:stop])
+            else:
+                function, args = get_elevations_into_cache, (
+                    self.elevation_cache, self.gmaps, locations[start:stop])
+            task = self.call(end, 'elevation', function, args)
+            for position in range(start, stop):
+                tasks.append((indexes[position], 'elevation', task,
+                              position - start))
+        return tasks
+
+    def close(self):
+        self.pool.terminate()
+
+
+# Columns filled from each enrichment field, for recording which were reused.
+ENRICHMENT_COLUMNS = {
+    'address_list': 'Address',
+    'elevation': 'Elevation',
+    'timezone': 'Offset',
+}
+
+# Characters of the Geohash column, about 5 x 5 metres. Its prefixes are
+# the coarser cells, so the table is clustered on it and queries for an
+# area filter on the prefixes covering it; web/bqapi.html has to use the
+# same precision.
+ROW_GEOHASH_PRECISION = 9
+
+def build_rows(fixes, enrichments):
+    """(fix, row) pairs for the fixes of a batch that were enriched."""
+    return [(fix, build_row(fix, enrichment))
+            for fix, enrichment in zip(fixes, enrichments)
+            if enrichment is not None]
+
+def build_row(fix, enrichment):
+    """Construct a row object that matches the BigQuery table schema."""
+    row = { 'VehicleID': fix['VehicleID'], 'UTCTime': fix['UTCTime'], 'Offset': 0, 'Address':"", 'Zipcode':"", 'Speed':fix['Speed'], 'Bearing':fix['Bearing'], 'Elevation':None, 'Latitude':fix['Latitude'], 'Longitude': fix['Longitude'] }
+
+    #Save the formatted address for insert into BigQuery.
+    address_list = enrichment['address_list']
+    if(len(address_list) > 0):
+        row["Address"] = extract_address(address_list, "formatted_address")
+        #extract the zip or postal code if one is returned
+        row["Zipcode"] = extract_component(address_list, "postal_code")
+
+    row["Elevation"] = enrichment['elevation']
+
+    # Store DST offset so can display/query UTC time as local time.
+    timezone = enrichment['timezone']
+    if(timezone["rawOffset"] is not None):
+        row["Offset"] = get_local_time(timezone)
+
+    # Columns taken from an earlier fix of the vehicle rather than looked up.
+    row["ReusedFields"] = ",".join(sorted(
+        ENRICHMENT_COLUMNS[field] for field in enrichment.get('reused', [])))
+
+    # Spatial cell and UTC date the table is clustered and partitioned on.
+    row["Geohash"] = geo_spatial.geohash(fix['Latitude'], fix['Longitude'],
+                                         ROW_GEOHASH_PRECISION)
+    row["JourneyDate"] = fix['UTCTime'][:10]
+    return row
+
 # [START maininit]
 def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes pulling from "
+                        "SUBSCRIPTION; 0 uses every CPU.")
+    parser.add_argument("--report-interval", type=float, default=10.0,
+                        help="Seconds between throughput reports of the workers.")
+    parser.add_argument("--log-level", default="INFO",
+                        help="DEBUG logs every row; INFO one in every 100.")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="Serve Prometheus metrics on this local port "
+                        "(worker N uses port + N); 0 to turn off.")
+    parser.add_argument("--summary-interval", type=float, default=60.0,
+                        help="Seconds between metrics summary log lines.")
+    parser.add_argument("--push-port", type=int, default=0,
+                        help="Receive messages from a push subscription on "
+                        "this port (worker N uses port + N) instead of "
+                        "pulling; 0 to pull.")
+    parser.add_argument("--tune-interval", type=float, default=10.0,
+                        help="Seconds between adjustments of the batch size, "
+                        "Maps API concurrency and insert thresholds to the "
+                        "load; 0 to keep them fixed.")
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+        format="%(asctime)s %(levelname)s %(processName)s %(message)s")
+
+    workers = args.workers or multiprocessing.cpu_count()
+    if workers == 1:
+        run_worker(metrics_port=args.metrics_port,
+                   summary_interval=args.summary_interval,
+                   push_port=args.push_port, tune_interval=args.tune_interval)
+    else:
+        supervise(workers, args.report_interval, args.metrics_port,
+                  args.summary_interval, args.push_port, args.tune_interval)
 
-    client = create_pubsub_client()
+def run_worker(worker=None, stats=None, report_interval=10.0, metrics_port=0,
+               summary_interval=60.0, push_port=0, tune_interval=10.0):
+    """Pull, enrich and write messages until stopped.
 
-    # You can fetch multiple messages with a single API call.
+    A worker started by supervise() has a worker number, and reports its
+    rows inserted so far on the stats queue every report_interval seconds.
+    With a metrics_port, metrics are served on metrics_port plus the
+    worker number; a summary of them is logged every summary_interval
+    seconds either way. With a push_port, messages are received from a
+    push subscription on push_port plus the worker number instead of
+    being pulled. Every tune_interval seconds, unless it is 0, the batch
+    size, Maps API concurrency and insert thresholds are adjusted to the
+    load (see geo_tuning). If a pipeline stage dies, the worker exits
+    with status 1.
+    """
+    start = time.time()
+
+    # You can fetch multiple messages with a single API call. Fewer are
+    # pulled when the Maps API quotas in MAPS_QUOTAS can't cover them.
     batch_size = 100
 
-    # Options to limit number of geocodes e.g to stay under daily quota.
-    geocode_counter = 0
-    geocode_limit = 10
+    # Rows are written to BigQuery in batches, at the latest after
+    # insert_max_age seconds so messages are acked before their deadline.
+    insert_max_rows = MAX_INSERT_ROWS
+    insert_max_age = 5.0
+    # Rows BigQuery fails to write are sent again for up to
+    # insert_retry_for seconds, while their messages stay leased.
+    insert_retry_for = 120.0
+    # Push requests wait for their rows to be written, so those are
+    # written sooner, and requests not done within push_timeout seconds
+    # are answered with an error (Pub/Sub waits 10 seconds by default).
+    push_insert_max_age = 1.0
+    push_timeout = 9.0
+
+    # At most this many pulled messages (and bytes of message data) are
+    # in flight at once; pulling pauses while the pipeline is full.
+    # Messages still being worked on when their ack deadline (the
+    # subscription's, 10 seconds by default) comes up are leased for
+    # lease_seconds more, for up to max_lease seconds in all.
+    max_outstanding_messages = 1000
+    max_outstanding_bytes = 100 * 1000 * 1000
+    ack_deadline = 10
+    lease_seconds = 60
+    max_lease = 600
 
-    # Option to wait for some time until daily quotas are reset.
-    wait_timeout = 2
+    # The tuner keeps each of these settings within (lowest, highest).
+    # Rows must still be written well within the ack deadline, or the
+    # push timeout.
+    tuning_bounds = {
+        'batch_size': (10, max_outstanding_messages),
+        'max_rows': (50, MAX_INSERT_ROWS),
+        'max_age': (0.25, push_insert_max_age if push_port
+                    else insert_max_age),
+    }
+
+    # Rows written in the last dedup_window seconds are remembered in
+    # CACHE_DIR, and up to dedup_memory_keys of them in memory, so their
+    # fixes are skipped if Pub/Sub redelivers them.
+    dedup_window = 24 * 3600.0
+    dedup_memory_keys = 100000
+
+    # The disk tier of the enrichment caches is shared between workers,
+    # so it is committed on every write when there are several of them.
+    cache_commit_every = geo_cache.COMMIT_EVERY if worker is None else 1
 # [END maininit]    
 # [START createmaps]
-    # Create a Google Maps API client.
-    gmaps = googlemaps.Client(key=cfg["env"]["MAPS_API_KEY"])
+    enricher = create_enricher(cache_commit_every)
     subscription = cfg["env"]["SUBSCRIPTION"]
 
     # Create a POST body for the Cloud Pub/Sub request.
@@ -151,101 +968,831 @@ def main(argv):
     }
 # [END createmaps]
     signal.signal(signal.SIGINT, signal_term_handler)
-    #[START pullmsgs]
-    while running_proc:
-        # Pull messages from Cloud Pub/Sub
-        resp = client.projects().subscriptions().pull(
-            subscription=subscription, body=body).execute()
+    # A push request is answered, and its message redelivered if it
+    # failed, after push_timeout whatever happens to its rows.
+    sink = BigQueryRowSink(
+        create_bigquery_client(), max_rows=insert_max_rows,
+        max_age=push_insert_max_age if push_port else insert_max_age,
+        retry_for=push_timeout if push_port else insert_retry_for)
+    quarantine = geo_batch.Quarantine(QUARANTINE_FILE)
+    seen = geo_dedup.SeenSet(os.path.join(CACHE_DIR, 'seen.sqlite'),
+                             dedup_window, dedup_memory_keys)
+    server = None
+    if push_port:
+        pipeline = PushPipeline(enricher, sink, enricher.quota, batch_size,
+                                max_outstanding_messages, push_timeout,
+                                quarantine=quarantine, seen=seen)
+    else:
+        leases = geo_leases.Leases(max_outstanding_messages,
+                                   max_outstanding_bytes, ack_deadline,
+                                   lease_seconds, max_lease)
+        # Each stage that calls Cloud Pub/Sub gets its own client.
+        pipeline = PullPipeline(
+            lambda: geo_clients.thread_client('pubsub', 'v1', PUBSUB_SCOPES),
+            subscription, body, enricher, sink, leases, enricher.quota,
+            quarantine=quarantine, seen=seen)
+    register_gauges(pipeline)
+    tuner = None
+    if tune_interval:
+        tuning_bounds['concurrency'] = (4, enricher.max_concurrency)
+        tuner = geo_tuning.Tuner(pipeline, tuning_bounds)
+    if metrics_port:
+        geo_metrics.serve(metrics_port + (worker or 0))
+        log.info("Serving metrics on port %d", metrics_port + (worker or 0))
+    log.info("Clients ready in %.1f ms", (time.time() - start) * 1000)
+    pipeline.start()
+    if push_port:
+        server = geo_push.serve(push_port + (worker or 0), pipeline,
+                                token=PUSH_TOKEN)
+        log.info("Receiving pushes on port %d", push_port + (worker or 0))
+    next_report = time.time() + report_interval
+    next_summary = time.time() + summary_interval
+    next_tuning = time.time() + tune_interval
+    try:
+        while not pipeline.wait(1.0):
+            if stats is not None and time.time() >= next_report:
+                stats.put((worker, os.getpid(), sink.rows_inserted))
+                next_report += report_interval
+            if time.time() >= next_summary:
+                log.info(metrics.summary())
+                next_summary += summary_interval
+            if tuner is not None and time.time() >= next_tuning:
+                tuner.adjust()
+                next_tuning += tune_interval
+    finally:
+        # Write and ack whatever is still in the pipeline when we are stopped.
+        if server is not None:
+            server.shutdown()
+        pipeline.stop()
+        pipeline.wait()
+        if stats is not None:
+            stats.put((worker, os.getpid(), sink.rows_inserted))
+        log.info(metrics.summary())
+        log.info(seen.report())
+        seen.close()
+        close_enricher(enricher)
+    if pipeline.failed:
+        # Exit with an error so that supervise(), or whatever started the
+        # worker, starts a new one.
+        log.error("Worker stopped because its %s died", pipeline.failed)
+        sys.exit(1)
 
-        received_messages = resp.get('receivedMessages')
-    # [END pullmsgs]
+def create_enricher(cache_commit_every=geo_cache.COMMIT_EVERY,
+                    enrich_deadline=4.0):
+    """The Enricher configured in setup.yaml, with its Maps API client,
+    quotas and local data sources, and if MAPS_CACHE and TRAJECTORY_REUSE
+    are set, its caches in CACHE_DIR and trajectory reuse.
 
+    enrich_deadline is how long a batch's calls may take before its
+    unfinished messages are left for redelivery.
+    """
+    # Number of Maps API calls run at once, and the most the tuner may
+    # raise that to.
+    enrich_concurrency = 20
+    max_enrich_concurrency = 50
 
-        if received_messages is not None:
-            ack_ids = []
-            bq = create_bigquery_client()
-            for received_message in received_messages:
-                pubsub_message = received_message.get('message')
-                if pubsub_message:
-                    # process messages
-                    msg = base64.b64decode(str(pubsub_message.get('data')))
-
-                    # We stored time as a message attribute.
-                    ts = pubsub_message["attributes"]["timestamp"]
-
-                    # Create a datetime object so we can get a POSIX timestamp for TimeZone API.
-                    utc_time = datetime.datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
-                    posix_time = time.mktime(utc_time.timetuple())
-
-                    # Our messages are in a comma-separated string.
-                    #Split into a list
-                    data_list = msg.split(",")
-                    #[START extract]
-                    # Extract latitude,longitude for input into Google Maps API calls.
-                    latitude = float(data_list[1])
-                    longitude = float(data_list[2])
-
-                    # Construct a row object that matches the BigQuery table schema.
-                    row = { 'VehicleID': data_list[0], 'UTCTime': None, 'Offset': 0, 'Address':"", 'Zipcode':"", 'Speed':data_list[3], 'Bearing':data_list[4], 'Elevation':None, 'Latitude':latitude, 'Longitude': longitude }
-
-                    # Maps API Geocoding has a daily limit - this lets us limit API calls during development.
-                    if geocode_counter <= geocode_limit:
-
-                        # Reverse geocode the latitude, longitude to get street address, city, region, etc.
-                        address_list = reverse_geocode(gmaps, latitude, longitude)
-                    # [END extract]
-                        #Save the formatted address for insert into BigQuery.
-                        if(len(address_list) > 0):
-                            row["Address"] = extract_address(address_list, "formatted_address")
-                            #extract the zip or postal code if one is returned
-                            row["Zipcode"] = extract_component(address_list, "postal_code")
-
-                        # Increment counter - in case you want to limit daily geocodes.
-                        geocode_counter += 1
-
-                        # get elevation
-                        row["Elevation"] = get_elevation(gmaps, latitude, longitude)
-
-                        # Get the timezone, pass in original timestamp in case DST applied at that time.
-                        timezone = get_timezone(gmaps, latitude, longitude, posix_time)
-
-                        # Store DST offset so can display/query UTC time as local time.
-                        if(timezone["rawOffset"] is not None):
-                            row["Offset"] = get_local_time(timezone)
-
-                        row["UTCTime"] = ts
-                        # [START saverow]
-                        # save a row to BigQuery
-                        result = stream_row_to_bigquery(bq, row)
-                        # [END saverow]
-
-                        # Addresses can contain non-ascii characters, for simplicity we'll replace non ascii characters.
-                        # This is just for command line output.
-                        addr = row['Address'].encode('ascii', 'replace')
-                        msg = "Appended one row to BigQuery."
-                        print msg
-                        msg = "Address: {0}".format(addr)
-                        print msg
-                        msg = "Elevation: {0} metres".format(row["Elevation"])
-                        print msg
-                        msg = "Timezone: {0}".format(timezone["timeZoneId"])
-                        print msg
-                        print " "
+    # Reverse geocodes are cached per geohash cell of this many characters
+    # (8 is about 38 x 19 metres), in memory and on disk in CACHE_DIR;
+    # timezones per 7 character cell (153 metres) and elevations per 9
+    # character cell (5 metres).
+    geocode_cache_precision = 8
+    timezone_cache_precision = 7
+    elevation_cache_precision = 9
+    cache_size = 100000
+
+    # A fix reuses the address, elevation or timezone of the last fix of
+    # the same vehicle that had it looked up, if it is within that field's
+    # distance in metres and trajectory_max_seconds of it.
+    trajectory_reuse_metres = {'address_list': 25.0, 'elevation': 100.0,
+                               'timezone': 5000.0}
+    trajectory_max_seconds = 120.0
+
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    # Per-API rate limits and daily quotas, shared with other workers.
+    quota = geo_quota.QuotaManager(os.path.join(CACHE_DIR, 'quota.sqlite'),
+                                   MAPS_QUOTAS)
+    # Create a Google Maps API client. The quota manager paces the calls,
+    # so the client's own limit only has to allow all the APIs together,
+    # and it shouldn't retry past the batch deadline.
+    gmaps = geo_clients.create_maps_client(
+        cfg["env"]["MAPS_API_KEY"], pool_size=max_enrich_concurrency,
+        queries_per_second=sum(limit['qps'] for limit in MAPS_QUOTAS.values()),
+        retry_timeout=enrich_deadline)
+    geocode_cache = timezone_cache = elevation_cache = None
+    if MAPS_CACHE:
+        cache_path = os.path.join(CACHE_DIR, 'maps_cache.sqlite')
+        geocode_cache = geo_cache.SpatialCache(
+            'reverse_geocode', capacity=cache_size, path=cache_path,
+            precision=geocode_cache_precision,
+            commit_every=cache_commit_every)
+        timezone_cache = geo_cache.SpatialCache(
+            'timezone', capacity=cache_size, path=cache_path,
+            precision=timezone_cache_precision,
+            commit_every=cache_commit_every)
+        elevation_cache = geo_cache.SpatialCache(
+            'elevation', capacity=cache_size, path=cache_path,
+            precision=elevation_cache_precision,
+            commit_every=cache_commit_every)
+    trajectories = None
+    if TRAJECTORY_REUSE:
+        trajectories = geo_trajectory.TrajectoryCache(
+            trajectory_reuse_metres, trajectory_max_seconds)
+    timezone_resolver = None
+    if TIMEZONE_BOUNDARIES:
+        timezone_resolver = geo_timezone.TimezoneResolver(TIMEZONE_BOUNDARIES)
+    elevation_model = None
+    if DEM_DIR:
+        elevation_model = geo_elevation.DemElevation(DEM_DIR)
+    offline_geocoder = None
+    if GEOCODE_MODE != "api":
+        offline_geocoder = geo_postal.OfflineGeocoder(
+            POSTAL_CODES, addresses=ADDRESS_POINTS)
+    return Enricher(gmaps, enrich_concurrency, enrich_deadline,
+                    geocode_cache=geocode_cache,
+                    timezone_resolver=timezone_resolver,
+                    elevation_model=elevation_model,
+                    offline_geocoder=offline_geocoder,
+                    geocode_mode=GEOCODE_MODE, quota=quota,
+                    timezone_cache=timezone_cache,
+                    elevation_cache=elevation_cache,
+                    trajectories=trajectories,
+                    max_concurrency=max_enrich_concurrency)
+
+def close_enricher(enricher):
+    """Log the reports of an Enricher from create_enricher and close it."""
+    enricher.close()
+    if enricher.trajectories is not None:
+        log.info(enricher.trajectories.report())
+    for cache in enricher.caches():
+        log.info(cache.report())
+        cache.close()
+    log.info(enricher.quota.report())
+    enricher.quota.close()
+
+def register_gauges(pipeline):
+    """Expose the pipeline's queue depths, leases, caches and quota use."""
+    for name in ('pulled', 'decoded', 'enriched', 'acks'):
+        metrics.gauge('geo_queue_depth', getattr(pipeline, name).qsize,
+                      queue=name)
+    metrics.gauge('geo_outstanding_messages', lambda: len(
+        pipeline if pipeline.leases is None else pipeline.leases))
+    for cache in pipeline.enricher.caches():
+        metrics.gauge('geo_cache_hit_ratio',
+                      lambda cache=cache: cache.stats()['hit_rate'],
+                      cache=cache.name)
+    if pipeline.quota is not None:
+        for api in pipeline.quota.limits:
+            metrics.gauge('geo_maps_quota_used',
+                          lambda api=api: pipeline.quota.usage().get(api, 0),
+                          api=api)
+
+def supervise(workers, report_interval, metrics_port=0, summary_interval=60.0,
+              push_port=0, tune_interval=10.0, max_restart_delay=60):
+    """Run run_worker() in `workers` processes, restarting any that exit.
+
+    Workers pull from the same subscription and share the Maps API quotas
+    and the disk tier of the enrichment caches through CACHE_DIR. Every
+    report_interval seconds the rows inserted per second by each worker
+    and in total are printed. A worker that keeps exiting is restarted
+    after a delay that doubles each time, up to max_restart_delay seconds.
+    """
+    signal.signal(signal.SIGINT, signal_term_handler)
+    stats = multiprocessing.Queue()
+    processes = [None] * workers
+    started = [0.0] * workers
+    restarts = [0] * workers
+    restart_at = [0.0] * workers
+    # Rows inserted in this reporting window, and in all, per worker;
+    # last report of each worker as (pid, rows inserted by that process).
+    window_rows = [0] * workers
+    total_rows = [0] * workers
+    last_report = {}
+
+    def record(report):
+        worker, pid, inserted = report
+        last_pid, last_inserted = last_report.get(worker, (None, 0))
+        if pid != last_pid:
+            last_inserted = 0
+        last_report[worker] = (pid, inserted)
+        window_rows[worker] += inserted - last_inserted
+        total_rows[worker] += inserted - last_inserted
+
+    window_start = start = time.time()
+    try:
+        while running_proc:
+            now = time.time()
+            for worker, process in enumerate(processes):
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    log.warning("Worker %d (pid %d) exited with code %s",
+                                worker, process.pid, process.exitcode)
+                    # A worker that ran for a while starts over with no delay.
+                    if now - started[worker] > max_restart_delay:
+                        restarts[worker] = 0
+                    restart_at[worker] = now + min(
+                        2 ** restarts[worker] - 1, max_restart_delay)
+                    restarts[worker] += 1
+                    processes[worker] = None
+                if now >= restart_at[worker]:
+                    process = multiprocessing.Process(
+                        target=run_worker, name='pull-worker-{0}'.format(worker),
+                        args=(worker, stats, report_interval, metrics_port,
+                              summary_interval, push_port, tune_interval))
+                    process.start()
+                    log.info("Started worker %d (pid %d)", worker, process.pid)
+                    processes[worker] = process
+                    started[worker] = now
+
+            try:
+                record(stats.get(timeout=1.0))
+            except Queue.Empty:
+                pass
+
+            if time.time() - window_start >= report_interval:
+                elapsed = time.time() - window_start
+                log.info("Throughput: {0}, total {1:.1f} rows/s ({2} rows in {3:.0f}s)".format(
+                    ", ".join("worker {0} {1:.1f} rows/s".format(
+                        worker, rows / elapsed)
+                              for worker, rows in enumerate(window_rows)),
+                    sum(window_rows) / elapsed, sum(total_rows),
+                    time.time() - start))
+                window_rows = [0] * workers
+                window_start = time.time()
+    finally:
+        # Stop the workers; they drain their pipelines before exiting.
+        for process in processes:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        for process in processes:
+            if process is not None:
+                process.join()
+        while True:
+            try:
+                record(stats.get(timeout=0.1))
+            except Queue.Empty:
+                break
+        log.info("Inserted {0} rows with {1} workers in {2:.0f}s: {3}".format(
+            sum(total_rows), workers, time.time() - start,
+            ", ".join("worker {0} {1} rows".format(worker, rows)
+                      for worker, rows in enumerate(total_rows))))
+
+def acknowledge(client, subscription, ack_ids):
+    if not ack_ids:
+        return
+    # Create a POST body for the acknowledge request.
+    ack_body = {'ackIds': ack_ids}
+
+    # Acknowledge the message.
+    client.projects().subscriptions().acknowledge(
+        subscription=subscription, body=ack_body).execute()
+
+def nack(client, subscription, ack_ids):
+    if not ack_ids:
+        return
+    # A zero ack deadline makes Pub/Sub redeliver the messages right away
+    # instead of after the deadline expires.
+    client.projects().subscriptions().modifyAckDeadline(
+        subscription=subscription,
+        body={'ackIds': ack_ids, 'ackDeadlineSeconds': 0}).execute()
+
+def admissible_messages(quota, enricher, batch_size, in_flight=0,
+                        fixes_per_message=1.0):
+    """How many messages the Maps API quotas can enrich within a deadline,
+    besides the in_flight fixes that were pulled but may not have made
+    their calls yet."""
+    if not enricher.call_rates and in_flight:
+        # Pull one batch at a time until we know how many calls a fix takes.
+        return 0
+    admissible = batch_size
+    for api, rate in enricher.call_rates.items():
+        if rate > 0:
+            headroom = quota.headroom(api, within=enricher.deadline)
+            admissible = min(admissible, int(
+                (headroom / rate - in_flight) / fixes_per_message))
+    return max(admissible, 0)
+
+def log_row(row, enrichment, level=logging.DEBUG):
+    if not log.isEnabledFor(level):
+        return
+    # Addresses can contain non-ascii characters, for simplicity we'll replace non ascii characters.
+    # This is just for log output.
+    addr = row['Address'].encode('ascii', 'replace')
+    log.log(level, "Buffered row for vehicle %s. Address: %s, Elevation: %s "
+            "metres, Timezone: %s", row['VehicleID'], addr, row["Elevation"],
+            enrichment['timezone']["timeZoneId"])
+
+# Ack and modifyAckDeadline requests carry at most this many ack IDs.
+MAX_ACK_IDS = 1000
+
+def chunked(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+class PullPipeline(object):
+    """Pulls, decodes, enriches and writes messages in overlapping stages.
+
+    Each stage runs on its own thread and hands batches to the next
+    through a bounded queue, so pulling the next batch overlaps with
+    enriching this one, and a slow stage makes the ones before it wait
+    rather than pile up work. Leases (geo_leases.Leases) limit how much
+    is pulled but not yet acked, and a lease stage extends the ack
+    deadline of messages that are still being worked on.
+
+    Messages are acked as soon as the sink has written their rows, and
+    nacked for redelivery as soon as they can't be enriched or written.
+    Messages that can't be decoded are acked right away and written to
+    quarantine (a geo_batch.Quarantine), if given, instead. With seen (a
+    geo_dedup.SeenSet), the insert ID of every row written is added to
+    it, and fixes whose rows it already has, from a message that was
+    redelivered, are skipped before they are enriched; a message with
+    only such fixes is acked right away.
+    client_factory returns a Cloud Pub/Sub client for the calling thread.
+    Every row is logged at DEBUG level, and one in row_log_every at INFO.
+
+    If a stage dies, the others give up what they are waiting for and
+    exit too, the messages not yet written are nacked, and failed names
+    the stage, so the worker can be restarted.
+
+    Each stage's timings and counts are recorded in geo_metrics.METRICS.
+    """
+
+    def __init__(self, client_factory, subscription, body, enricher, sink,
+                 leases, quota=None, queue_size=4, throttle_wait=1.0,
+                 lease_margin=3.0, row_log_every=100, quarantine=None,
+                 seen=None):
+        self.client_factory = client_factory
+        self.subscription = subscription
+        self.body = body
+        self.batch_size = body['maxMessages']
+        self.enricher = enricher
+        self.sink = sink
+        self.leases = leases
+        self.quota = quota
+        self.throttle_wait = throttle_wait
+        self.lease_margin = lease_margin
+        self.row_log_every = row_log_every
+        self.rows_logged = 0
+        self.quarantine = quarantine
+        self.seen = seen
+        self.running = True
+        # Name of the stage that died, if one did.
+        self.failed = None
+        # Lists of received messages, of fixes, and of (fix, row) pairs.
+        self.pulled = Queue.Queue(queue_size)
+        self.decoded = Queue.Queue(queue_size)
+        self.enriched = Queue.Queue(queue_size)
+        # (ack?, ack IDs); never bounded, so a full queue can't hold up acks.
+        self.acks = Queue.Queue()
+        self.acked = threading.Event()
+        self.threads = []
+        # Fixes pulled but not yet through the enrich stage, counting a
+        # message that isn't decoded yet as one fix.
+        self.unenriched = 0
+        self.messages_decoded = 0
+        self.fixes_decoded = 0
+        # ack ID -> fixes of the message not yet written, for messages
+        # whose ack or nack hasn't been sent.
+        self.unsettled = {}
+        self._lock = threading.Lock()
+
+    def stages(self):
+        return (self.pull_stage, self.decode_stage, self.enrich_stage,
+                self.sink_stage, self.ack_stage, self.lease_stage)
+
+    def start(self):
+        for stage in self.stages():
+            thread = threading.Thread(target=self.run_stage, args=(stage,),
+                                      name=stage.__name__)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Stop pulling; the stages finish what has been pulled and exit."""
+        self.running = False
+
+    def wait(self, timeout=None):
+        """Wait for every stage to exit; False if timeout ran out first."""
+        end = None if timeout is None else time.time() + timeout
+        # Join with a timeout so the main thread still gets signals.
+        for thread in self.threads:
+            while thread.is_alive():
+                if end is None:
+                    thread.join(1.0)
+                elif time.time() >= end:
+                    return False
+                else:
+                    thread.join(min(1.0, end - time.time()))
+        return True
+
+    def run_stage(self, stage):
+        try:
+            stage()
+        except Exception:
+            log.exception("%s stopped", stage.__name__)
+            self.fail(stage.__name__)
+
+    def fail(self, stage_name):
+        """Stop every stage after stage_name died."""
+        with self._lock:
+            self.running = False
+            self.failed = stage_name
+            unsettled = list(self.unsettled)
+        # Nack what hasn't been written, so it is redelivered straight
+        # away rather than leased until the worker is restarted.
+        self.acks.put((False, unsettled))
+        self.acks.put(None)
+        self.acked.set()
+
+    def put(self, queue, item):
+        """Put item on one of the bounded queues between stages; False
+        if a stage died first."""
+        while not self.failed:
+            try:
+                queue.put(item, timeout=1.0)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def get(self, queue):
+        """The next item on a queue between stages, or None once it is
+        empty and a stage has died."""
+        while True:
+            try:
+                return queue.get(timeout=1.0)
+            except Queue.Empty:
+                if self.failed:
+                    return None
+
+    def count_unenriched(self, change):
+        with self._lock:
+            self.unenriched += change
+
+    def fixes_per_message(self):
+        with self._lock:
+            if not self.messages_decoded:
+                return 1.0
+            return float(self.fixes_decoded) / self.messages_decoded
+
+    def next_acks(self):
+        """Wait for results on the acks queue, and take every one that is
+        waiting, so they are sent in as few requests as possible. Returns
+        the ack IDs to ack and to nack, and whether the queue has ended."""
+        batches = [self.acks.get()]
+        while True:
+            try:
+                batches.append(self.acks.get_nowait())
+            except Queue.Empty:
+                break
+        ack_ids, nack_ids = self.settle([batch for batch in batches if batch])
+        return ack_ids, nack_ids, None in batches
+
+    def settle(self, batches):
+        """Turn per-fix results into the ack IDs to ack and to nack.
+
+        A message is acked once every one of its fixes has been written,
+        and nacked as soon as any of them fails; results that arrive for
+        it after that are ignored.
+        """
+        ack_ids = []
+        nack_ids = []
+        with self._lock:
+            for ok, ids in batches:
+                for ack_id in ids:
+                    if ack_id not in self.unsettled:
+                        continue
+                    if not ok:
+                        del self.unsettled[ack_id]
+                        nack_ids.append(ack_id)
+                    elif self.unsettled[ack_id] > 1:
+                        self.unsettled[ack_id] -= 1
                     else:
-                        time.sleep(wait_timeout)
-                        geocode_counter = 0
-                        print "counter reset"
+                        del self.unsettled[ack_id]
+                        ack_ids.append(ack_id)
+        return ack_ids, nack_ids
+
+    def pull_stage(self):
+        client = self.client_factory()
+        throttled = False
+        while self.running and running_proc:
+            max_messages = min(self.batch_size,
+                               self.leases.wait_for_room(self.throttle_wait))
+            if not max_messages:
+                continue
+            # Only pull what the Maps API quotas can take; the rest stays
+            # queued in Pub/Sub rather than being pulled and given up on.
+            if self.quota is not None:
+                admissible = admissible_messages(
+                    self.quota, self.enricher, max_messages, self.unenriched,
+                    self.fixes_per_message())
+                if not admissible and not throttled and self.enricher.call_rates:
+                    log.info("Maps API quotas are used up for now, pausing "
+                             "pulls. %s", self.quota.report())
+                throttled = not admissible
+                if throttled:
+                    time.sleep(self.throttle_wait)
+                    continue
+                max_messages = admissible
+
+            #[START pullmsgs]
+            # Pull messages from Cloud Pub/Sub
+            pull_start = time.time()
+            try:
+                with metrics.timer('geo_stage_seconds', stage='pull'):
+                    resp = client.projects().subscriptions().pull(
+                        subscription=self.subscription,
+                        body=dict(self.body, maxMessages=max_messages)).execute()
+            except REQUEST_ERRORS as e:
+                log.warning("Pull failed: %s", e)
+                time.sleep(self.throttle_wait)
+                continue
+
+            received_messages = resp.get('receivedMessages') or []
+            metrics.inc('geo_messages_total', len(received_messages),
+                        event='pulled')
+            log.debug("Pulled %d messages in %.1f ms", len(received_messages),
+                      (time.time() - pull_start) * 1000)
+            # [END pullmsgs]
+            for received_message in received_messages:
+                self.leases.add(received_message['ackId'], len(
+                    received_message.get('message', {}).get('data', '')))
+            self.count_unenriched(len(received_messages))
+            if received_messages and not self.put(self.pulled,
+                                                  received_messages):
+                return
+        self.put(self.pulled, None)
+
+    def decode_stage(self):
+        while True:
+            received_messages = self.get(self.pulled)
+            if received_messages is None:
+                self.put(self.decoded, None)
+                return
+            with metrics.timer('geo_stage_seconds', stage='decode'):
+                batch, rejected = geo_batch.decode_batch(received_messages)
+            for received_message, reason in rejected:
+                log.warning("Quarantining message %s: %s",
+                            received_message.get('message', {}).get(
+                                'messageId'), reason)
+                if self.quarantine is not None:
+                    self.quarantine.add(received_message, reason)
+            metrics.inc('geo_messages_total', len(rejected),
+                        event='quarantined')
+            if self.seen is not None and len(batch):
+                batch = self.skip_written(batch)
+
+            fixes_per_ack_id = batch.fixes_per_ack_id()
+            # Quarantined messages, and any without fixes, are acked now.
+            done_ids = [received_message['ackId']
+                        for received_message in received_messages
+                        if received_message['ackId'] not in fixes_per_ack_id]
+            with self._lock:
+                self.unsettled.update(fixes_per_ack_id)
+                self.unsettled.update((ack_id, 1) for ack_id in done_ids)
+                self.messages_decoded += len(received_messages)
+                self.fixes_decoded += len(batch)
+            self.acks.put((True, done_ids))
+            self.count_unenriched(len(batch) - len(received_messages))
+            metrics.inc('geo_fixes_total', len(batch))
+            if len(batch) and not self.put(self.decoded, batch):
+                return
+
+    def skip_written(self, batch):
+        """The fixes of batch whose rows aren't in self.seen."""
+        keys = [row_insert_id(message_id, index)
+                if message_id is not None else None
+                for message_id, index in zip(batch.message_id.tolist(),
+                                             batch.index.tolist())]
+        written = self.seen.seen([key for key in keys if key is not None])
+        if not written:
+            return batch
+        keep = [position for position, key in enumerate(keys)
+                if key not in written]
+        ack_ids = batch.ack_id.tolist()
+        redelivered = set(ack_ids[position] for position, key
+                          in enumerate(keys) if key in written)
+        remaining = batch.take(keep)
+        duplicates = len(redelivered - set(remaining.ack_id.tolist()))
+        log.info("Skipping %d fixes of %d redelivered messages, their rows "
+                 "were already written", len(written), len(redelivered))
+        metrics.inc('geo_fixes_skipped_total', len(written))
+        metrics.inc('geo_messages_total', duplicates, event='duplicate')
+        return remaining
+
+    def enrich_stage(self):
+        stopping = False
+        while not stopping:
+            batches = [self.get(self.decoded)]
+            if batches[0] is None:
+                break
+            # Enrich whatever else is already decoded along with this batch.
+            while sum(len(batch) for batch in batches) < self.batch_size:
+                try:
+                    more = self.decoded.get_nowait()
+                except Queue.Empty:
+                    break
+                if more is None:
+                    stopping = True
+                    break
+                batches.append(more)
+            fixes = geo_batch.concatenate(batches)
+
+            # Reverse geocode, get elevation and get the timezone (passing in
+            # the original timestamp in case DST applied at that time) for the
+            # whole batch at once.
+            with metrics.timer('geo_stage_seconds', stage='enrich'):
+                enrichments = self.enricher.enrich(fixes)
+            self.count_unenriched(-len(fixes))
+            # Nacked, so Pub/Sub redelivers the message.
+            retry_ids = [fix['ackId'] for fix, enrichment
+                         in zip(fixes, enrichments) if enrichment is None]
+            rows = build_rows(fixes, enrichments)
+            enriched = [enrichment for enrichment in enrichments
+                        if enrichment is not None]
+            for (fix, row), enrichment in zip(rows, enriched):
+                self.rows_logged += 1
+                sampled = (self.row_log_every and
+                           self.rows_logged % self.row_log_every == 0)
+                log_row(row, enrichment,
+                        logging.INFO if sampled else logging.DEBUG)
+            self.acks.put((False, retry_ids))
+            if rows and not self.put(self.enriched, rows):
+                return
+        self.put(self.enriched, None)
+
+    def sink_stage(self):
+        sink = self.sink
+        stopping = False
+        while not stopping:
+            time_left = sink.time_left()
+            try:
+                rows = self.enriched.get(
+                    timeout=1.0 if time_left is None else time_left)
+            except Queue.Empty:
+                rows = [] if not self.failed else None
+            if rows is None:
+                stopping = True
+                rows = []
+            for fix, row in rows:
+                # [START saverow]
+                # Buffer the row for BigQuery; its message is acked
+                # once the row has been written.
+                sink.add(row, row_insert_id(fix['messageId'], fix['index']),
+                         fix['ackId'])
+                # [END saverow]
+            if sink.due() or (stopping and len(sink)):
+                inserted = sink.rows_inserted
+                finished = sink.flush(final=stopping)
+                # Remembered before the acks are sent, so a message
+                # redelivered once they are is skipped.
+                if self.seen is not None:
+                    self.seen.add(sink.finished_insert_ids)
+                self.acks.put((True, finished))
+                self.acks.put((False, sink.failed_ack_ids))
+                log.debug("Appended %d rows to BigQuery.",
+                          sink.rows_inserted - inserted)
+                if log.isEnabledFor(logging.DEBUG):
+                    reports = [cache.report()
+                               for cache in self.enricher.caches()]
+                    if self.enricher.trajectories is not None:
+                        reports.append(self.enricher.trajectories.report())
+                    if self.quota is not None:
+                        reports.append(self.quota.report())
+                    for report in reports:
+                        log.debug(report)
+        self.acks.put(None)
+
+    def ack_stage(self):
+        client = self.client_factory()
+        stopping = False
+        while not stopping:
+            ack_ids, nack_ids, stopping = self.next_acks()
+            for send, ids, event in ((acknowledge, ack_ids, 'acked'),
+                                     (nack, nack_ids, 'nacked')):
+                for chunk in chunked(ids, MAX_ACK_IDS):
+                    try:
+                        with metrics.timer('geo_stage_seconds', stage='ack'):
+                            send(client, self.subscription, chunk)
+                        metrics.inc('geo_messages_total', len(chunk),
+                                    event=event)
+                    except REQUEST_ERRORS as e:
+                        # The messages will be redelivered.
+                        log.warning("%s of %d messages failed: %s",
+                                    send.__name__, len(chunk), e)
+                self.leases.remove(ids)
+        self.acked.set()
+
+    def lease_stage(self):
+        client = self.client_factory()
+        # Check a few times per margin, until everything has been acked.
+        while not self.acked.wait(self.lease_margin / 3):
+            expiring = self.leases.expiring(self.lease_margin)
+            for chunk in chunked(expiring, MAX_ACK_IDS):
+                try:
+                    with metrics.timer('geo_stage_seconds', stage='lease'):
+                        client.projects().subscriptions().modifyAckDeadline(
+                            subscription=self.subscription,
+                            body={'ackIds': chunk,
+                                  'ackDeadlineSeconds': self.leases.lease_seconds}
+                        ).execute()
+                    metrics.inc('geo_messages_total', len(chunk),
+                                event='extended')
+                except REQUEST_ERRORS as e:
+                    log.warning("Extending %d leases failed: %s", len(chunk), e)
+
+
+class PushPipeline(PullPipeline):
+    """Enriches and writes messages that Pub/Sub pushes over HTTP.
+
+    Runs the decode, enrich and sink stages of PullPipeline on messages
+    handed to deliver(), one per push request of a geo_push server.
+    Messages delivered at about the same time are enriched and written
+    together. deliver() returns only once the message's rows have been
+    written to BigQuery, so the push request is not answered with
+    success, which acks the message, before that.
+
+    At most max_outstanding messages are worked on at once. Further ones,
+    and ones the Maps API quotas can't take, are turned away at once as
+    'busy' so that Pub/Sub backs off, and a message not done within
+    timeout seconds is answered as such and left for redelivery.
+    """
+
+    def __init__(self, enricher, sink, quota=None, batch_size=100,
+                 max_outstanding=1000, timeout=30.0, row_log_every=100,
+                 quarantine=None, seen=None):
+        super(PushPipeline, self).__init__(
+            None, None, {'maxMessages': batch_size}, enricher, sink, None,
+            quota, queue_size=max_outstanding, row_log_every=row_log_every,
+            quarantine=quarantine, seen=seen)
+        self.max_outstanding = max_outstanding
+        self.timeout = timeout
+        # Token standing in for an ack ID -> [threading.Event, outcome]
+        self.waiting = {}
+        self._tokens = itertools.count()
+
+    def __len__(self):
+        with self._lock:
+            return len(self.waiting)
+
+    def stages(self):
+        return (self.decode_stage, self.enrich_stage, self.sink_stage,
+                self.ack_stage)
 
-                    # Get the message's ack ID.
-                    ack_ids.append(received_message.get('ackId'))
+    def stop(self):
+        with self._lock:
+            if not self.running:
+                return
+            self.running = False
+        self.pulled.put(None)
 
-            # Create a POST body for the acknowledge request.
-            ack_body = {'ackIds': ack_ids}
+    def deliver(self, received_message):
+        """Process one pushed message.
 
-            # Acknowledge the message.
-            client.projects().subscriptions().acknowledge(
-                subscription=subscription, body=ack_body).execute()
+        Returns 'ok' once its rows are written (or it was quarantined),
+        'failed' if they couldn't be, 'timeout' if that took too long, and
+        'busy' or 'stopping' if the message wasn't taken on.
+        """
+        if self.quota is not None and not admissible_messages(
+                self.quota, self.enricher, 1, self.unenriched,
+                self.fixes_per_message()):
+            metrics.inc('geo_messages_total', event='shed')
+            return 'busy'
+        done = threading.Event()
+        with self._lock:
+            if not self.running:
+                return 'stopping'
+            if len(self.waiting) >= self.max_outstanding:
+                metrics.inc('geo_messages_total', event='shed')
+                return 'busy'
+            token = 'push-{0}'.format(next(self._tokens))
+            waiter = self.waiting[token] = [done, None]
+            self.unenriched += 1
+            # Put while holding the lock, so nothing follows the None
+            # that stop() puts.
+            self.pulled.put([dict(received_message, ackId=token)])
+        metrics.inc('geo_messages_total', event='pushed')
+        if not done.wait(self.timeout):
+            with self._lock:
+                if self.waiting.pop(token, None) is not None:
+                    return 'timeout'
+        return waiter[1]
 
+    def ack_stage(self):
+        stopping = False
+        while not stopping:
+            ack_ids, nack_ids, stopping = self.next_acks()
+            with self._lock:
+                for ids, outcome in ((ack_ids, 'ok'), (nack_ids, 'failed')):
+                    for token in ids:
+                        waiter = self.waiting.pop(token, None)
+                        if waiter is not None:
+                            waiter[1] = outcome
+                            waiter[0].set()
+            metrics.inc('geo_messages_total', len(ack_ids), event='acked')
+            metrics.inc('geo_messages_total', len(nack_ids), event='nacked')
+        self.acked.set()
 
 
 if __name__ == '__main__':
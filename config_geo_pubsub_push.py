@@ -38,23 +38,38 @@ Usage:
 
 Run the script passing in the location of the folder that contains the CSV files.
 % python geo_pubsub.py --fileloc 'your_folder_location'
+Messages are published in batches; use --batch-size, --max-latency and
+--max-in-flight to tune how they are grouped and sent. Use --workers N to
+spread the trip files across N processes.
+Each fix is sent as its own CSV string message by default. With
+--format binary, up to --fixes-per-message fixes are packed into each
+message in the compact format of geo_message.py.
 Run 'python traffic_pubsub_generator.py -h' for more information.
 """
 import argparse
 import base64
-import csv
 import datetime
+import itertools
+import logging
+import multiprocessing
 import random
+import re
 import sys
 import time
 import os
+import warnings
 import datetime
+import threading
+import Queue
 import yaml
 import googlemaps
+import numpy
 
 from apiclient import discovery
 from dateutil.parser import parse
 import httplib2
+import geo_clients
+import geo_message
 from oauth2client import client as oauth2client
 
 with open("resources/setup.yaml", 'r') as  varfile:
@@ -67,15 +82,17 @@ PUBSUB_SCOPES = ['https://www.googleapis.com/auth/pubsub']
 NUM_RETRIES = 3
 ROOTDIR = cfg["env"]["ROOTDIR"]
 
+# Cloud Pub/Sub accepts at most 1000 messages and 10MB per publish request.
+MAX_BATCH_MESSAGES = 1000
+MAX_BATCH_BYTES = 10 * 1000 * 1000
+# Allowance for the JSON framing around each message in the request body.
+MESSAGE_OVERHEAD_BYTES = 64
+
+log = logging.getLogger('config_geo_pubsub_push')
+
 # [START createclient]
 def create_pubsub_client(http=None):
-    credentials = oauth2client.GoogleCredentials.get_application_default()
-    if credentials.create_scoped_required():
-        credentials = credentials.create_scoped(PUBSUB_SCOPES)
-    if not http:
-        http = httplib2.Http()
-    credentials.authorize(http)
-    return discovery.build('pubsub', 'v1', http=http)
+    return geo_clients.build_client('pubsub', 'v1', PUBSUB_SCOPES, http=http)
 # [END createclient]
 
 # [START publish]
@@ -91,17 +108,466 @@ def publish(client, pubsub_topic, data_line, msg_attributes=None):
     return resp
 # [END publish]
 
+def publish_batch(client, pubsub_topic, messages):
+    """Publish a list of already encoded message payloads in one request."""
+    body = {'messages': messages}
+    resp = client.projects().topics().publish(
+        topic=pubsub_topic, body=body).execute(num_retries=NUM_RETRIES)
+    return resp
+
+def message_size(msg_payload):
+    """Estimate how many bytes a message payload adds to a publish request."""
+    size = len(msg_payload['data']) + MESSAGE_OVERHEAD_BYTES
+    for key, value in msg_payload.get('attributes', {}).items():
+        size += len(key) + len(value) + MESSAGE_OVERHEAD_BYTES
+    return size
+
+
+class BatchPublisher(object):
+    """Buffers messages and publishes them in batches.
+
+    A batch is sent when it reaches max_messages, when adding another
+    message would take it over max_bytes, or when its oldest message has
+    waited max_latency seconds.
+
+    Batches are built in max_in_flight lanes, each with its own sender
+    thread and client because httplib2 connections are not thread-safe.
+    Messages published with the same ordering_key always use the same
+    lane, so they are sent in the order they were published. Messages
+    without a key rotate across lanes. publish() blocks when a lane
+    already has a request in flight and another one queued.
+
+    A request that fails is logged and its messages are dropped; the
+    errors are kept in errors, counted in report(), and close() raises
+    the first of them.
+    """
+
+    def __init__(self, client_factory, pubsub_topic,
+                 max_messages=MAX_BATCH_MESSAGES, max_bytes=MAX_BATCH_BYTES,
+                 max_latency=0.5, max_in_flight=4):
+        self.pubsub_topic = pubsub_topic
+        self.max_messages = min(max_messages, MAX_BATCH_MESSAGES)
+        self.max_bytes = min(max_bytes, MAX_BATCH_BYTES)
+        self.max_latency = max_latency
+
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.requests_sent = 0
+        self.messages_failed = 0
+        self.errors = []
+        self.start_time = time.time()
+
+        # _lock guards the open batches and is held while handing a full
+        # batch to a sender, so the senders record their results under a
+        # separate lock.
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batches = [[] for _ in range(max_in_flight)]
+        self._batch_bytes = [0] * max_in_flight
+        self._batch_started = [None] * max_in_flight
+        self._next_lane = 0
+        self._closed = False
+        self._queues = [Queue.Queue(maxsize=1) for _ in range(max_in_flight)]
+
+        self._senders = []
+        for queue in self._queues:
+            sender = threading.Thread(target=self._send_loop,
+                                      args=(client_factory(), queue))
+            sender.daemon = True
+            sender.start()
+            self._senders.append(sender)
+
+        self._timer = threading.Thread(target=self._timer_loop)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def publish(self, data_line, msg_attributes=None, ordering_key=None):
+        """Add one message to the open batch of its lane."""
+        msg_payload = {'data': base64.b64encode(data_line)}
+        if msg_attributes:
+            msg_payload['attributes'] = msg_attributes
+        size = message_size(msg_payload)
+        if size > self.max_bytes:
+            raise ValueError("Message of %d bytes exceeds the publish "
+                             "request limit" % size)
+
+        with self._lock:
+            if ordering_key is None:
+                lane = self._next_lane
+            else:
+                lane = hash(ordering_key) % len(self._queues)
+            if self._batch_bytes[lane] + size > self.max_bytes:
+                self._dispatch(lane)
+            if not self._batches[lane]:
+                self._batch_started[lane] = time.time()
+            self._batches[lane].append(msg_payload)
+            self._batch_bytes[lane] += size
+            if len(self._batches[lane]) >= self.max_messages:
+                self._dispatch(lane)
+
+    def flush(self):
+        """Send whatever is buffered without waiting for it to fill up."""
+        with self._lock:
+            for lane in range(len(self._queues)):
+                self._dispatch(lane)
+
+    def drain(self):
+        """Flush and wait until every request sent so far has completed."""
+        self.flush()
+        for queue in self._queues:
+            queue.join()
+
+    def close(self):
+        """Flush, wait for outstanding requests and stop the senders.
+
+        Raises the first publish error, if any request failed.
+        """
+        with self._lock:
+            for lane in range(len(self._queues)):
+                self._dispatch(lane)
+            self._closed = True
+        for queue in self._queues:
+            queue.put(None)
+        for sender in self._senders:
+            sender.join()
+        self._timer.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def report(self):
+        """Summarize what has been published so far."""
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        return ("Published {0} messages ({1} bytes) in {2} requests, "
+                "{3:.1f} msgs/s, {4} failed requests of {5} messages").format(
+                    self.messages_sent, self.bytes_sent, self.requests_sent,
+                    self.messages_sent / elapsed, len(self.errors),
+                    self.messages_failed)
+
+    def _dispatch(self, lane):
+        # Caller must hold self._lock.
+        if not self._batches[lane]:
+            return
+        self._queues[lane].put((self._batches[lane], self._batch_bytes[lane]))
+        self._batches[lane] = []
+        self._batch_bytes[lane] = 0
+        self._batch_started[lane] = None
+        if lane == self._next_lane:
+            self._next_lane = (lane + 1) % len(self._queues)
+
+    def _timer_loop(self):
+        while True:
+            time.sleep(self.max_latency / 2.0)
+            with self._lock:
+                if self._closed:
+                    return
+                now = time.time()
+                for lane, started in enumerate(self._batch_started):
+                    if started is not None and now - started >= self.max_latency:
+                        self._dispatch(lane)
+
+    def _send_loop(self, client, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                queue.task_done()
+                return
+            messages, size = item
+            try:
+                resp = publish_batch(client, self.pubsub_topic, messages)
+            except Exception as e:
+                log.exception("Publish of %d messages failed", len(messages))
+                with self._stats_lock:
+                    self.errors.append(e)
+                    self.messages_failed += len(messages)
+            else:
+                with self._stats_lock:
+                    self.messages_sent += len(resp.get('messageIds', messages))
+                    self.bytes_sent += size
+                    self.requests_sent += 1
+            queue.task_done()
+
 def create_timestamp(hms,dmy):
     """Format two time/date columns as a datetime object"""
     h = int(hms[0:2])
-    m = int(hms[2:4])
+    mi = int(hms[2:4])
     s = int(hms[4:6])
 
     d= int(dmy[0:2])
-    m = int(dmy[2:4])
+    mo = int(dmy[2:4])
     y = int(dmy[4:6]) + 2000
 
-    return (str(datetime.datetime(y,m,d,h,m,s)))
+    return (str(datetime.datetime(y,mo,d,h,mi,s)))
+
+# Columns of a $GPRMC sentence in the trip files.
+# See http://www.gpsinformation.org/dale/nmea.htm#RMC for details.
+(RMC_SENTENCE, RMC_TIME, RMC_STATUS, RMC_LAT, RMC_LAT_DIR, RMC_LNG,
+ RMC_LNG_DIR, RMC_SPEED, RMC_BEARING, RMC_DATE) = range(10)
+RMC_COLUMNS = 10
+# How those columns are parsed; strings longer than a valid value are
+# kept long enough to tell them apart from it.
+RMC_DTYPE = [('sentence', 'S8'), ('time', float), ('status', 'S2'),
+             ('lat', float), ('lat_dir', 'S2'), ('lng', float),
+             ('lng_dir', 'S2'), ('speed', float), ('bearing', float),
+             ('date', 'S7')]
+
+# Names of the arrays returned by read_trip_file.
+FIX_FIELDS = ('latitude', 'longitude', 'speed', 'bearing', 'epoch')
+
+def nmea_to_decimal(values, directions, negative):
+    """Convert NMEA (d)ddmm.mmmm values to signed decimal degrees."""
+    degrees = numpy.floor(values / 100.0)
+    decimal = degrees + (values - degrees * 100.0) / 60.0
+    return numpy.where(directions == negative, -decimal, decimal)
+
+def rmc_epoch(hms, dmy):
+    """Convert hhmmss.s and ddmmyy columns to POSIX seconds (UTC)."""
+    day = dmy // 10000
+    month = (dmy // 100) % 100
+    year = dmy % 100 + 30  # Years since 1970 for a 20yy date.
+    days = (year.astype('datetime64[Y]') +
+            (month - 1).astype('timedelta64[M]')).astype('datetime64[D]')
+    days = days + (day - 1).astype('timedelta64[D]')
+    seconds = (hms // 10000) * 3600 + ((hms // 100) % 100) * 60 + hms % 100
+    return days.astype('int64') * 86400 + seconds
+
+def format_timestamps(epoch):
+    """Format POSIX seconds the way create_timestamp does."""
+    stamps = numpy.datetime_as_string(
+        numpy.floor(epoch).astype('int64').astype('datetime64[s]'))
+    return numpy.char.replace(stamps, 'T', ' ')
+
+def parse_trip_lines(lines):
+    """Parse trip CSV lines, without the header, like read_trip_file.
+
+    Each column is parsed straight into an array of its type; rows with
+    too few columns, and values that aren't numbers, are rejected below.
+    """
+    counts = [0]
+
+    def counted(lines):
+        for line in lines:
+            if line.strip('\r\n'):
+                counts[0] += 1
+            yield line
+
+    with warnings.catch_warnings():
+        # Rows with too few columns are skipped with a warning each.
+        warnings.simplefilter('ignore')
+        table = numpy.atleast_1d(numpy.genfromtxt(
+            counted(lines), delimiter=',', dtype=RMC_DTYPE,
+            usecols=range(RMC_COLUMNS), comments=None, invalid_raise=False))
+    fixes = dict((field, numpy.empty(0)) for field in FIX_FIELDS)
+    if not len(table):
+        return fixes, counts[0]
+
+    date = table['date']
+    # Empty and non-numeric values parse as NaN.
+    valid = ((table['sentence'] == '$GPRMC') & (table['status'] == 'A') &
+             numpy.in1d(table['lat_dir'], ['N', 'S']) &
+             numpy.in1d(table['lng_dir'], ['E', 'W']) &
+             numpy.isfinite(table['lat']) & numpy.isfinite(table['lng']) &
+             numpy.isfinite(table['time']) &
+             (numpy.char.str_len(date) == 6) & numpy.char.isdigit(date))
+    table = table[valid]
+
+    fixes['latitude'] = nmea_to_decimal(table['lat'], table['lat_dir'], 'S')
+    fixes['longitude'] = nmea_to_decimal(table['lng'], table['lng_dir'], 'W')
+    fixes['speed'] = table['speed']
+    fixes['bearing'] = table['bearing']
+    fixes['epoch'] = rmc_epoch(table['time'], table['date'].astype(int))
+    return fixes, counts[0] - len(table)
+
+def read_trip_file(path):
+    """Parse a trip CSV file into column arrays of valid $GPRMC fixes.
+
+    Returns a dict of NumPy arrays keyed by FIX_FIELDS, in file order, and
+    the number of rows that were rejected: other sentences, fixes whose
+    status is not A (active), and rows with bad directions or empty fields.
+    """
+    with open(path) as data_file:
+        next(data_file, None)  # Skip the header row.
+        return parse_trip_lines(data_file)
+
+def read_trip_chunks(path, chunk_size, offset=0):
+    """Parse a trip CSV file chunk_size rows at a time, after skipping the
+    first offset rows after the header.
+
+    Yields the number of rows read so far, counting the skipped ones, and
+    the fixes and rejected count of the chunk, like read_trip_file.
+    """
+    with open(path) as data_file:
+        next(data_file, None)  # Skip the header row.
+        for _ in itertools.islice(data_file, offset):
+            pass
+        while True:
+            lines = list(itertools.islice(data_file, chunk_size))
+            if not lines:
+                return
+            offset += len(lines)
+            fixes, rejected = parse_trip_lines(lines)
+            yield offset, fixes, rejected
+
+
+# San Diego data file names include trip ID, so use this to identify each journey.
+TRIP_FILE_PATTERN = re.compile(r'Trip(\d+)\.csv$')
+
+def vehicle_id(path):
+    """Return the trip ID in a Mobile-GPS-Trip file name, or None."""
+    match = TRIP_FILE_PATTERN.search(os.path.basename(path))
+    if match:
+        return match.group(1)
+    return None
+
+def find_trip_files(rootdir):
+    """List trip files under rootdir, largest first to balance the workers."""
+    paths = []
+    for subdir, dirs, files in os.walk(rootdir):
+        for file in files:
+            myfile = os.path.join(subdir, file)
+            if vehicle_id(myfile) is not None:
+                paths.append(myfile)
+    return sorted(paths, key=os.path.getsize, reverse=True)
+
+# Message formats: one CSV string per fix, or many fixes per message.
+MESSAGE_FORMATS = ('csv', 'binary')
+DEFAULT_FIXES_PER_MESSAGE = 100
+
+# The publisher of this process, how it formats messages and whether
+# publish_trip_file waits for them to be sent, set by init_worker.
+_publisher = None
+_message_format = 'csv'
+_fixes_per_message = DEFAULT_FIXES_PER_MESSAGE
+_drain_each_file = False
+
+def init_worker(pubsub_topic, publisher_options,
+                client_factory=create_pubsub_client, message_format='csv',
+                fixes_per_message=DEFAULT_FIXES_PER_MESSAGE,
+                drain_each_file=False):
+    """Create the publisher used by publish_trip_file in this process.
+
+    With drain_each_file, publish_trip_file returns only once the file's
+    messages are sent, for pool workers, whose publishers are never
+    closed. Otherwise the next file is published while they are in
+    flight; close the publisher to send the rest.
+    """
+    global _publisher, _message_format, _fixes_per_message, _drain_each_file
+    _publisher = BatchPublisher(client_factory, pubsub_topic,
+                                **publisher_options)
+    _message_format = message_format
+    _fixes_per_message = fixes_per_message
+    _drain_each_file = drain_each_file
+
+def publish_csv_fixes(vehicleID, fixes):
+    """Publish each fix as its own comma-separated string."""
+    timestamps = format_timestamps(fixes['epoch']).tolist()
+    for latitude, longitude, speed, bearing, ts in zip(
+            fixes['latitude'].tolist(), fixes['longitude'].tolist(),
+            fixes['speed'].tolist(), fixes['bearing'].tolist(),
+            timestamps):
+        msg_attributes = {'timestamp': ts}
+        proc_line =  "{0}, {1}, {2}, {3} ,{4} ".format(vehicleID, latitude,longitude, speed, bearing)
+        _publisher.publish(proc_line, msg_attributes, ordering_key=vehicleID)
+
+def publish_binary_fixes(vehicleID, fixes):
+    """Publish the fixes packed _fixes_per_message at a time."""
+    msg_attributes = {geo_message.FORMAT_ATTRIBUTE: geo_message.BINARY_FORMAT}
+    count = len(fixes['epoch'])
+    for start in range(0, count, _fixes_per_message):
+        end = min(start + _fixes_per_message, count)
+        data = geo_message.encode(
+            [vehicleID] * (end - start),
+            dict((field, fixes[field][start:end])
+                 for field in geo_message.FIELDS))
+        _publisher.publish(data, msg_attributes, ordering_key=vehicleID)
+
+def publish_trip_file(myfile):
+    """Publish every fix in one trip file and return its statistics.
+
+    Fixes are published in file order with the vehicle ID as ordering key.
+    The published, bytes, errors and failed counts are of the requests
+    completed while the file was published, which are all of the file's
+    only if init_worker was told to drain each file.
+    """
+    start = time.time()
+    sent, size, errors, failed = (
+        _publisher.messages_sent, _publisher.bytes_sent,
+        len(_publisher.errors), _publisher.messages_failed)
+    vehicleID = vehicle_id(myfile)
+    # [START processcsv]
+    fixes, rejected = read_trip_file(myfile)
+    if _message_format == 'binary':
+        publish_binary_fixes(vehicleID, fixes)
+    else:
+        publish_csv_fixes(vehicleID, fixes)
+    # [END processcsv]
+    if _drain_each_file:
+        _publisher.drain()
+    return {
+        'file': myfile,
+        'vehicle': vehicleID,
+        'fixes': len(fixes['epoch']),
+        'rejected': rejected,
+        'published': _publisher.messages_sent - sent,
+        'bytes': _publisher.bytes_sent - size,
+        'errors': len(_publisher.errors) - errors,
+        'failed': _publisher.messages_failed - failed,
+        'seconds': time.time() - start,
+    }
+
+
+class IngestProgress(object):
+    """Merges per-file results from the workers into one progress report."""
+
+    def __init__(self, total_files):
+        self.total_files = total_files
+        self.files = 0
+        self.totals = {'fixes': 0, 'rejected': 0, 'published': 0,
+                       'bytes': 0, 'errors': 0, 'failed': 0}
+        self.failed_files = []
+        self.start_time = time.time()
+
+    def update(self, result):
+        self.files += 1
+        for key in self.totals:
+            self.totals[key] += result[key]
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        print ("[{0}/{1}] Vehicle ID: {2}, {3} fixes, {4} rows rejected, "
+               "{5:.2f}s; total {6:.1f} msgs/s").format(
+                   self.files, self.total_files, result['vehicle'],
+                   result['fixes'], result['rejected'], result['seconds'],
+                   self.totals['published'] / elapsed)
+
+    def file_failed(self, path):
+        """Count a file whose publish_trip_file raised."""
+        self.files += 1
+        self.failed_files.append(path)
+        log.exception("[%d/%d] Publishing %s failed", self.files,
+                      self.total_files, path)
+
+    def succeeded(self):
+        """Whether every file and every publish request got through."""
+        return not (self.failed_files or self.totals['errors'])
+
+    def finish(self, publisher):
+        """Take the totals sent from a closed publisher, which include the
+        requests completed after the last file returned."""
+        self.totals['published'] = publisher.messages_sent
+        self.totals['bytes'] = publisher.bytes_sent
+        self.totals['errors'] = len(publisher.errors)
+        self.totals['failed'] = publisher.messages_failed
+
+    def report(self):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        return ("Published {0} messages for {1} fixes ({2} bytes) from {3} "
+                "files in {4:.1f}s, {5:.1f} msgs/s, {6:.1f} MB/s; {7} rows "
+                "rejected, {8} failed requests of {9} messages, {10} failed "
+                "files").format(
+                    self.totals['published'], self.totals['fixes'],
+                    self.totals['bytes'], self.files, elapsed,
+                    self.totals['published'] / elapsed,
+                    self.totals['bytes'] / elapsed / 1e6,
+                    self.totals['rejected'], self.totals['errors'],
+                    self.totals['failed'], len(self.failed_files))
 
 
 def main(argv):
@@ -111,8 +577,25 @@ def main(argv):
     parser.add_argument("--topic", default=TRAFFIC_TOPIC,
                         help="The pubsub 'traffic' topic to publish to. " +
                         "Should already exist.")
+    parser.add_argument("--batch-size", type=int, default=MAX_BATCH_MESSAGES,
+                        help="Maximum number of messages per publish request.")
+    parser.add_argument("--max-latency", type=float, default=0.5,
+                        help="Maximum seconds a message waits in a batch.")
+    parser.add_argument("--max-in-flight", type=int, default=4,
+                        help="Number of concurrent publish requests.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes that read and publish "
+                        "trip files; 0 uses every CPU.")
+    parser.add_argument("--format", choices=MESSAGE_FORMATS, default='csv',
+                        help="Message format: one CSV string per fix, or "
+                        "fixes packed in binary.")
+    parser.add_argument("--fixes-per-message", type=int,
+                        default=DEFAULT_FIXES_PER_MESSAGE,
+                        help="Fixes packed into each binary message.")
 
     args = parser.parse_args()
+    # Shows the client setup times geo_clients logs.
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
 
     pubsub_topic = args.topic
     print "Publishing to pubsub 'traffic' topic: %s" % pubsub_topic
@@ -120,39 +603,49 @@ def main(argv):
     rootdir = args.fileloc
     print "Folder to process: %s" % rootdir
 
+    trip_files = find_trip_files(rootdir)
+    publisher_options = {
+        'max_messages': args.batch_size,
+        'max_latency': args.max_latency,
+        'max_in_flight': args.max_in_flight,
+    }
+    workers = args.workers or multiprocessing.cpu_count()
+    progress = IngestProgress(len(trip_files))
 
-    client = create_pubsub_client()
+    worker_args = (pubsub_topic, publisher_options, create_pubsub_client,
+                   args.format, args.fixes_per_message)
 
-    for subdir, dirs, files in os.walk(rootdir):
-        for file in files:
-            # San Diego data file names include trip ID, so use this to identify each journey.
-            name_ext = file.split(".")
-            vehicleID = name_ext[0][15:]
-
-            myfile = os.path.join(subdir,file)
-            print myfile
-            line_count = 0
-            # [START processcsv]
-            with open(myfile) as data_file:
-                reader = csv.reader(data_file)
-                for line in reader:
-                    line_count += 1
-
-                    if line_count > 1:
-                        # Convert NMEA GPS format to decimal degrees.
-                        # See http://www.gpsinformation.org/dale/nmea.htm#position for NMEA GPS format details.
-                        lat = float(line[3][0:2])
-                        lng = float(line[5][0:3])
-                        lng_minutes = float(line[5][3:])/60
-                        lat_minutes = float(line[3][2:])/60
-                        latitude = lat + lat_minutes
-                        longitude =  0 - (lng + lng_minutes)
-                        ts = create_timestamp(line[1],line[9])
-                        msg_attributes = {'timestamp': ts}
-                        print "Vehicle ID: {0}, location: {1}, {2}; speed: {3} mph, bearing: {4} degrees".format(vehicleID, latitude,longitude, line[7], line[8])
-                        proc_line =  "{0}, {1}, {2}, {3} ,{4} ".format(vehicleID, latitude,longitude, line[7], line[8])
-                        publish(client, pubsub_topic, proc_line, msg_attributes)
-            # [END processcsv]
+    if workers == 1:
+        init_worker(*worker_args)
+        for myfile in trip_files:
+            try:
+                progress.update(publish_trip_file(myfile))
+            except Exception:
+                progress.file_failed(myfile)
+        try:
+            _publisher.close()
+        except Exception:
+            # The sender logged it; finish counts it among the errors.
+            pass
+        progress.finish(_publisher)
+    else:
+        print "Publishing with %d worker processes" % workers
+        pool = multiprocessing.Pool(workers, init_worker,
+                                    worker_args + (True,))
+        # get() raises what the worker raised, so each file is waited
+        # on by itself and one failure doesn't hide the others.
+        results = [(myfile, pool.apply_async(publish_trip_file, (myfile,)))
+                   for myfile in trip_files]
+        pool.close()
+        for myfile, result in results:
+            try:
+                progress.update(result.get())
+            except Exception:
+                progress.file_failed(myfile)
+        pool.join()
+
+    print progress.report()
+    return 0 if progress.succeeded() else 1
 
 if __name__ == '__main__':
-        main(sys.argv)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This script serves point counts of the BigQuery table per map tile to the
+web viewer, from a cache, instead of the viewer querying BigQuery itself.
+
+Tiles are aggregated by a BigQuery query the first time they are asked
+for and then served from memory, so panning back over the map doesn't
+start new jobs. Every --refresh-interval seconds the rows inserted since
+are added to the cached tiles, and tiles are loaded again after --ttl
+seconds. Set tileServer in web/bqapi.html to the server's URL to use it.
+
+Usage:
+
+% python config_geo_tiles.py --port 8090
+% python config_geo_tiles.py --port 8090 --fake resources/data
+
+With --fake, the tiles are made from the trip files in the folder instead
+of BigQuery, without any Google credentials.
+"""
+import argparse
+import logging
+import sys
+import threading
+
+import config_geo_pubsub_pull as pull
+import config_geo_pubsub_push as push
+import geo_fakes
+import geo_tiles
+
+log = logging.getLogger('config_geo_tiles')
+
+
+def fake_source(fileloc):
+    """A FakeTileSource of the fixes in the trip files under fileloc."""
+    source = geo_fakes.FakeTileSource()
+    for trip_file in push.find_trip_files(fileloc):
+        fixes, _ = push.read_trip_file(trip_file)
+        source.add(fixes['latitude'].tolist(), fixes['longitude'].tolist())
+    return source
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--host", default='',
+                        help="Address to listen on; all of them by default.")
+    parser.add_argument("--cache-tiles", type=int, default=10000,
+                        help="Most tiles kept in memory.")
+    parser.add_argument("--ttl", type=float, default=600.0,
+                        help="Seconds before a cached tile is loaded again.")
+    parser.add_argument("--refresh-interval", type=float, default=30.0,
+                        help="Seconds between adding new rows to the "
+                        "cached tiles.")
+    parser.add_argument("--bins", type=int, default=16,
+                        help="Tiles count points in a grid of this many "
+                        "bins a side.")
+    parser.add_argument("--bin-samples", type=int, default=4,
+                        help="Points sampled per bin.")
+    parser.add_argument("--fake", metavar="FOLDER",
+                        help="Serve the trip files in FOLDER instead of "
+                        "querying BigQuery.")
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+        format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.fake:
+        source = fake_source(args.fake)
+    else:
+        source = geo_tiles.BigQueryTileSource(
+            pull.create_bigquery_client(), pull.cfg["env"]["PROJECT_ID"],
+            pull.cfg["env"]["DATASET_ID"], pull.cfg["env"]["TABLE_ID"])
+    cache = geo_tiles.TileCache(args.cache_tiles, args.ttl)
+    service = geo_tiles.TileService(source, cache, args.bins,
+                                    args.bin_samples)
+    stop = threading.Event()
+    refresher = threading.Thread(target=service.refresh_every,
+                                 args=(args.refresh_interval, stop),
+                                 name='refresh')
+    refresher.daemon = True
+    refresher.start()
+    server = geo_tiles.serve(args.port, service, args.host)
+    log.info("Serving tiles at http://%s:%d/tiles/ZOOM/X/Y.json",
+             args.host or 'localhost', args.port)
+    try:
+        while not stop.wait(3600):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        refresher.join()
+        server.shutdown()
+        log.info(cache.report())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
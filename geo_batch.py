@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Columnar decoding of pulled Pub/Sub messages into batches of GPS fixes.
+
+decode_batch() turns the messages of a pull response, in either format the
+publisher sends (one CSV string per fix, or geo_message binary), into one
+FixBatch of NumPy columns. Numbers and timestamps are converted for the
+whole batch at once, and timestamps are read as UTC. Messages that can't
+be decoded, or whose fixes are out of range, are returned separately for
+quarantine rather than failing the batch.
+"""
+import base64
+import collections
+import json
+import threading
+import time
+
+import numpy
+
+import geo_message
+
+# Columns of a FixBatch besides the vehicle and message IDs.
+FLOAT_COLUMNS = ('epoch', 'latitude', 'longitude', 'speed', 'bearing')
+# Comma-separated fields of a CSV string message.
+CSV_FIELDS = ('vehicle', 'latitude', 'longitude', 'speed', 'bearing')
+
+
+def format_utc(epoch):
+    """Format POSIX seconds as 'YYYY-MM-DD HH:MM:SS' UTC strings."""
+    stamps = numpy.datetime_as_string(
+        numpy.floor(epoch).astype('int64').astype('datetime64[s]'))
+    return numpy.char.replace(stamps, 'T', ' ')
+
+
+def parse_utc(stamps):
+    """POSIX seconds of 'YYYY-MM-DD HH:MM:SS' UTC strings, NaN if invalid."""
+    try:
+        return numpy.array(stamps, dtype='datetime64[s]').astype(
+            'int64').astype(float)
+    except ValueError:
+        pass
+    # Find the invalid ones.
+    epoch = numpy.empty(len(stamps))
+    for position, stamp in enumerate(stamps):
+        try:
+            epoch[position] = numpy.datetime64(stamp, 's').astype('int64')
+        except ValueError:
+            epoch[position] = numpy.nan
+    return epoch
+
+
+def parse_floats(values):
+    """values as a float array, NaN where they aren't numbers."""
+    try:
+        return numpy.array(values, dtype=float)
+    except ValueError:
+        pass
+    floats = numpy.empty(len(values))
+    for position, value in enumerate(values):
+        try:
+            floats[position] = float(value)
+        except ValueError:
+            floats[position] = numpy.nan
+    return floats
+
+
+class FixBatch(object):
+    """GPS fixes as NumPy columns, with the messages they came from.
+
+    Columns are vehicle_id, the FLOAT_COLUMNS (epoch is POSIX seconds,
+    speed and bearing NaN if unknown), message_id, ack_id and index, the
+    position of the fix in its message. A FixBatch is also a sequence of
+    fix dicts, as used by the Enricher and build_row, made on first use.
+    """
+
+    def __init__(self, vehicle_id, epoch, latitude, longitude, speed,
+                 bearing, message_id, ack_id, index):
+        self.vehicle_id = numpy.asarray(vehicle_id, dtype=object)
+        self.epoch = numpy.asarray(epoch, dtype=float)
+        self.latitude = numpy.asarray(latitude, dtype=float)
+        self.longitude = numpy.asarray(longitude, dtype=float)
+        self.speed = numpy.asarray(speed, dtype=float)
+        self.bearing = numpy.asarray(bearing, dtype=float)
+        self.message_id = numpy.asarray(message_id, dtype=object)
+        self.ack_id = numpy.asarray(ack_id, dtype=object)
+        self.index = numpy.asarray(index, dtype=int)
+        self._fixes = None
+
+    @classmethod
+    def empty(cls):
+        return cls(*[[]] * 9)
+
+    def __len__(self):
+        return len(self.epoch)
+
+    def __getitem__(self, position):
+        return self.fixes()[position]
+
+    def __iter__(self):
+        return iter(self.fixes())
+
+    def take(self, positions):
+        """A batch of the fixes at positions."""
+        return FixBatch(*[column[positions] for column in self._columns()])
+
+    def fixes_per_ack_id(self):
+        return collections.Counter(self.ack_id.tolist())
+
+    def fixes(self):
+        """The fixes as dicts, keyed like the BigQuery columns."""
+        if self._fixes is None:
+            utc_time = format_utc(self.epoch).tolist()
+            # NaN isn't valid JSON, so unknown values are left empty.
+            speed = numpy.where(numpy.isnan(self.speed), None, self.speed)
+            bearing = numpy.where(numpy.isnan(self.bearing), None,
+                                  self.bearing)
+            self._fixes = [{
+                'VehicleID': vehicle,
+                'UTCTime': stamp,
+                'posix_time': epoch,
+                'Latitude': latitude,
+                'Longitude': longitude,
+                'Speed': fix_speed,
+                'Bearing': fix_bearing,
+                'messageId': message_id,
+                'ackId': ack_id,
+                'index': index,
+            } for (vehicle, stamp, epoch, latitude, longitude, fix_speed,
+                   fix_bearing, message_id, ack_id, index) in zip(
+                       self.vehicle_id.tolist(), utc_time,
+                       self.epoch.tolist(), self.latitude.tolist(),
+                       self.longitude.tolist(), speed.tolist(),
+                       bearing.tolist(), self.message_id.tolist(),
+                       self.ack_id.tolist(), self.index.tolist())]
+        return self._fixes
+
+    def _columns(self):
+        return (self.vehicle_id, self.epoch, self.latitude, self.longitude,
+                self.speed, self.bearing, self.message_id, self.ack_id,
+                self.index)
+
+
+def concatenate(batches):
+    """One batch of the fixes of every batch, in order."""
+    if not batches:
+        return FixBatch.empty()
+    if len(batches) == 1:
+        return batches[0]
+    return FixBatch(*[numpy.concatenate(columns) for columns in zip(
+        *[batch._columns() for batch in batches])])
+
+
+def decode_batch(received_messages):
+    """Decode the messages of a pull response into one FixBatch.
+
+    Returns the batch and a list of (received message, reason) for the
+    messages that were rejected as a whole: undecodable, or with any fix
+    that lacks a vehicle ID or has an invalid time or position. Messages
+    that decode to no fixes are in neither.
+    """
+    rejected = {}
+    # Positions in received_messages and contents of the messages that
+    # decoded, by format.
+    csv_messages = []
+    csv_lines = []
+    csv_stamps = []
+    binary_messages = []
+    binary_parts = []
+    for position, received_message in enumerate(received_messages):
+        pubsub_message = received_message.get('message') or {}
+        try:
+            data = base64.b64decode(str(pubsub_message.get('data', '')))
+        except TypeError:
+            rejected[position] = "data is not base64"
+            continue
+        attributes = pubsub_message.get('attributes') or {}
+        if geo_message.is_binary(attributes):
+            try:
+                vehicle_ids, records = geo_message.decode(data)
+            except geo_message.MessageError as e:
+                rejected[position] = str(e)
+                continue
+            binary_messages.append(position)
+            binary_parts.append((vehicle_ids, records))
+            continue
+        fields = data.split(',')
+        if len(fields) != len(CSV_FIELDS) or 'timestamp' not in attributes:
+            rejected[position] = "not a CSV fix with a timestamp"
+            continue
+        csv_messages.append(position)
+        csv_lines.append(fields)
+        csv_stamps.append(attributes['timestamp'])
+
+    columns = dict((name, []) for name in ('vehicle_id', 'position',
+                                           'index') + FLOAT_COLUMNS)
+    if csv_lines:
+        table = numpy.array(csv_lines, dtype=object)
+        columns['vehicle_id'].append(
+            numpy.char.strip(table[:, 0].astype(str)).astype(object))
+        for field in CSV_FIELDS[1:]:
+            columns[field].append(parse_floats(
+                table[:, CSV_FIELDS.index(field)].tolist()))
+        columns['epoch'].append(parse_utc(csv_stamps))
+        columns['position'].append(numpy.array(csv_messages))
+        columns['index'].append(numpy.zeros(len(csv_lines), dtype=int))
+    for position, (vehicle_ids, records) in zip(binary_messages,
+                                                binary_parts):
+        columns['vehicle_id'].append(
+            numpy.array(vehicle_ids, dtype=object)[records['vehicle']]
+            if len(records) else numpy.empty(0, dtype=object))
+        for field in FLOAT_COLUMNS:
+            columns[field].append(records[field])
+        columns['position'].append(numpy.repeat(position, len(records)))
+        columns['index'].append(numpy.arange(len(records)))
+    if not columns['position']:
+        return FixBatch.empty(), [
+            (received_messages[position], reason)
+            for position, reason in sorted(rejected.items())]
+    columns = dict((name, numpy.concatenate(parts))
+                   for name, parts in columns.items())
+
+    with numpy.errstate(invalid='ignore'):
+        # NaN positions compare false, so they are invalid too.
+        valid = ((columns['vehicle_id'] != '') &
+                 numpy.isfinite(columns['epoch']) &
+                 (numpy.abs(columns['latitude']) <= 90) &
+                 (numpy.abs(columns['longitude']) <= 180))
+    for position in numpy.unique(columns['position'][~valid]).tolist():
+        rejected[position] = "fix with no vehicle ID or an invalid time " \
+            "or position"
+    keep = ~numpy.in1d(columns['position'], list(rejected))
+
+    positions = columns['position'][keep]
+    message_ids = [(received_messages[position].get('message') or {}).get(
+        'messageId') for position in positions.tolist()]
+    ack_ids = [received_messages[position].get('ackId')
+               for position in positions.tolist()]
+    batch = FixBatch(columns['vehicle_id'][keep], columns['epoch'][keep],
+                     columns['latitude'][keep], columns['longitude'][keep],
+                     columns['speed'][keep], columns['bearing'][keep],
+                     message_ids, ack_ids, columns['index'][keep])
+    return batch, [(received_messages[position], reason)
+                   for position, reason in sorted(rejected.items())]
+
+
+class Quarantine(object):
+    """Appends messages that can't be processed to a JSON lines file.
+
+    Each line has the message as pulled, the reason it was rejected and
+    when, so it can be inspected and republished by hand. Several workers
+    can append to the same file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, received_message, reason):
+        line = json.dumps({
+            'message': received_message.get('message'),
+            'reason': reason,
+            'time': time.time(),
+        }) + '\n'
+        with self._lock:
+            # One write per line, so lines from several processes
+            # appending at once don't interleave.
+            with open(self.path, 'a') as quarantine_file:
+                quarantine_file.write(line)
+            self.count += 1
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+End-to-end throughput benchmark against local fakes.
+
+Replays the trip files through the push script's publisher, the pull
+script's pipeline and BigQuery row sink, with geo_fakes standing in for
+Cloud Pub/Sub, BigQuery and the Maps APIs, and reports rows per
+second, end-to-end latency from publish to insert, and Maps API calls per
+row. Run it from the repository root, like the scripts it drives.
+
+Usage:
+
+% python geo_benchmark.py
+% python geo_benchmark.py --maps-latency 0.1 --maps-error-rate 0.01 --cache
+% python geo_benchmark.py --format binary --fixes-per-message 50
+% python geo_benchmark.py --push --push-concurrency 200
+% python geo_benchmark.py --tune-interval 2 --maps-latency 0.2
+% python geo_benchmark.py --pubsub-error-rate 0.2 --dedup
+
+With --push, the fake Pub/Sub delivers messages by HTTP to the pull
+script's push endpoint (geo_push) on a local port instead of being pulled.
+"""
+import argparse
+import logging
+import sys
+import threading
+import time
+
+import numpy
+
+import config_geo_pubsub_pull as pull
+import config_geo_pubsub_push as push
+import geo_cache
+import geo_dedup
+import geo_fakes
+import geo_leases
+import geo_metrics
+import geo_push
+import geo_trajectory
+import geo_tuning
+
+TOPIC = 'projects/benchmark/topics/traffic'
+SUBSCRIPTION = 'projects/benchmark/subscriptions/traffic'
+
+
+def publish_files(trip_files, broker, publisher_options, progress,
+                  message_format='csv', fixes_per_message=1):
+    push.init_worker(TOPIC, publisher_options, client_factory=lambda: broker,
+                     message_format=message_format,
+                     fixes_per_message=fixes_per_message)
+    for trip_file in trip_files:
+        progress.update(push.publish_trip_file(trip_file))
+    push._publisher.close()
+    progress.finish(push._publisher)
+
+
+def latency_percentiles(broker, bigquery, percentiles=(50, 95, 99)):
+    """Seconds from publish to insert at the given percentiles."""
+    latencies = []
+    for insert_id, (_, _, inserted) in bigquery.rows.items():
+        message_id = insert_id.rsplit('-', 1)[0]
+        if message_id in broker.publish_times:
+            latencies.append(inserted - broker.publish_times[message_id])
+    if not latencies:
+        return [float('nan')] * len(percentiles)
+    return numpy.percentile(latencies, percentiles).tolist()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fileloc", default="resources/data",
+                        help="input folder with csv files")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="Messages per pull request.")
+    parser.add_argument("--format", choices=push.MESSAGE_FORMATS,
+                        default='csv', help="Message format to publish.")
+    parser.add_argument("--fixes-per-message", type=int,
+                        default=push.DEFAULT_FIXES_PER_MESSAGE,
+                        help="Fixes packed into each binary message.")
+    parser.add_argument("--push", action="store_true",
+                        help="Deliver messages to the push endpoint.")
+    parser.add_argument("--push-concurrency", type=int, default=100,
+                        help="Push requests the fake Pub/Sub makes at once.")
+    parser.add_argument("--max-outstanding", type=int, default=1000,
+                        help="Pushed messages worked on at once; more are "
+                        "turned away.")
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="Maps API calls run at once.")
+    parser.add_argument("--insert-max-age", type=float, default=1.0,
+                        help="Seconds rows wait in the BigQuery sink at most.")
+    parser.add_argument("--pubsub-latency", type=float, default=0.01)
+    parser.add_argument("--pubsub-error-rate", type=float, default=0.0)
+    parser.add_argument("--bigquery-latency", type=float, default=0.05)
+    parser.add_argument("--bigquery-error-rate", type=float, default=0.0)
+    parser.add_argument("--bigquery-row-error-rate", type=float, default=0.0,
+                        help="Fraction of rows failing with backendError.")
+    parser.add_argument("--maps-latency", type=float, default=0.05)
+    parser.add_argument("--maps-error-rate", type=float, default=0.0)
+    parser.add_argument("--maps-max-qps", type=float, default=None,
+                        help="Answer Maps API calls beyond this many per "
+                        "second with OVER_QUERY_LIMIT.")
+    parser.add_argument("--cache", action="store_true",
+                        help="Cache Maps API results in memory.")
+    parser.add_argument("--trajectories", action="store_true",
+                        help="Reuse enrichment along vehicle trajectories.")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Skip redelivered fixes whose rows were "
+                        "written, remembered in memory.")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed for repeatable error injection.")
+    parser.add_argument("--tune-interval", type=float, default=0,
+                        help="Seconds between adjustments by geo_tuning, "
+                        "which are logged; 0 to keep the settings fixed.")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="Give up after this many seconds.")
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s",
+                        level=logging.WARNING)
+
+    broker = geo_fakes.FakePubSub(latency=args.pubsub_latency,
+                                  error_rate=args.pubsub_error_rate,
+                                  seed=args.seed)
+    bigquery = geo_fakes.FakeBigQuery(latency=args.bigquery_latency,
+                                      error_rate=args.bigquery_error_rate,
+                                      row_error_rate=args.bigquery_row_error_rate,
+                                      seed=args.seed)
+    gmaps = geo_fakes.FakeMaps(latency=args.maps_latency,
+                               error_rate=args.maps_error_rate,
+                               max_qps=args.maps_max_qps,
+                               seed=args.seed)
+
+    caches = {}
+    if args.cache:
+        for name, precision in (('geocode', 8), ('timezone', 7),
+                                ('elevation', 9)):
+            caches[name + '_cache'] = geo_cache.SpatialCache(
+                name, precision=precision)
+    trajectories = None
+    if args.trajectories:
+        trajectories = geo_trajectory.TrajectoryCache()
+    enricher = pull.Enricher(gmaps, args.concurrency, trajectories=trajectories,
+                             max_concurrency=100, **caches)
+    sink = pull.BigQueryRowSink(bigquery, max_age=args.insert_max_age)
+    seen = geo_dedup.SeenSet() if args.dedup else None
+    server = None
+    if args.push:
+        pipeline = pull.PushPipeline(enricher, sink,
+                                     batch_size=args.batch_size,
+                                     max_outstanding=args.max_outstanding,
+                                     timeout=broker.ack_deadline - 1,
+                                     row_log_every=0, seen=seen)
+        server = geo_push.serve(0, pipeline, host='127.0.0.1')
+        broker.create_push_subscription(
+            TOPIC, SUBSCRIPTION, 'http://127.0.0.1:{0}/push'.format(
+                server.server_address[1]), args.push_concurrency)
+    else:
+        broker.create_subscription(TOPIC, SUBSCRIPTION)
+        pipeline = pull.PullPipeline(
+            lambda: broker, SUBSCRIPTION,
+            {'returnImmediately': False, 'maxMessages': args.batch_size},
+            enricher, sink, geo_leases.Leases(), row_log_every=0, seen=seen)
+
+    tuner = None
+    if args.tune_interval:
+        logging.getLogger('geo_tuning').setLevel(logging.INFO)
+        tuner = geo_tuning.Tuner(pipeline, {
+            'batch_size': (10, 1000),
+            'concurrency': (4, enricher.max_concurrency),
+            'max_rows': (50, pull.MAX_INSERT_ROWS),
+            'max_age': (0.25, args.insert_max_age),
+        })
+
+    trip_files = push.find_trip_files(args.fileloc)
+    progress = push.IngestProgress(len(trip_files))
+    publisher = threading.Thread(target=publish_files, args=(
+        trip_files, broker, {'max_latency': 0.05}, progress, args.format,
+        args.fixes_per_message))
+
+    start = time.time()
+    publisher.start()
+    pipeline.start()
+    next_tuning = start + args.tune_interval
+    # Done once every published message has been acked.
+    while time.time() - start < args.timeout:
+        time.sleep(0.1)
+        if not publisher.is_alive() and not broker.backlog(SUBSCRIPTION):
+            break
+        if pipeline.failed:
+            break
+        if tuner is not None and time.time() >= next_tuning:
+            tuner.adjust()
+            next_tuning += args.tune_interval
+    elapsed = time.time() - start
+    broker.close()
+    if server is not None:
+        server.shutdown()
+    pipeline.stop()
+    pipeline.wait()
+    enricher.close()
+
+    rows = bigquery.row_count()
+    maps_calls = sum(gmaps.calls.values())
+    p50, p95, p99 = latency_percentiles(broker, bigquery)
+    print progress.report()
+    if pipeline.failed:
+        print "Pipeline stopped early: its {0} died".format(pipeline.failed)
+    print "Inserted {0} rows from {1} messages in {2:.2f}s: {3:.1f} rows/s".format(
+        rows, broker.published, elapsed, rows / elapsed)
+    print "End-to-end latency: p50 {0:.0f} ms, p95 {1:.0f} ms, p99 {2:.0f} ms".format(
+        p50 * 1000, p95 * 1000, p99 * 1000)
+    print "Maps API calls per row: {0:.3f} ({1})".format(
+        float(maps_calls) / max(rows, 1), ", ".join(
+            "{0} {1}".format(method, calls)
+            for method, calls in sorted(gmaps.calls.items())))
+    print "Pub/Sub: {0}, {1} redelivered, {2} errors injected".format(
+        ", ".join("{0} {1}".format(method, calls)
+                  for method, calls in sorted(broker.calls.items())),
+        broker.redelivered, broker.errors)
+    if args.push:
+        print "Push responses: {0}".format(", ".join(
+            "{0} {1}".format(status, count)
+            for status, count in sorted(broker.push_statuses.items())))
+    print "BigQuery: {0} insertAll requests, {1} duplicate rows, {2} errors injected".format(
+        bigquery.calls['insertAll'], bigquery.duplicates, bigquery.errors)
+    print "Maps API errors injected: {0}, throttled: {1}".format(
+        gmaps.errors, gmaps.throttled)
+    if tuner is not None:
+        print "Tuned settings: {0}".format(", ".join(
+            "{0} {1}".format(name, tuner.setting(name))
+            for name in sorted(tuner.bounds)))
+    for cache in enricher.caches():
+        print cache.report()
+    if trajectories is not None:
+        print trajectories.report()
+    if seen is not None:
+        print seen.report()
+    print geo_metrics.METRICS.summary()
+
+if __name__ == '__main__':
+    main(sys.argv)
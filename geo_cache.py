@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Two-tier cache for Maps API results, keyed by spatial cell.
+
+Vehicles on the same road keep asking for the same few addresses, so
+results are stored per cell (a geohash or a metre grid, see geo_spatial)
+rather than per exact position. Lookups go to an in-memory LRU first and
+then to a SQLite file, which keeps results across restarts. Several
+processes can share one file: each keeps its own memory tier, and a miss
+there finds what the other processes have written.
+"""
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+import geo_spatial
+
+log = logging.getLogger(__name__)
+
+# Commit the SQLite tier after this many writes rather than on every put.
+COMMIT_EVERY = 100
+
+
+class SpatialCache(object):
+    """LRU cache of JSON-serializable values keyed by spatial cell.
+
+    capacity bounds the in-memory tier. If path is given, values are also
+    written to a SQLite table called `name` in that file, and misses in
+    memory fall back to it. Writes are committed every commit_every puts;
+    use 1 when other processes share the file, so they see new values
+    straight away and never wait long for the write lock. Safe to use
+    from several threads.
+    """
+
+    def __init__(self, name, capacity=100000, path=None, precision=8,
+                 grid_metres=None, commit_every=COMMIT_EVERY):
+        self.name = name
+        self.capacity = capacity
+        self.precision = precision
+        self.grid_metres = grid_metres
+        self.commit_every = commit_every
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()
+        self._db = None
+        self._uncommitted = 0
+        if path:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._db = sqlite3.connect(path, timeout=30,
+                                       check_same_thread=False)
+            # Readers in other processes don't block on a writer, or it on them.
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS {0} '
+                '(cell TEXT PRIMARY KEY, value TEXT)'.format(name))
+            self._db.commit()
+
+    def key(self, latitude, longitude):
+        return geo_spatial.cell_key(latitude, longitude, self.precision,
+                                    self.grid_metres)
+
+    def get(self, latitude, longitude):
+        """Return the cached value for the position's cell, or None."""
+        cell = self.key(latitude, longitude)
+        with self._lock:
+            if cell in self._memory:
+                value = self._memory.pop(cell)
+                self._memory[cell] = value
+                self.hits += 1
+                return value
+            if self._db is not None:
+                try:
+                    found = self._db.execute(
+                        'SELECT value FROM {0} WHERE cell = ?'.format(
+                            self.name), (cell,)).fetchone()
+                except sqlite3.OperationalError as e:
+                    # The caller can still ask the API; a locked file
+                    # shouldn't fail the lookup.
+                    log.warning("Could not read %s cache: %s", self.name, e)
+                    found = None
+                if found is not None:
+                    value = json.loads(found[0])
+                    self._remember(cell, value)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, latitude, longitude, value):
+        """Store value for the position's cell in both tiers."""
+        cell = self.key(latitude, longitude)
+        with self._lock:
+            self._remember(cell, value)
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO {0} (cell, value) '
+                    'VALUES (?, ?)'.format(self.name),
+                    (cell, json.dumps(value)))
+                self._uncommitted += 1
+                if self._uncommitted >= self.commit_every:
+                    self._db.commit()
+                    self._uncommitted = 0
+            except sqlite3.OperationalError as e:
+                # Another process held the file for too long; the value
+                # is still cached in memory.
+                log.warning("Could not write %s cache: %s", self.name, e)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'name': self.name,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._memory),
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+    def report(self):
+        return ("{name} cache: {hits} hits ({disk_hits} from disk), {misses} "
+                "misses, {hit_rate:.1%} hit rate, {evictions} evictions, "
+                "{size} entries in memory").format(**self.stats())
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
+                self._db.close()
+                self._db = None
+
+    def _remember(self, cell, value):
+        # Caller must hold self._lock.
+        self._memory.pop(cell, None)
+        self._memory[cell] = value
+        while len(self._memory) > self.capacity:
+            self._memory.popitem(last=False)
+            self.evictions += 1
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Shared API client layer for the push and pull scripts.
+
+Application default credentials are loaded once per process, and discovery
+documents are cached in memory and on disk, so building a client doesn't
+re-read credentials or fetch the discovery document again. Each client
+gets its own httplib2.Http, which keeps its connections open between
+requests. httplib2 is not thread-safe, so thread_client() hands every
+thread its own Cloud Pub/Sub or BigQuery client, and the Maps client's
+requests session gets a connection pool sized for the threads that share
+it.
+
+Client setup times are logged so startup cost shows up in the logs.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import googlemaps
+import httplib2
+import requests
+from apiclient import discovery
+from oauth2client import client as oauth2client
+
+# Discovery documents older than this are fetched again.
+DISCOVERY_CACHE_SECONDS = 24 * 60 * 60
+DISCOVERY_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'geo_bq_discovery')
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_credentials = {}
+_documents = {}
+_local = threading.local()
+
+
+def get_credentials(scopes):
+    """Return application default credentials for scopes, loaded once."""
+    key = tuple(sorted(scopes))
+    with _lock:
+        if key not in _credentials:
+            credentials = oauth2client.GoogleCredentials.get_application_default()
+            if credentials.create_scoped_required():
+                credentials = credentials.create_scoped(list(scopes))
+            _credentials[key] = credentials
+        return _credentials[key]
+
+
+def get_discovery_document(api, version, cache_dir=DISCOVERY_CACHE_DIR):
+    """Return the discovery document for api and where it came from.
+
+    Looks in memory first, then in cache_dir, and only then fetches the
+    document and writes it to cache_dir for the next process.
+    """
+    key = (api, version)
+    with _lock:
+        if key in _documents:
+            return _documents[key], 'memory'
+
+    path = os.path.join(cache_dir, '{0}.{1}.json'.format(api, version))
+    source = 'disk'
+    try:
+        if time.time() - os.path.getmtime(path) > DISCOVERY_CACHE_SECONDS:
+            raise IOError('stale discovery document')
+        with open(path) as doc_file:
+            document = doc_file.read()
+        json.loads(document)
+    except (IOError, OSError, ValueError):
+        source = 'network'
+        uri = discovery.DISCOVERY_URI.format(api=api, apiVersion=version)
+        resp, document = httplib2.Http().request(uri)
+        if resp.status >= 400:
+            raise IOError('Could not fetch discovery document {0}: {1}'.format(
+                uri, resp.status))
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # Write then rename so other processes never read half a file.
+            tmp_path = '{0}.{1}'.format(path, os.getpid())
+            with open(tmp_path, 'w') as doc_file:
+                doc_file.write(document)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            log.warning("Could not cache discovery document: %s", e)
+
+    with _lock:
+        _documents[key] = document
+    return document, source
+
+
+def build_client(api, version, scopes, http=None):
+    """Build a new client for api with its own keep-alive connection."""
+    start = time.time()
+    credentials = get_credentials(scopes)
+    document, source = get_discovery_document(api, version)
+    if not http:
+        http = httplib2.Http()
+    http = credentials.authorize(http)
+    service = discovery.build_from_document(document, http=http)
+    log.info("Built %s %s client in %.1f ms (discovery document from %s)",
+             api, version, (time.time() - start) * 1000, source)
+    return service
+
+
+def thread_client(api, version, scopes):
+    """Return this thread's client for api, building it on first use."""
+    clients = getattr(_local, 'clients', None)
+    if clients is None:
+        clients = _local.clients = {}
+    key = (api, version)
+    if key not in clients:
+        clients[key] = build_client(api, version, scopes)
+    return clients[key]
+
+
+def create_maps_client(key, pool_size=10, **kwargs):
+    """Create a Maps client whose session keeps pool_size connections open."""
+    start = time.time()
+    gmaps = googlemaps.Client(key=key, **kwargs)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    gmaps.session.mount('https://', adapter)
+    log.info("Built Maps client in %.1f ms", (time.time() - start) * 1000)
+    return gmaps
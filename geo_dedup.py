@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Remembers which rows have been written, so redelivered messages aren't
+enriched again.
+
+Pub/Sub redelivers a message whose ack was lost or came too late, for
+example because the worker stopped after writing its rows. The pull
+worker records the insertId of every row it finishes in a SeenSet and
+skips the fixes whose insertId is already there before calling any Maps
+API. Like geo_cache, keys are kept in an in-memory LRU and in a SQLite
+file shared by the workers, since a redelivery may go to another worker,
+and are forgotten after a window of time.
+"""
+import collections
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import geo_metrics
+
+log = logging.getLogger(__name__)
+metrics = geo_metrics.METRICS
+
+metrics.describe('geo_seen_write_errors_total', 'counter',
+                 'Writes of seen keys to the SQLite file that failed.')
+metrics.describe('geo_seen_read_errors_total', 'counter',
+                 'Lookups of seen keys in the SQLite file that failed.')
+
+# SQLite allows at most 999 parameters in one statement.
+MAX_QUERY_KEYS = 500
+
+
+class SeenSet(object):
+    """Keys added within the last window seconds.
+
+    capacity bounds the in-memory tier. If path is given, keys are also
+    written to a SQLite file, committed on every add() so other processes
+    sharing it see them straight away, and keys missing from memory are
+    looked up there. Keys older than the window are deleted from the file
+    every prune_interval seconds. Safe to use from several threads.
+    """
+
+    def __init__(self, path=None, window=24 * 3600.0, capacity=100000,
+                 prune_interval=60.0, clock=time.time):
+        self.window = window
+        self.capacity = capacity
+        self.prune_interval = prune_interval
+        self.clock = clock
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.added = 0
+        self._lock = threading.Lock()
+        # key -> POSIX time it was added, oldest first.
+        self._memory = collections.OrderedDict()
+        self._db = None
+        self._next_prune = clock()
+        if path:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._db = sqlite3.connect(path, timeout=30,
+                                       check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS seen '
+                             '(key TEXT PRIMARY KEY, time REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS seen_time '
+                             'ON seen (time)')
+            self._db.commit()
+
+    def seen(self, keys):
+        """The set of keys that were added within the window."""
+        oldest = self.clock() - self.window
+        found = set()
+        with self._lock:
+            missing = []
+            for key in keys:
+                added = self._memory.get(key)
+                if added is not None and added >= oldest:
+                    found.add(key)
+                else:
+                    missing.append(key)
+            if self._db is not None and missing:
+                try:
+                    self._find_on_disk(missing, oldest, found)
+                except sqlite3.OperationalError as e:
+                    # Keys not found in memory count as new: at worst a
+                    # redelivered fix is enriched again, and its rows
+                    # keep their insertIds.
+                    metrics.inc('geo_seen_read_errors_total')
+                    log.warning("Could not read seen keys: %s", e)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def add(self, keys):
+        """Remember keys as seen now."""
+        if not keys:
+            return
+        now = self.clock()
+        with self._lock:
+            for key in keys:
+                self._remember(key, now)
+            self.added += len(keys)
+            if self._db is None:
+                return
+            try:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO seen (key, time) VALUES (?, ?)',
+                    [(key, now) for key in keys])
+                if now >= self._next_prune:
+                    self._db.execute('DELETE FROM seen WHERE time < ?',
+                                     (now - self.window,))
+                    self._next_prune = now + self.prune_interval
+                self._db.commit()
+            except sqlite3.OperationalError as e:
+                # Redeliveries to this worker are still skipped from
+                # memory; other workers won't know these rows are written.
+                metrics.inc('geo_seen_write_errors_total')
+                log.warning("Could not write seen keys: %s", e)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'added': self.added,
+                'size': len(self._memory),
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+    def report(self):
+        return ("Seen rows: {hits} already written ({disk_hits} found on "
+                "disk), {misses} new, {hit_rate:.1%} duplicates, {added} "
+                "added, {size} in memory").format(**self.stats())
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
+                self._db.close()
+                self._db = None
+
+    def _find_on_disk(self, keys, oldest, found):
+        # Caller must hold self._lock.
+        for start in range(0, len(keys), MAX_QUERY_KEYS):
+            chunk = keys[start:start + MAX_QUERY_KEYS]
+            for key, added in self._db.execute(
+                    'SELECT key, time FROM seen WHERE time >= ? AND '
+                    'key IN ({0})'.format(','.join('?' * len(chunk))),
+                    [oldest] + chunk):
+                self._remember(key, added)
+                found.add(key)
+                self.disk_hits += 1
+
+    def _remember(self, key, added):
+        # Caller must hold self._lock.
+        self._memory.pop(key, None)
+        self._memory[key] = added
+        while len(self._memory) > self.capacity:
+            self._memory.popitem(last=False)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Offline elevation lookups from local SRTM tiles.
+
+Tiles are the 1x1 degree .hgt files published by the SRTM mission (for
+example N32W118.hgt, named after their south-west corner), either SRTM1
+(3601x3601 samples) or SRTM3 (1201x1201). They are memory-mapped rather
+than read, so only the pages that are actually sampled are loaded, and a
+small LRU keeps a bounded number of them open.
+"""
+import collections
+import math
+import os
+import threading
+
+import numpy
+
+# Value of samples with no data in an .hgt file.
+HGT_VOID = -32768
+
+
+def tile_name(lat_floor, lng_floor):
+    """Name of the .hgt tile whose south-west corner is at the given degrees."""
+    return '{0}{1:02d}{2}{3:03d}.hgt'.format(
+        'N' if lat_floor >= 0 else 'S', abs(lat_floor),
+        'E' if lng_floor >= 0 else 'W', abs(lng_floor))
+
+
+class DemElevation(object):
+    """Bilinear elevation lookups over a directory of SRTM .hgt tiles.
+
+    At most max_open_tiles tiles are memory-mapped at once, which bounds
+    both open files and the address space the tiles can take up. Safe to
+    use from several threads.
+    """
+
+    def __init__(self, tile_dir, max_open_tiles=16):
+        self.tile_dir = tile_dir
+        self.max_open_tiles = max_open_tiles
+        self.tiles_opened = 0
+        self._lock = threading.Lock()
+        self._tiles = collections.OrderedDict()
+
+    def elevations(self, latitudes, longitudes):
+        """Elevations in metres for arrays of positions.
+
+        Positions with no tile, or next to a void sample, get NaN.
+        """
+        latitudes = numpy.asarray(latitudes, dtype=float)
+        longitudes = numpy.asarray(longitudes, dtype=float)
+        result = numpy.full(latitudes.shape, numpy.nan)
+        lat_floor = numpy.floor(latitudes).astype(int)
+        lng_floor = numpy.floor(longitudes).astype(int)
+        keys = numpy.column_stack([lat_floor, lng_floor])
+        for key in set(map(tuple, keys.tolist())):
+            tile = self._tile(*key)
+            if tile is None:
+                continue
+            mask = (lat_floor == key[0]) & (lng_floor == key[1])
+            result[mask] = self._interpolate(
+                tile, latitudes[mask] - key[0], longitudes[mask] - key[1])
+        return result
+
+    def _interpolate(self, tile, lat_offsets, lng_offsets):
+        # Rows run north to south and columns west to east, and the edge
+        # samples are shared with the neighbouring tiles.
+        last = tile.shape[0] - 1
+        rows = (1.0 - lat_offsets) * last
+        columns = lng_offsets * last
+        row0 = numpy.clip(numpy.floor(rows).astype(int), 0, last - 1)
+        column0 = numpy.clip(numpy.floor(columns).astype(int), 0, last - 1)
+        row_fraction = rows - row0
+        column_fraction = columns - column0
+
+        corners = numpy.array([
+            tile[row0, column0], tile[row0, column0 + 1],
+            tile[row0 + 1, column0], tile[row0 + 1, column0 + 1],
+        ]).astype(float)
+        corners[corners == HGT_VOID] = numpy.nan
+        top = corners[0] * (1 - column_fraction) + corners[1] * column_fraction
+        bottom = corners[2] * (1 - column_fraction) + corners[3] * column_fraction
+        return top * (1 - row_fraction) + bottom * row_fraction
+
+    def _tile(self, lat_floor, lng_floor):
+        key = (lat_floor, lng_floor)
+        with self._lock:
+            if key in self._tiles:
+                tile = self._tiles.pop(key)
+                self._tiles[key] = tile
+                return tile
+            path = os.path.join(self.tile_dir, tile_name(lat_floor, lng_floor))
+            if not os.path.exists(path):
+                tile = None
+            else:
+                samples = int(math.sqrt(os.path.getsize(path) // 2))
+                tile = numpy.memmap(path, dtype='>i2', mode='r',
+                                    shape=(samples, samples))
+                self.tiles_opened += 1
+            self._tiles[key] = tile
+            while len(self._tiles) > self.max_open_tiles:
+                # Dropping the last reference closes the memory map.
+                self._tiles.popitem(last=False)
+            return tile
@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+In-process stand-ins for the Cloud Pub/Sub, BigQuery and Maps clients.
+
+They answer the calls the push and pull scripts make, with the same
+request and response shapes as the real clients, so the scripts' code can
+run without any Google services, for example in geo_benchmark.py. Every
+fake can add latency to its calls and fail a fraction of them: Pub/Sub and
+BigQuery calls with a 503 HttpError (retried by execute(num_retries) like
+the real client does), Maps calls with an ApiError. Pass a seed to make
+the injected errors repeatable.
+
+FakePubSub can also push messages to an HTTP endpoint, as a push
+subscription does, and post_envelope() sends one push request by hand.
+FakeTileSource stands in for BigQuery queries of the geo_tiles server.
+"""
+import collections
+import datetime
+import hashlib
+import json
+import random
+import socket
+import threading
+import time
+import urllib2
+
+import googlemaps
+import httplib2
+import numpy
+from apiclient import errors
+
+import geo_tiles
+import geo_timezone
+
+
+class FakeRequest(object):
+    """A request whose execute() runs function after the fake's latency."""
+
+    def __init__(self, fake, method, function):
+        self.fake = fake
+        self.method = method
+        self.function = function
+
+    def execute(self, num_retries=0, http=None):
+        for attempt in range(num_retries + 1):
+            self.fake.count(self.method)
+            self.fake.delay(self.method)
+            if not self.fake.fails():
+                return self.function()
+        raise errors.HttpError(httplib2.Response({'status': 503}),
+                               '{"error": "injected backend error"}')
+
+
+class Fake(object):
+    """Latency, error injection and call counts shared by the fakes.
+
+    latency is the mean seconds a call takes; latencies overrides it per
+    method. Actual delays vary uniformly between half and one and a half
+    times the mean. error_rate is the fraction of calls that fail.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, latencies=None, seed=None):
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.error_rate = error_rate
+        self.calls = collections.Counter()
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def count(self, method, calls=1):
+        with self._lock:
+            self.calls[method] += calls
+
+    def delay(self, method):
+        latency = self.latencies.get(method, self.latency)
+        if latency:
+            with self._lock:
+                factor = 0.5 + self._random.random()
+            time.sleep(latency * factor)
+
+    def fails(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+            self.errors += failed
+        return failed
+
+
+class FakeSubscription(object):
+
+    def __init__(self, ack_deadline):
+        self.ack_deadline = ack_deadline
+        self.ready = collections.deque()
+        # ack ID -> (message, time its ack deadline expires)
+        self.outstanding = {}
+        self.deliveries = collections.Counter()
+        self.acked = set()
+
+
+def post_envelope(endpoint, message, subscription, timeout=60):
+    """POST message to endpoint in a push envelope, like Pub/Sub does.
+
+    Returns the HTTP status of the response, or None if the request
+    couldn't be made.
+    """
+    request = urllib2.Request(endpoint, json.dumps({
+        'message': message, 'subscription': subscription}),
+        {'Content-Type': 'application/json'})
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+        response.read()
+        return response.getcode()
+    except urllib2.HTTPError as e:
+        return e.code
+    except (urllib2.URLError, socket.error):
+        return None
+
+
+class FakePubSub(Fake):
+    """Topics and subscriptions held in memory, used like a v1 client.
+
+    Messages published to a topic go to every subscription created for
+    it. Pulled messages that aren't acked within the ack deadline, or that
+    get a zero deadline from modifyAckDeadline, are delivered again. A pull
+    with returnImmediately false waits up to pull_wait seconds for messages.
+
+    A push subscription instead POSTs its messages to an endpoint, with
+    up to max_outstanding requests at once. A success status acks the
+    message; after any other, it is delivered again and that sender waits
+    before its next request, twice as long after each failure in a row.
+    """
+
+    def __init__(self, ack_deadline=10, pull_wait=0.5, **kwargs):
+        super(FakePubSub, self).__init__(**kwargs)
+        self.ack_deadline = ack_deadline
+        self.pull_wait = pull_wait
+        self.published = 0
+        self.redelivered = 0
+        # messageId -> POSIX time it was published
+        self.publish_times = {}
+        # HTTP status (None if the request failed) -> push requests
+        self.push_statuses = collections.Counter()
+        self._topics = collections.defaultdict(list)
+        self._subscriptions = {}
+        self._changed = threading.Condition(threading.Lock())
+        self._closed = False
+
+    def create_subscription(self, topic, subscription):
+        with self._changed:
+            self._topics[topic].append(subscription)
+            self._subscriptions[subscription] = FakeSubscription(
+                self.ack_deadline)
+
+    def create_push_subscription(self, topic, subscription, endpoint,
+                                 max_outstanding=100, max_backoff=1.0):
+        self.create_subscription(topic, subscription)
+        for _ in range(max_outstanding):
+            sender = threading.Thread(
+                target=self._push_loop,
+                args=(subscription, endpoint, max_backoff))
+            sender.daemon = True
+            sender.start()
+
+    def close(self):
+        """Stop pushing messages."""
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+
+    # The resource chain of the discovery client:
+    # client.projects().topics().publish(...).execute()
+    def projects(self):
+        return self
+
+    def topics(self):
+        return self
+
+    def subscriptions(self):
+        return self
+
+    def publish(self, topic, body):
+        def publish():
+            message_ids = []
+            now = time.time()
+            with self._changed:
+                for payload in body['messages']:
+                    self.published += 1
+                    message_id = str(self.published)
+                    message = {
+                        'data': payload['data'],
+                        'attributes': payload.get('attributes', {}),
+                        'messageId': message_id,
+                        'publishTime': datetime.datetime.utcfromtimestamp(
+                            now).isoformat() + 'Z',
+                    }
+                    self.publish_times[message_id] = now
+                    for name in self._topics[topic]:
+                        self._subscriptions[name].ready.append(message)
+                    message_ids.append(message_id)
+                self._changed.notify_all()
+            return {'messageIds': message_ids}
+        return FakeRequest(self, 'publish', publish)
+
+    def pull(self, subscription, body):
+        def pull():
+            end = time.time() + (0 if body.get('returnImmediately')
+                                 else self.pull_wait)
+            with self._changed:
+                sub = self._subscriptions[subscription]
+                while True:
+                    self._expire(sub)
+                    if sub.ready or time.time() >= end:
+                        break
+                    self._changed.wait(min(end - time.time(), 0.1))
+                received = []
+                while sub.ready and len(received) < body['maxMessages']:
+                    message = sub.ready.popleft()
+                    sub.deliveries[message['messageId']] += 1
+                    ack_id = '{0}-{1}'.format(
+                        message['messageId'],
+                        sub.deliveries[message['messageId']])
+                    sub.outstanding[ack_id] = (
+                        message, time.time() + sub.ack_deadline)
+                    received.append({'ackId': ack_id, 'message': message})
+            return {'receivedMessages': received} if received else {}
+        return FakeRequest(self, 'pull', pull)
+
+    def acknowledge(self, subscription, body):
+        def acknowledge():
+            with self._changed:
+                sub = self._subscriptions[subscription]
+                for ack_id in body['ackIds']:
+                    lease = sub.outstanding.pop(ack_id, None)
+                    if lease is not None:
+                        sub.acked.add(lease[0]['messageId'])
+            return {}
+        return FakeRequest(self, 'acknowledge', acknowledge)
+
+    def modifyAckDeadline(self, subscription, body):
+        def modify():
+            with self._changed:
+                sub = self._subscriptions[subscription]
+                for ack_id in body['ackIds']:
+                    lease = sub.outstanding.get(ack_id)
+                    if lease is not None:
+                        sub.outstanding[ack_id] = (
+                            lease[0], time.time() + body['ackDeadlineSeconds'])
+                self._expire(sub)
+                self._changed.notify_all()
+            return {}
+        return FakeRequest(self, 'modifyAckDeadline', modify)
+
+    def backlog(self, subscription):
+        """Messages not yet acked, delivered or not."""
+        with self._changed:
+            sub = self._subscriptions[subscription]
+            return len(sub.ready) + len(sub.outstanding)
+
+    def _push_loop(self, subscription, endpoint, max_backoff):
+        backoff = 0.0
+        while True:
+            with self._changed:
+                sub = self._subscriptions[subscription]
+                while not self._closed:
+                    self._expire(sub)
+                    if sub.ready:
+                        break
+                    self._changed.wait(0.1)
+                if self._closed:
+                    return
+                message = sub.ready.popleft()
+                sub.deliveries[message['messageId']] += 1
+                ack_id = '{0}-{1}'.format(
+                    message['messageId'], sub.deliveries[message['messageId']])
+                sub.outstanding[ack_id] = (message,
+                                           time.time() + sub.ack_deadline)
+
+            status = post_envelope(endpoint, message, subscription,
+                                   timeout=sub.ack_deadline)
+            with self._changed:
+                self.push_statuses[status] += 1
+                lease = sub.outstanding.pop(ack_id, None)
+                if status is not None and 200 <= status < 300:
+                    sub.acked.add(message['messageId'])
+                elif lease is not None:
+                    sub.ready.append(message)
+                    self.redelivered += 1
+                    self._changed.notify_all()
+            if status is not None and 200 <= status < 300:
+                backoff = 0.0
+            else:
+                backoff = min(max(backoff * 2, 0.01), max_backoff)
+                time.sleep(backoff)
+
+    def _expire(self, sub):
+        # Caller must hold self._changed.
+        now = time.time()
+        for ack_id, (message, deadline) in sub.outstanding.items():
+            if deadline <= now:
+                del sub.outstanding[ack_id]
+                if message['messageId'] not in sub.acked:
+                    sub.ready.append(message)
+                    self.redelivered += 1
+
+
+class FakeBigQuery(Fake):
+    """Keeps rows streamed with tabledata().insertAll() in memory.
+
+    Besides failing whole requests, a fraction row_error_rate of rows is
+    reported in insertErrors with reason backendError, which makes the
+    rest of that request's rows fail with reason stopped, as BigQuery does.
+    Rows are deduplicated on insertId.
+    """
+
+    def __init__(self, row_error_rate=0.0, **kwargs):
+        super(FakeBigQuery, self).__init__(**kwargs)
+        self.row_error_rate = row_error_rate
+        self.duplicates = 0
+        # insertId -> (table, row, POSIX time it was first inserted)
+        self.rows = collections.OrderedDict()
+
+    def tabledata(self):
+        return self
+
+    def insertAll(self, projectId, datasetId, tableId, body):
+        table = '{0}:{1}.{2}'.format(projectId, datasetId, tableId)
+
+        def insert_all():
+            rows = body['rows']
+            with self._lock:
+                failed = [index for index in range(len(rows))
+                          if self.row_error_rate and
+                          self._random.random() < self.row_error_rate]
+            if failed:
+                failed = set(failed)
+                return {'insertErrors': [
+                    {'index': index, 'errors': [{
+                        'reason': 'backendError' if index in failed
+                        else 'stopped'}]}
+                    for index in range(len(rows))]}
+            now = time.time()
+            with self._lock:
+                for row in rows:
+                    if row['insertId'] in self.rows:
+                        self.duplicates += 1
+                    else:
+                        self.rows[row['insertId']] = (table, row['json'], now)
+            return {}
+        return FakeRequest(self, 'insertAll', insert_all)
+
+    def row_count(self):
+        with self._lock:
+            return len(self.rows)
+
+
+class FakeMaps(Fake):
+    """Answers the Geocoding, Elevation and Time Zone calls of a
+    googlemaps.Client with made-up but consistent results.
+
+    Addresses and elevations are derived from the position, and every
+    position is in America/Los_Angeles. Besides failing calls with
+    UNKNOWN_ERROR, calls beyond max_qps in any second are turned away with
+    OVER_QUERY_LIMIT, like the real APIs do.
+    """
+
+    def __init__(self, max_qps=None, **kwargs):
+        super(FakeMaps, self).__init__(**kwargs)
+        self.max_qps = max_qps
+        self.throttled = 0
+        # POSIX times of the calls answered in the last second.
+        self._answered = collections.deque()
+
+    def reverse_geocode(self, latlng):
+        self._call('reverse_geocode')
+        latitude, longitude = latlng
+        digest = hashlib.md5('{0:.4f},{1:.4f}'.format(
+            latitude, longitude)).hexdigest()
+        return [{
+            'formatted_address': '{0} Fake St, San Diego, CA 92{1:03d}, USA'.format(
+                int(digest[:4], 16) % 9999 + 1, int(digest[4:8], 16) % 200),
+            'address_components': [{
+                'types': ['postal_code'],
+                'long_name': '92{0:03d}'.format(int(digest[4:8], 16) % 200),
+            }],
+        }]
+
+    def elevation(self, locations):
+        self._call('elevation')
+        if isinstance(locations, tuple):
+            locations = [locations]
+        return [{
+            'elevation': 100.0 + 50.0 * (latitude - int(latitude)),
+            'location': {'lat': latitude, 'lng': longitude},
+            'resolution': 9.5,
+        } for latitude, longitude in locations]
+
+    def timezone(self, location, timestamp=None):
+        self._call('timezone')
+        return geo_timezone.timezone_response('America/Los_Angeles',
+                                              timestamp or time.time())
+
+    def _call(self, method):
+        self.count(method)
+        self.delay(method)
+        if self.max_qps:
+            now = time.time()
+            with self._lock:
+                while self._answered and self._answered[0] <= now - 1.0:
+                    self._answered.popleft()
+                throttled = len(self._answered) >= self.max_qps
+                if throttled:
+                    self.throttled += 1
+                else:
+                    self._answered.append(now)
+            if throttled:
+                raise googlemaps.exceptions.ApiError('OVER_QUERY_LIMIT',
+                                                     'over max_qps')
+        if self.fails():
+            raise googlemaps.exceptions.ApiError('UNKNOWN_ERROR',
+                                                 'injected error')
+
+
+class FakeTileSource(Fake):
+    """A geo_tiles source of points kept in memory, or of the rows of a
+    FakeBigQuery, so what the pull worker streams shows up on the map.
+
+    The cursor is the number of rows. Each tile() call counts as a query,
+    with the fake's latency, failing with a 503 HttpError like BigQuery.
+    """
+
+    def __init__(self, bigquery=None, **kwargs):
+        super(FakeTileSource, self).__init__(**kwargs)
+        self.bigquery = bigquery
+        self._latitudes = []
+        self._longitudes = []
+
+    def add(self, latitudes, longitudes):
+        with self._lock:
+            self._latitudes.extend(latitudes)
+            self._longitudes.extend(longitudes)
+
+    def points(self, start=0, end=None):
+        """Latitude and longitude arrays of rows start to end."""
+        if self.bigquery is not None:
+            with self.bigquery._lock:
+                rows = [row for _, row, _ in self.bigquery.rows.values()]
+            rows = rows[start:end]
+            return (numpy.array([row['Latitude'] for row in rows], dtype=float),
+                    numpy.array([row['Longitude'] for row in rows],
+                                dtype=float))
+        with self._lock:
+            return (numpy.array(self._latitudes[start:end], dtype=float),
+                    numpy.array(self._longitudes[start:end], dtype=float))
+
+    def cursor(self):
+        return len(self.points()[0])
+
+    def tile(self, zoom, x, y, bins, bin_samples, until):
+        self._call('tile')
+        tile = geo_tiles.Tile(zoom, x, y, bins, bin_samples)
+        latitudes, longitudes = self.points(0, until)
+        south, west, north, east = tile.bounds
+        inside = ((latitudes >= south) & (latitudes < north) &
+                  (longitudes >= west) & (longitudes < east))
+        tile.add_points(latitudes[inside], longitudes[inside])
+        return tile
+
+    def changes(self, since):
+        self._call('changes')
+        latitudes, longitudes = self.points(since)
+        return latitudes, longitudes, since + len(latitudes)
+
+    def _call(self, method):
+        self.count(method)
+        self.delay(method)
+        if self.fails():
+            raise errors.HttpError(httplib2.Response({'status': 503}),
+                                   '{"error": "injected backend error"}')
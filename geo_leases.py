@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Flow control and ack deadline tracking for pulled Pub/Sub messages.
+
+Every message a worker has pulled but not yet acked or nacked holds a
+lease. Leases cap how many messages and bytes are outstanding, so a worker
+stops pulling when its pipeline is full, and record when each message's
+ack deadline runs out so it can be extended before Pub/Sub redelivers the
+message to someone else.
+"""
+import threading
+import time
+
+
+class Leases(object):
+    """Outstanding messages of one subscriber, keyed by ack ID.
+
+    ack_deadline is the subscription's ack deadline, which applies to
+    freshly pulled messages. Extensions push a deadline lease_seconds out.
+    A message is given up on (its lease dropped without acking, so Pub/Sub
+    redelivers it) once it has been held for max_lease seconds.
+    """
+
+    def __init__(self, max_messages=1000, max_bytes=100 * 1000 * 1000,
+                 ack_deadline=10, lease_seconds=60, max_lease=600):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.ack_deadline = ack_deadline
+        self.lease_seconds = lease_seconds
+        self.max_lease = max_lease
+        self.dropped = 0
+        self._bytes = 0
+        # ack ID -> [size, time pulled, time its ack deadline expires]
+        self._leases = {}
+        self._changed = threading.Condition(threading.Lock())
+
+    def __len__(self):
+        with self._changed:
+            return len(self._leases)
+
+    def add(self, ack_id, size):
+        now = time.time()
+        with self._changed:
+            if ack_id not in self._leases:
+                self._bytes += size
+            self._leases[ack_id] = [size, now, now + self.ack_deadline]
+
+    def remove(self, ack_ids):
+        """Release the leases of messages that were acked or nacked."""
+        with self._changed:
+            for ack_id in ack_ids:
+                lease = self._leases.pop(ack_id, None)
+                if lease is not None:
+                    self._bytes -= lease[0]
+            self._changed.notify_all()
+
+    def room(self):
+        """How many more messages may be pulled, or 0 if bytes are full."""
+        with self._changed:
+            return self._room()
+
+    def wait_for_room(self, timeout):
+        """Wait up to timeout seconds for room to pull; return the room."""
+        end = time.time() + timeout
+        with self._changed:
+            while not self._room():
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+            return self._room()
+
+    def expiring(self, margin):
+        """Ack IDs whose deadline runs out within margin seconds.
+
+        Their deadlines are assumed extended by lease_seconds; call
+        modifyAckDeadline for them. Messages held longer than max_lease
+        are dropped instead and not returned.
+        """
+        now = time.time()
+        extend = []
+        with self._changed:
+            for ack_id, lease in self._leases.items():
+                if lease[2] - now > margin:
+                    continue
+                if now - lease[1] >= self.max_lease:
+                    self._bytes -= lease[0]
+                    del self._leases[ack_id]
+                    self.dropped += 1
+                    continue
+                lease[2] = now + self.lease_seconds
+                extend.append(ack_id)
+            self._changed.notify_all()
+        return extend
+
+    def _room(self):
+        if self._bytes >= self.max_bytes:
+            return 0
+        return max(self.max_messages - len(self._leases), 0)
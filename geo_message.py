@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compact binary encoding of many GPS fixes in one Pub/Sub message.
+
+A message starts with a header (magic, version, number of vehicles and of
+fixes), then the vehicle IDs, each a length byte followed by the ID, then
+one fixed-width little-endian record per fix (RECORD) that refers to its
+vehicle by position in that list. Records decode as a NumPy view on the
+message data, without copying or parsing text.
+
+Messages in this format carry the attribute FORMAT_ATTRIBUTE set to
+BINARY_FORMAT; messages without it are the original one-fix CSV strings.
+"""
+import struct
+
+import numpy
+
+FORMAT_ATTRIBUTE = 'format'
+BINARY_FORMAT = 'fixes'
+
+MAGIC = 'GFX'
+VERSION = 1
+# Magic, version, number of vehicle IDs, number of fixes.
+HEADER = struct.Struct('<3sBHI')
+MAX_VEHICLE_ID_BYTES = 255
+
+# One fix; epoch is POSIX seconds (UTC), speed and bearing NaN if unknown.
+RECORD = numpy.dtype([
+    ('vehicle', '<u2'),
+    ('epoch', '<f8'),
+    ('latitude', '<f8'),
+    ('longitude', '<f8'),
+    ('speed', '<f8'),
+    ('bearing', '<f8'),
+])
+FIELDS = RECORD.names[1:]
+
+
+class MessageError(ValueError):
+    """The message data is not a valid binary fixes message."""
+
+
+def is_binary(attributes):
+    return (attributes or {}).get(FORMAT_ATTRIBUTE) == BINARY_FORMAT
+
+
+def encode(vehicle_ids, columns):
+    """Pack fixes into one message.
+
+    vehicle_ids has the vehicle ID of each fix, and columns an array or
+    list of values for each of FIELDS, like the arrays read_trip_file
+    returns in config_geo_pubsub_push.
+    """
+    vehicles, inverse = numpy.unique(numpy.asarray(vehicle_ids, dtype=str),
+                                     return_inverse=True)
+    if len(vehicles) > numpy.iinfo('<u2').max:
+        raise ValueError("Too many vehicles for one message")
+    records = numpy.empty(len(inverse), dtype=RECORD)
+    records['vehicle'] = inverse
+    for field in FIELDS:
+        records[field] = columns[field]
+
+    parts = [HEADER.pack(MAGIC, VERSION, len(vehicles), len(records))]
+    for vehicle in vehicles:
+        if len(vehicle) > MAX_VEHICLE_ID_BYTES:
+            raise ValueError("Vehicle ID too long: %r" % vehicle)
+        parts.append(chr(len(vehicle)) + vehicle)
+    parts.append(records.tostring())
+    return ''.join(parts)
+
+
+def decode(data):
+    """Unpack a message into its vehicle IDs and a RECORD array.
+
+    The array is a read-only view on data; look up each record's vehicle
+    ID with vehicle_ids[record['vehicle']].
+    """
+    view = memoryview(data)
+    if len(view) < HEADER.size:
+        raise MessageError("Message shorter than its header")
+    magic, version, vehicle_count, fix_count = HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise MessageError("Not a binary fixes message")
+    if version != VERSION:
+        raise MessageError("Unsupported message version %d" % version)
+
+    offset = HEADER.size
+    vehicle_ids = []
+    for _ in range(vehicle_count):
+        if offset >= len(view):
+            raise MessageError("Message truncated in its vehicle IDs")
+        length = ord(view[offset])
+        vehicle_ids.append(view[offset + 1:offset + 1 + length].tobytes())
+        offset += 1 + length
+
+    if len(view) - offset != fix_count * RECORD.itemsize:
+        raise MessageError("Expected {0} records of {1} bytes, got {2} "
+                           "bytes".format(fix_count, RECORD.itemsize,
+                                          len(view) - offset))
+    records = numpy.frombuffer(data, dtype=RECORD, count=fix_count,
+                               offset=offset)
+    if fix_count and records['vehicle'].max() >= vehicle_count:
+        raise MessageError("Record refers to an unknown vehicle")
+    return vehicle_ids, records
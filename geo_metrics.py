@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Counters, gauges and timing histograms for the pull worker.
+
+Metrics are kept in a Registry, by name and labels, and can be read in two
+ways: as the Prometheus text format from a small HTTP server (serve()),
+for scraping or a quick curl, and as a one-line summary of what happened
+since the last summary, for the logs. METRICS is the registry the scripts
+record to.
+"""
+import BaseHTTPServer
+import SocketServer
+import bisect
+import contextlib
+import threading
+import time
+
+# Upper bounds in seconds of the histogram buckets, from 1 ms to 30 s.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0)
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs) + '}'
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+class Registry(object):
+    """Named metrics, each with any number of label combinations.
+
+    Counters and histograms are updated as things happen; gauges are
+    functions called whenever the metrics are read, so they always show
+    current values such as queue depths. Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (type, help)
+        self._descriptions = {}
+        # name -> {label key: value, Histogram or function}
+        self._metrics = {}
+        self._last_summary = ({}, time.time())
+
+    def describe(self, name, metric_type, help_text):
+        with self._lock:
+            self._descriptions[name] = (metric_type, help_text)
+            self._metrics.setdefault(name, {})
+
+    def inc(self, name, value=1, **labels):
+        key = label_key(labels)
+        with self._lock:
+            series = self._metrics.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = label_key(labels)
+        with self._lock:
+            series = self._metrics.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observe how long the with block takes, even if it raises."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def gauge(self, name, function, **labels):
+        """Report function() as the gauge's value from now on."""
+        with self._lock:
+            self._metrics.setdefault(name, {})[label_key(labels)] = function
+
+    def values(self):
+        """Current value of every counter and gauge, and histograms as
+        (count, sum, max), keyed by (name, label key)."""
+        with self._lock:
+            snapshot = [(name, key, value)
+                        for name, series in self._metrics.items()
+                        for key, value in series.items()]
+        values = {}
+        for name, key, value in snapshot:
+            if callable(value):
+                try:
+                    value = value()
+                except Exception:
+                    continue
+            elif isinstance(value, Histogram):
+                value = (value.count, value.sum, value.max)
+            values[(name, key)] = value
+        return values
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            names = sorted(self._metrics)
+            descriptions = dict(self._descriptions)
+            series = dict((name, dict(self._metrics[name])) for name in names)
+        for name in names:
+            metric_type, help_text = descriptions.get(name, ('untyped', ''))
+            if help_text:
+                lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} {1}'.format(name, metric_type))
+            for key, value in sorted(series[name].items()):
+                if isinstance(value, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + ('+Inf',), value.counts):
+                        cumulative += count
+                        lines.append('{0}_bucket{1} {2}'.format(
+                            name, format_labels(key, [('le', bound)]),
+                            cumulative))
+                    lines.append('{0}_sum{1} {2}'.format(
+                        name, format_labels(key), value.sum))
+                    lines.append('{0}_count{1} {2}'.format(
+                        name, format_labels(key), value.count))
+                    continue
+                if callable(value):
+                    try:
+                        value = value()
+                    except Exception:
+                        continue
+                lines.append('{0}{1} {2}'.format(name, format_labels(key),
+                                                  value))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """One line describing activity since the previous summary.
+
+        Histograms show calls and mean milliseconds in the interval,
+        counters their increase, gauges their current value.
+        """
+        values = self.values()
+        with self._lock:
+            last, last_time = self._last_summary
+            self._last_summary = (values, time.time())
+            types = dict((name, description[0]) for name, description
+                         in self._descriptions.items())
+        parts = []
+        for (name, key), value in sorted(values.items()):
+            label = name + format_labels(key)
+            previous = last.get((name, key))
+            if isinstance(value, tuple):
+                count = value[0] - (previous[0] if previous else 0)
+                if count:
+                    total = value[1] - (previous[1] if previous else 0)
+                    parts.append('{0} {1}x{2:.1f}ms'.format(
+                        label, count, total * 1000 / count))
+            elif types.get(name) == 'counter':
+                increase = value - (previous or 0)
+                if increase:
+                    parts.append('{0} +{1:g}'.format(label, increase))
+            else:
+                parts.append('{0} {1:g}'.format(label, value))
+        return 'Metrics over {0:.0f}s: {1}'.format(
+            time.time() - last_time, ', '.join(parts) or 'no activity')
+
+
+METRICS = Registry()
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would drown out the worker's own log lines.
+        pass
+
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(port, registry=METRICS, host='127.0.0.1'):
+    """Serve registry at http://host:port/metrics from a daemon thread."""
+    server = MetricsServer((host, port), MetricsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Offline reverse lookups of postal codes and nearest addresses.
+
+Postal codes come from a GeoJSON file of postal code polygons, such as the
+US Census ZIP Code Tabulation Areas converted to GeoJSON, looked up with
+geo_spatial.PolygonIndex. Addresses come from a CSV of address points in
+the OpenAddresses layout (LON, LAT, NUMBER, STREET, CITY, REGION,
+POSTCODE columns), indexed in a KD-tree so the nearest address for a whole
+batch of points is found in one query.
+"""
+import csv
+
+import numpy
+from scipy import spatial
+
+import geo_spatial
+
+# Columns of an OpenAddresses CSV used to build the formatted address.
+STREET_COLUMNS = ('NUMBER', 'STREET', 'UNIT')
+
+
+def to_unit_vectors(latitudes, longitudes):
+    """Positions as points on the unit sphere, so KD-tree distances are
+    chord lengths, which match great-circle distances at street scale."""
+    phi = numpy.radians(numpy.asarray(latitudes, dtype=float))
+    lam = numpy.radians(numpy.asarray(longitudes, dtype=float))
+    return numpy.column_stack([numpy.cos(phi) * numpy.cos(lam),
+                               numpy.cos(phi) * numpy.sin(lam),
+                               numpy.sin(phi)])
+
+
+def format_address(record):
+    """Format an OpenAddresses row like "12 Main St, Oceanside, CA 92058"."""
+    street = ' '.join(record[column].strip() for column in STREET_COLUMNS
+                      if record.get(column, '').strip())
+    region = ' '.join(record[column].strip() for column in ('REGION', 'POSTCODE')
+                      if record.get(column, '').strip())
+    return ', '.join(part for part in (street, record.get('CITY', '').strip(),
+                                       region) if part)
+
+
+class OfflineGeocoder(object):
+    """Fills Zipcode and, optionally, Address from local files.
+
+    postal_codes is a GeoJSON file whose features carry the code in
+    postal_property. addresses, if given, is an OpenAddresses style CSV;
+    the nearest address within max_distance metres of a point is used.
+    bounds (min_lat, min_lng, max_lat, max_lng) limits what is loaded.
+    """
+
+    def __init__(self, postal_codes, postal_property='ZCTA5CE10',
+                 addresses=None, max_distance=50.0, bounds=None):
+        self.postal_index = geo_spatial.load_polygon_index(
+            postal_codes, postal_property, bounds=bounds, cell_degrees=0.1)
+        self.max_distance = max_distance
+        self.address_tree = None
+        self.addresses = []
+        if addresses:
+            self._load_addresses(addresses, bounds)
+
+    def _load_addresses(self, path, bounds):
+        latitudes, longitudes = [], []
+        with open(path) as address_file:
+            for record in csv.DictReader(address_file):
+                try:
+                    latitude = float(record['LAT'])
+                    longitude = float(record['LON'])
+                except (KeyError, ValueError):
+                    continue
+                if bounds is not None and not (
+                        bounds[0] <= latitude <= bounds[2] and
+                        bounds[1] <= longitude <= bounds[3]):
+                    continue
+                latitudes.append(latitude)
+                longitudes.append(longitude)
+                self.addresses.append(format_address(record))
+        if self.addresses:
+            self.address_tree = spatial.cKDTree(
+                to_unit_vectors(latitudes, longitudes))
+
+    def lookup(self, latitudes, longitudes):
+        """Return (postal code, address) for each point.
+
+        Either part is None when no polygon contains the point or no
+        address is close enough.
+        """
+        zipcodes = self.postal_index.lookup_many(latitudes, longitudes)
+        addresses = [None] * len(zipcodes)
+        if self.address_tree is not None and len(zipcodes):
+            distances, nearest = self.address_tree.query(
+                to_unit_vectors(latitudes, longitudes),
+                distance_upper_bound=(self.max_distance /
+                                      geo_spatial.EARTH_RADIUS_METRES))
+            for index, found in enumerate(nearest.tolist()):
+                if found < len(self.addresses):
+                    addresses[index] = self.addresses[found]
+        return zip(zipcodes, addresses)
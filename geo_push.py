@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+HTTP endpoint for Cloud Pub/Sub push subscriptions.
+
+Pub/Sub POSTs each message of a push subscription to the endpoint as a
+JSON envelope, {"message": {...}, "subscription": "..."}, and treats a
+success status as an ack and anything else as a nack, delivering the
+message again later and slowing down while pushes keep failing. The
+server hands each message to a pipeline's deliver() method, which returns
+once the message is done with, and answers with the status for its
+outcome: a success only once its rows are written, and 429 or 503 to turn
+messages away when the worker is busy, so Pub/Sub backs off.
+
+Requests are served on a thread each, like the metrics server in
+geo_metrics.
+"""
+import BaseHTTPServer
+import SocketServer
+import json
+import logging
+import socket
+import sys
+import threading
+import urlparse
+
+log = logging.getLogger('geo_push')
+
+# HTTP status answered for each outcome of PushPipeline.deliver().
+STATUS = {
+    'ok': 204,
+    'failed': 500,
+    'busy': 429,
+    'timeout': 503,
+    'stopping': 503,
+}
+# Largest request body read; Pub/Sub messages are at most 10MB, and grow
+# by a third in base64.
+MAX_BODY_BYTES = 14 * 1000 * 1000
+
+
+class PushHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != self.server.path:
+            self.send_error(404)
+            return
+        if self.server.token is not None and urlparse.parse_qs(
+                url.query).get('token') != [self.server.token]:
+            self.send_error(403)
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_BYTES:
+            self.send_error(413)
+            return
+        try:
+            envelope = json.loads(self.rfile.read(length))
+            message = envelope['message']
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400, "Expected a Pub/Sub push envelope")
+            return
+        outcome = self.server.pipeline.deliver({'message': message})
+        self.send_response(STATUS[outcome])
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # Every push is a request; the pipeline's metrics count them.
+        pass
+
+
+class PushServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # Pub/Sub opens many connections at once when it pushes fast.
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], socket.error):
+            # The client gave up waiting; it will push the message again.
+            log.debug("Push from %s disconnected", client_address[0])
+        else:
+            log.exception("Push from %s failed", client_address[0])
+
+
+def serve(port, pipeline, path='/push', token=None, host=''):
+    """Serve pushes to pipeline at http://host:port/path from a daemon
+    thread. With a token, only requests carrying it as the token query
+    parameter of the push endpoint URL are accepted."""
+    server = PushServer((host, port), PushHandler)
+    server.pipeline = pipeline
+    server.path = path
+    server.token = token
+    thread = threading.Thread(target=server.serve_forever, name='push')
+    thread.daemon = True
+    thread.start()
+    return server
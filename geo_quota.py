@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Rate limiting and daily quota accounting for Maps API calls.
+
+Each API gets a token bucket that refills at its queries-per-second limit,
+and a count of calls made today. Both live in a SQLite file, so they
+survive restarts and every worker process using the same file (and so
+the same API key) draws from the same buckets. Days follow Pacific time,
+which is when Maps API daily quotas reset.
+"""
+import datetime
+import sqlite3
+import threading
+import time
+
+import pytz
+
+QUOTA_TIMEZONE = pytz.timezone('America/Los_Angeles')
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def quota_day(now=None):
+    """The current quota day as YYYY-MM-DD in Pacific time."""
+    utc_now = datetime.datetime.utcfromtimestamp(now or time.time())
+    return pytz.utc.localize(utc_now).astimezone(QUOTA_TIMEZONE).strftime(
+        '%Y-%m-%d')
+
+
+class QuotaManager(object):
+    """Token buckets and daily counters for a set of APIs.
+
+    limits maps an API name to {'qps': ..., 'daily': ...}; a daily limit
+    of 0 means no daily limit. A bucket holds at most `burst` seconds'
+    worth of tokens.
+    """
+
+    def __init__(self, path, limits, burst=1.0):
+        self.limits = limits
+        self.burst = burst
+        self._lock = threading.Lock()
+        # Autocommit mode, so transactions are exactly the BEGIN IMMEDIATE
+        # blocks below; the timeout covers other processes holding the lock.
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS buckets '
+                         '(api TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS daily '
+                         '(api TEXT, day TEXT, used INTEGER, '
+                         'PRIMARY KEY (api, day))')
+
+    def try_acquire(self, api, count=1):
+        """Take count tokens for api if they are available right now."""
+        return self._update(api, count) == 0
+
+    def acquire(self, api, count=1, timeout=0):
+        """Take count tokens, waiting up to timeout seconds for them.
+
+        Raises QuotaExceeded if they don't become available in time, or
+        straight away if the daily quota would be exceeded.
+        """
+        end = time.time() + timeout
+        while True:
+            wait = self._update(api, count)
+            if wait == 0:
+                return
+            if wait is None or time.time() + wait > end:
+                raise QuotaExceeded('{0} quota exhausted'.format(api))
+            time.sleep(wait)
+
+    def headroom(self, api, within=0):
+        """Calls api could make in the next `within` seconds, counting
+        the tokens the bucket holds now and those it will refill."""
+        limit = self.limits[api]
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                tokens = self._refill(api, limit, time.time())
+                remaining = self._daily_remaining(api, limit)
+            finally:
+                self._db.execute('COMMIT')
+        return int(max(min(tokens + within * limit['qps'], remaining), 0))
+
+    def over_limit(self, api):
+        """Empty api's bucket after the API answered OVER_QUERY_LIMIT."""
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute('INSERT OR REPLACE INTO buckets '
+                                 '(api, tokens, updated) VALUES (?, 0, ?)',
+                                 (api, time.time()))
+            finally:
+                self._db.execute('COMMIT')
+
+    def usage(self):
+        """Calls made today per API."""
+        with self._lock:
+            rows = self._db.execute('SELECT api, used FROM daily WHERE day = ?',
+                                    (quota_day(),)).fetchall()
+        return dict(rows)
+
+    def report(self):
+        usage = self.usage()
+        return 'Maps API calls today: ' + ', '.join(
+            '{0} {1}{2}'.format(api, usage.get(api, 0),
+                                '/{0}'.format(limit['daily'])
+                                if limit['daily'] else '')
+            for api, limit in sorted(self.limits.items()))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _update(self, api, count):
+        # Take count tokens and return 0, or return how many seconds to
+        # wait for them, or None if today's quota can't cover them.
+        limit = self.limits[api]
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                if self._daily_remaining(api, limit) < count:
+                    return None
+                tokens = self._refill(api, limit, now)
+                if tokens < count:
+                    return (count - tokens) / float(limit['qps'])
+                self._db.execute('UPDATE buckets SET tokens = ? WHERE api = ?',
+                                 (tokens - count, api))
+                self._db.execute('INSERT OR IGNORE INTO daily (api, day, used) '
+                                 'VALUES (?, ?, 0)', (api, quota_day(now)))
+                self._db.execute('UPDATE daily SET used = used + ? '
+                                 'WHERE api = ? AND day = ?',
+                                 (count, api, quota_day(now)))
+                return 0
+            finally:
+                self._db.execute('COMMIT')
+
+    def _refill(self, api, limit, now):
+        capacity = max(limit['qps'] * self.burst, 1)
+        row = self._db.execute('SELECT tokens, updated FROM buckets '
+                               'WHERE api = ?', (api,)).fetchone()
+        if row is None:
+            tokens = capacity
+        else:
+            tokens = min(capacity, row[0] + (now - row[1]) * limit['qps'])
+        self._db.execute('INSERT OR REPLACE INTO buckets (api, tokens, updated) '
+                         'VALUES (?, ?, ?)', (api, tokens, now))
+        return tokens
+
+    def _daily_remaining(self, api, limit):
+        if not limit['daily']:
+            return float('inf')
+        row = self._db.execute('SELECT used FROM daily WHERE api = ? AND day = ?',
+                               (api, quota_day())).fetchone()
+        return limit['daily'] - (row[0] if row else 0)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Local checks of rows against a BigQuery table schema.
+
+The schema is the JSON list of fields used to create the table, such as
+resources/geocoded_journeys.json. check_row() reports what BigQuery would
+reject in a row of a load file or insertAll request: missing required
+values, unknown columns and values of the wrong type. check_file() does
+the same for every row of a newline-delimited JSON file.
+"""
+import datetime
+import json
+import numbers
+
+SCHEMA_FILE = 'resources/geocoded_journeys.json'
+TIMESTAMP_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f',
+                     '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f')
+
+
+def load_schema(path=SCHEMA_FILE):
+    with open(path) as schema_file:
+        return json.load(schema_file)
+
+
+def is_timestamp(value):
+    if isinstance(value, numbers.Number) and not isinstance(value, bool):
+        return True
+    if not isinstance(value, basestring):
+        return False
+    value = value.rstrip('Z').replace(' UTC', '')
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            datetime.datetime.strptime(value, timestamp_format)
+            return True
+        except ValueError:
+            pass
+    return False
+
+
+def is_date(value):
+    if not isinstance(value, basestring):
+        return False
+    try:
+        datetime.datetime.strptime(value, '%Y-%m-%d')
+        return True
+    except ValueError:
+        return False
+
+
+def is_integer(value):
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, numbers.Integral):
+        return True
+    return isinstance(value, basestring) and value.strip().lstrip(
+        '-').isdigit()
+
+
+def is_float(value):
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, numbers.Real):
+        # NaN and infinity can't be written as JSON numbers.
+        return value == value and abs(value) != float('inf')
+    if isinstance(value, basestring):
+        try:
+            float(value)
+            return True
+        except ValueError:
+            return False
+    return False
+
+
+TYPE_CHECKS = {
+    'integer': is_integer,
+    'float': is_float,
+    'string': lambda value: isinstance(value, basestring),
+    'boolean': lambda value: isinstance(value, bool),
+    'timestamp': is_timestamp,
+    'date': is_date,
+}
+
+
+def check_row(schema, row):
+    """A list of problems BigQuery would have with row; empty if none."""
+    problems = []
+    fields = dict((field['name'], field) for field in schema)
+    for name in sorted(set(row) - set(fields)):
+        problems.append("{0}: not in the schema".format(name))
+    for field in schema:
+        value = row.get(field['name'])
+        if value is None:
+            if field.get('mode', 'nullable').lower() == 'required':
+                problems.append("{0}: required".format(field['name']))
+            continue
+        check = TYPE_CHECKS.get(field['type'].lower())
+        if check is not None and not check(value):
+            problems.append("{0}: {1!r} is not a {2}".format(
+                field['name'], value, field['type'].lower()))
+    return problems
+
+
+def check_file(schema, path, max_problems=10):
+    """Check every row of a newline-delimited JSON file.
+
+    Returns the number of rows, the number with problems, and the first
+    max_problems problems as (line number, problem) pairs.
+    """
+    rows = 0
+    bad_rows = 0
+    problems = []
+    with open(path) as rows_file:
+        for number, line in enumerate(rows_file, 1):
+            rows += 1
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                row_problems = ["not JSON: {0}".format(e)]
+            else:
+                row_problems = check_row(schema, row)
+            bad_rows += bool(row_problems)
+            for problem in row_problems:
+                if len(problems) < max_problems:
+                    problems.append((number, problem))
+    return rows, bad_rows, problems
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Helpers for bucketing latitude/longitude into spatial cells and for
+finding which polygon contains a point.
+"""
+import collections
+import json
+import math
+
+import numpy
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+EARTH_RADIUS_METRES = 6371000.0
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS_METRES / 180.0
+
+
+def geohash(latitude, longitude, precision=8):
+    """Encode a position as a geohash string of `precision` characters."""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            bounds, coordinate = lng_range, longitude
+        else:
+            bounds, coordinate = lat_range, latitude
+        middle = (bounds[0] + bounds[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            bounds[0] = middle
+        else:
+            bounds[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+def geohash_cell_size(precision):
+    """Height and width in degrees of the geohash cells of precision."""
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def geohash_cover(south, west, north, east, precision=9, max_cells=32):
+    """The sorted geohash cells covering a rectangle.
+
+    Uses the finest precision up to `precision` that needs no more than
+    max_cells cells. Like geohashCover() in web/bqapi.html.
+    """
+    for cell_precision in range(precision, 0, -1):
+        lat_size, lng_size = geohash_cell_size(cell_precision)
+        first_row = int(math.floor(south / lat_size))
+        first_column = int(math.floor(west / lng_size))
+        rows = int(math.floor(north / lat_size)) - first_row + 1
+        columns = int(math.floor(east / lng_size)) - first_column + 1
+        if rows * columns <= max_cells or cell_precision == 1:
+            break
+    # Encode the centre of each cell.
+    return sorted(set(
+        geohash(min((first_row + row + 0.5) * lat_size, 90.0),
+                min((first_column + column + 0.5) * lng_size, 180.0),
+                cell_precision)
+        for row in range(rows) for column in range(columns)))
+
+
+def geohash_next(cell):
+    """The geohash after cell in the same precision, or None after the
+    last."""
+    end = len(cell) - 1
+    while end >= 0 and cell[end] == GEOHASH_ALPHABET[-1]:
+        end -= 1
+    if end < 0:
+        return None
+    return (cell[:end] +
+            GEOHASH_ALPHABET[GEOHASH_ALPHABET.index(cell[end]) + 1] +
+            '0' * (len(cell) - end - 1))
+
+
+def geohash_ranges(cells):
+    """(start, end) ranges of geohashes starting with one of the sorted
+    cells, end None for no end; cells that follow each other share one."""
+    ranges = []
+    for cell in cells:
+        if ranges and ranges[-1][1] == cell:
+            ranges[-1] = (ranges[-1][0], geohash_next(cell))
+        else:
+            ranges.append((cell, geohash_next(cell)))
+    return ranges
+
+
+def grid_cell(latitude, longitude, size_metres):
+    """Return the (row, column) of a roughly size_metres square grid cell.
+
+    Rows are a fixed number of degrees of latitude; the width of a column
+    in degrees of longitude grows with the latitude of its row so cells
+    stay about square.
+    """
+    lat_step = size_metres / METRES_PER_DEGREE
+    row = int(math.floor((latitude + 90.0) / lat_step))
+    row_latitude = row * lat_step - 90.0 + lat_step / 2
+    lng_step = lat_step / max(math.cos(math.radians(row_latitude)), 1e-6)
+    column = int(math.floor((longitude + 180.0) / lng_step))
+    return row, column
+
+
+def cell_key(latitude, longitude, precision=8, grid_metres=None):
+    """Key of the cell containing a position.
+
+    Uses a grid of grid_metres cells if given, otherwise a geohash.
+    """
+    if grid_metres:
+        row, column = grid_cell(latitude, longitude, grid_metres)
+        return 'g{0}:{1}:{2}'.format(grid_metres, row, column)
+    return geohash(latitude, longitude, precision)
+
+
+def distance_metres(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two positions (haversine)."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = (math.sin(d_phi / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2)
+    return 2 * EARTH_RADIUS_METRES * math.asin(min(1.0, math.sqrt(a)))
+
+
+def point_in_ring(longitude, latitude, ring):
+    """Even-odd test of a point against a closed ring of (lng, lat) rows."""
+    xs, ys = ring[:, 0], ring[:, 1]
+    next_xs, next_ys = numpy.roll(xs, -1), numpy.roll(ys, -1)
+    straddles = (ys > latitude) != (next_ys > latitude)
+    # Horizontal edges divide by zero, but they never straddle the point.
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        crossing_x = xs + (latitude - ys) * (next_xs - xs) / (next_ys - ys)
+        crosses = straddles & (longitude < crossing_x)
+    return numpy.count_nonzero(crosses) % 2 == 1
+
+
+def points_in_ring(longitudes, latitudes, ring):
+    """point_in_ring for arrays of points, testing every edge at once."""
+    xs, ys = ring[:, 0], ring[:, 1]
+    next_xs, next_ys = numpy.roll(xs, -1), numpy.roll(ys, -1)
+    lats = latitudes[:, numpy.newaxis]
+    straddles = (ys > lats) != (next_ys > lats)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        crossing_x = xs + (lats - ys) * (next_xs - xs) / (next_ys - ys)
+        crosses = straddles & (longitudes[:, numpy.newaxis] < crossing_x)
+    return crosses.sum(axis=1) % 2 == 1
+
+
+class PolygonIndex(object):
+    """Finds the polygon that contains a point.
+
+    Each polygon carries a value (a timezone ID, a postal code, ...) and
+    is registered in every cell of a cell_degrees grid that its bounding
+    box overlaps, so a lookup only tests the few polygons near the point.
+    """
+
+    def __init__(self, cell_degrees=1.0):
+        self.cell_degrees = cell_degrees
+        self._polygons = []
+        self._grid = collections.defaultdict(list)
+
+    def __len__(self):
+        return len(self._polygons)
+
+    def add(self, value, rings):
+        """Add a polygon given as GeoJSON-style rings, outer ring first."""
+        rings = [numpy.asarray(ring, dtype=float)[:, :2] for ring in rings]
+        outer = rings[0]
+        bbox = (outer[:, 0].min(), outer[:, 1].min(),
+                outer[:, 0].max(), outer[:, 1].max())
+        polygon_id = len(self._polygons)
+        self._polygons.append((value, bbox, rings))
+        for row in range(self._cell(bbox[1]), self._cell(bbox[3]) + 1):
+            for column in range(self._cell(bbox[0]), self._cell(bbox[2]) + 1):
+                self._grid[(row, column)].append(polygon_id)
+
+    def add_geometry(self, value, geometry):
+        """Add a GeoJSON Polygon or MultiPolygon geometry."""
+        if geometry['type'] == 'Polygon':
+            self.add(value, geometry['coordinates'])
+        elif geometry['type'] == 'MultiPolygon':
+            for rings in geometry['coordinates']:
+                self.add(value, rings)
+
+    def lookup(self, latitude, longitude):
+        """Return the value of the polygon containing the point, or None."""
+        cell = (self._cell(latitude), self._cell(longitude))
+        for polygon_id in self._grid.get(cell, ()):
+            value, bbox, rings = self._polygons[polygon_id]
+            if not (bbox[0] <= longitude <= bbox[2] and
+                    bbox[1] <= latitude <= bbox[3]):
+                continue
+            if not point_in_ring(longitude, latitude, rings[0]):
+                continue
+            if any(point_in_ring(longitude, latitude, hole)
+                   for hole in rings[1:]):
+                continue
+            return value
+        return None
+
+    def lookup_many(self, latitudes, longitudes):
+        """lookup() for arrays of points, testing each polygon against all
+        the points in its grid cell at once."""
+        latitudes = numpy.asarray(latitudes, dtype=float)
+        longitudes = numpy.asarray(longitudes, dtype=float)
+        values = [None] * len(latitudes)
+        rows = numpy.floor(latitudes / self.cell_degrees).astype(int)
+        columns = numpy.floor(longitudes / self.cell_degrees).astype(int)
+        for cell in set(zip(rows.tolist(), columns.tolist())):
+            remaining = numpy.nonzero((rows == cell[0]) &
+                                      (columns == cell[1]))[0]
+            for polygon_id in self._grid.get(cell, ()):
+                if not remaining.size:
+                    break
+                value, bbox, rings = self._polygons[polygon_id]
+                lats, lngs = latitudes[remaining], longitudes[remaining]
+                inside = ((bbox[0] <= lngs) & (lngs <= bbox[2]) &
+                          (bbox[1] <= lats) & (lats <= bbox[3]))
+                if not inside.any():
+                    continue
+                inside &= points_in_ring(lngs, lats, rings[0])
+                for hole in rings[1:]:
+                    inside &= ~points_in_ring(lngs, lats, hole)
+                for index in remaining[inside].tolist():
+                    values[index] = value
+                remaining = remaining[~inside]
+        return values
+
+    def _cell(self, degrees):
+        return int(math.floor(degrees / self.cell_degrees))
+
+
+def overlaps(geometry, bounds):
+    """Whether a GeoJSON polygon's bounding box overlaps bounds.
+
+    bounds is (min_lat, min_lng, max_lat, max_lng).
+    """
+    if geometry['type'] == 'Polygon':
+        polygons = [geometry['coordinates']]
+    else:
+        polygons = geometry['coordinates']
+    for rings in polygons:
+        outer = numpy.asarray(rings[0], dtype=float)
+        if (outer[:, 1].max() >= bounds[0] and outer[:, 0].max() >= bounds[1]
+                and outer[:, 1].min() <= bounds[2]
+                and outer[:, 0].min() <= bounds[3]):
+            return True
+    return False
+
+
+def load_polygon_index(path, property, bounds=None, cell_degrees=1.0):
+    """Build a PolygonIndex from a GeoJSON FeatureCollection file.
+
+    Each feature's polygons are indexed under its `property` value. With
+    bounds, only polygons overlapping that area are kept, which saves a
+    lot of memory for a fleet that covers one region.
+    """
+    with open(path) as geojson_file:
+        collection = json.load(geojson_file)
+    index = PolygonIndex(cell_degrees)
+    for feature in collection['features']:
+        geometry = feature.get('geometry')
+        if not geometry or geometry['type'] not in ('Polygon', 'MultiPolygon'):
+            continue
+        if bounds is not None and not overlaps(geometry, bounds):
+            continue
+        index.add_geometry(feature['properties'][property], geometry)
+    return index
@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Point counts of the journeys table per map tile, for the web viewer.
+
+A tile is a square of the Web Mercator map at a zoom level, as in Google
+Maps: 2**zoom by 2**zoom tiles cover the world. Each Tile holds the points
+in it aggregated into a grid of bins, each with its number of points,
+their mean position and a few sampled points, which is what a heatmap of
+the tile needs.
+
+TileService answers tiles from a TileCache, with LRU eviction and a time
+to live, and loads missing ones from a source: BigQueryTileSource, or
+geo_fakes.FakeTileSource for running without Google services. A source
+has three methods:
+
+  cursor()          the position of the newest row, as an opaque value;
+  tile(zoom, x, y, bins, bin_samples, until)
+                    the Tile of the rows up to the cursor until;
+  changes(since)    (latitudes, longitudes, cursor) of the rows after the
+                    cursor since.
+
+refresh() adds the rows inserted since the last refresh to the cached
+tiles they fall in, so new rows show up without loading the tiles again.
+serve() answers GET /tiles/ZOOM/X/Y.json over HTTP, and /metrics.
+"""
+import BaseHTTPServer
+import SocketServer
+import collections
+import json
+import logging
+import math
+import re
+import socket
+import sys
+import threading
+import time
+
+import numpy
+
+import geo_metrics
+import geo_spatial
+
+log = logging.getLogger('geo_tiles')
+metrics = geo_metrics.METRICS
+
+metrics.describe('geo_tile_requests_total', 'counter',
+                 'Tile requests by whether the cache had the tile.')
+metrics.describe('geo_tile_load_seconds', 'histogram',
+                 'Time to load a tile from its source.')
+metrics.describe('geo_tile_refresh_rows_total', 'counter',
+                 'New rows added to cached tiles by refreshes.')
+metrics.describe('geo_tile_cache_hit_ratio', 'gauge',
+                 'Hit rate of the tile cache.')
+metrics.describe('geo_tile_cache_tiles', 'gauge', 'Tiles in the cache.')
+
+# Web Mercator stops short of the poles.
+MAX_LATITUDE = 85.0511287798
+MAX_ZOOM = 21
+TILE_PATH = re.compile(r'^/tiles/(\d+)/(\d+)/(\d+)\.json$')
+
+
+def tile_xy(latitudes, longitudes, zoom):
+    """Columns and rows of the tiles at zoom containing the positions."""
+    tiles = 2 ** zoom
+    latitudes = numpy.radians(numpy.clip(
+        numpy.asarray(latitudes, dtype=float), -MAX_LATITUDE, MAX_LATITUDE))
+    x = (numpy.asarray(longitudes, dtype=float) + 180.0) / 360.0 * tiles
+    y = (1.0 - numpy.log(numpy.tan(latitudes) + 1.0 / numpy.cos(latitudes)) /
+         math.pi) / 2.0 * tiles
+    return (numpy.clip(numpy.floor(x), 0, tiles - 1).astype(int),
+            numpy.clip(numpy.floor(y), 0, tiles - 1).astype(int))
+
+
+def tile_bounds(zoom, x, y):
+    """(south, west, north, east) of a tile, in degrees."""
+    tiles = 2.0 ** zoom
+
+    def latitude(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row /
+                                                           tiles))))
+    return (latitude(y + 1), x / tiles * 360.0 - 180.0, latitude(y),
+            (x + 1) / tiles * 360.0 - 180.0)
+
+
+class Tile(object):
+    """The points in a map tile, counted in a bins x bins grid.
+
+    Bins are equal steps of latitude and longitude across the tile. Each
+    keeps its number of points, the sums of their coordinates and up to
+    bin_samples of them.
+    """
+
+    def __init__(self, zoom, x, y, bins=16, bin_samples=4):
+        self.zoom = zoom
+        self.x = x
+        self.y = y
+        self.bounds = tile_bounds(zoom, x, y)
+        self.bins = bins
+        self.bin_samples = bin_samples
+        self.count = 0
+        # (row, column) -> [count, latitude sum, longitude sum, samples]
+        self._bins = {}
+        self._body = None
+
+    def add_bin(self, row, column, count, latitude, longitude, samples):
+        """Add count points with mean position (latitude, longitude), of
+        which samples is a list of (latitude, longitude)."""
+        entry = self._bins.setdefault((row, column), [0, 0.0, 0.0, []])
+        entry[0] += count
+        entry[1] += latitude * count
+        entry[2] += longitude * count
+        entry[3].extend(samples[:self.bin_samples - len(entry[3])])
+        self.count += count
+        self._body = None
+
+    def bin_of(self, latitudes, longitudes):
+        """Rows and columns of the bins containing the positions."""
+        south, west, north, east = self.bounds
+        rows = numpy.floor((numpy.asarray(latitudes) - south) /
+                           (north - south) * self.bins)
+        columns = numpy.floor((numpy.asarray(longitudes) - west) /
+                              (east - west) * self.bins)
+        return (numpy.clip(rows, 0, self.bins - 1).astype(int),
+                numpy.clip(columns, 0, self.bins - 1).astype(int))
+
+    def add_points(self, latitudes, longitudes):
+        latitudes = numpy.asarray(latitudes, dtype=float)
+        longitudes = numpy.asarray(longitudes, dtype=float)
+        if not len(latitudes):
+            return
+        rows, columns = self.bin_of(latitudes, longitudes)
+        keys = rows * self.bins + columns
+        order = numpy.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+        ends = numpy.r_[starts[1:], len(keys)]
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            members = order[start:end]
+            bin_latitudes = latitudes[members]
+            bin_longitudes = longitudes[members]
+            self.add_bin(
+                int(keys[start] // self.bins), int(keys[start] % self.bins),
+                end - start, bin_latitudes.mean(), bin_longitudes.mean(),
+                zip(bin_latitudes[:self.bin_samples].tolist(),
+                    bin_longitudes[:self.bin_samples].tolist()))
+
+    def body(self):
+        """The tile as JSON: its bounds, number of points, each non-empty
+        bin as [latitude, longitude, count] and the sampled points."""
+        if self._body is None:
+            bins = []
+            points = []
+            for key in sorted(self._bins):
+                count, latitude_sum, longitude_sum, samples = self._bins[key]
+                bins.append([round(latitude_sum / count, 6),
+                             round(longitude_sum / count, 6), count])
+                points.extend([round(latitude, 6), round(longitude, 6)]
+                              for latitude, longitude in samples)
+            self._body = json.dumps({
+                'zoom': self.zoom, 'x': self.x, 'y': self.y,
+                'bounds': self.bounds, 'count': self.count,
+                'bins': bins, 'points': points,
+            }, separators=(',', ':'))
+        return self._body
+
+
+class TileCache(object):
+    """Tiles by (zoom, x, y), least recently used evicted past capacity.
+
+    A tile expires ttl seconds after it was loaded, so rows the refreshes
+    miss, such as backfills, show up within ttl.
+    """
+
+    def __init__(self, capacity=10000, ttl=600.0, clock=time.time):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        # (zoom, x, y) -> (Tile, time loaded)
+        self._tiles = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def get(self, key):
+        """The JSON of the cached tile for key, or None."""
+        with self._lock:
+            entry = self._tiles.pop(key, None)
+            if entry is not None and self.clock() - entry[1] > self.ttl:
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._tiles[key] = entry
+            self.hits += 1
+            return entry[0].body()
+
+    def put(self, key, tile):
+        with self._lock:
+            self._tiles.pop(key, None)
+            self._tiles[key] = (tile, self.clock())
+            while len(self._tiles) > self.capacity:
+                self._tiles.popitem(last=False)
+                self.evictions += 1
+
+    def add_points(self, latitudes, longitudes):
+        """Add new points to the cached tiles containing them; returns the
+        number of tiles changed."""
+        latitudes = numpy.asarray(latitudes, dtype=float)
+        longitudes = numpy.asarray(longitudes, dtype=float)
+        changed = 0
+        with self._lock:
+            zooms = set(key[0] for key in self._tiles)
+            for zoom in zooms:
+                xs, ys = tile_xy(latitudes, longitudes, zoom)
+                for x, y in set(zip(xs.tolist(), ys.tolist())):
+                    entry = self._tiles.get((zoom, x, y))
+                    if entry is None:
+                        continue
+                    inside = (xs == x) & (ys == y)
+                    entry[0].add_points(latitudes[inside], longitudes[inside])
+                    changed += 1
+        return changed
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'size': len(self._tiles),
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+    def report(self):
+        return ("tile cache: {hits} hits, {misses} misses ({expired} "
+                "expired), {hit_rate:.1%} hit rate, {evictions} evictions, "
+                "{size} tiles").format(**self.stats())
+
+
+class TileService(object):
+    """Tiles from a TileCache, loaded from source when missing.
+
+    Requests for a tile already being loaded wait for that load rather
+    than querying the source again.
+    """
+
+    def __init__(self, source, cache, bins=16, bin_samples=4):
+        self.source = source
+        self.cache = cache
+        self.bins = bins
+        self.bin_samples = bin_samples
+        self.cursor = source.cursor()
+        self._loading = {}
+        self._lock = threading.Lock()
+        metrics.gauge('geo_tile_cache_hit_ratio',
+                      lambda: cache.stats()['hit_rate'])
+        metrics.gauge('geo_tile_cache_tiles', lambda: len(cache))
+
+    def tile(self, zoom, x, y):
+        """The JSON of a tile and whether it came from the cache."""
+        if not 0 <= zoom <= MAX_ZOOM or not (0 <= x < 2 ** zoom and
+                                              0 <= y < 2 ** zoom):
+            raise ValueError("No tile {0}/{1}/{2}".format(zoom, x, y))
+        key = (zoom, x, y)
+        while True:
+            body = self.cache.get(key)
+            if body is not None:
+                metrics.inc('geo_tile_requests_total', result='hit')
+                return body, True
+            with self._lock:
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    cursor = self.cursor
+                    break
+            # Loaded by another request then, unless it failed or went
+            # stale.
+            loading.wait()
+
+        metrics.inc('geo_tile_requests_total', result='miss')
+        try:
+            with metrics.timer('geo_tile_load_seconds'):
+                tile = self.source.tile(zoom, x, y, self.bins,
+                                        self.bin_samples, cursor)
+            with self._lock:
+                # A refresh since the load started skipped this tile, so
+                # only cache it if there has been none.
+                if self.cursor == cursor:
+                    self.cache.put(key, tile)
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+        return tile.body(), False
+
+    def refresh(self):
+        """Add the rows inserted since the last refresh to the cached
+        tiles; returns the number of rows."""
+        latitudes, longitudes, cursor = self.source.changes(self.cursor)
+        with self._lock:
+            changed = self.cache.add_points(latitudes, longitudes)
+            self.cursor = cursor
+        if len(latitudes):
+            log.info("Added %d new rows to %d cached tiles", len(latitudes),
+                     changed)
+            metrics.inc('geo_tile_refresh_rows_total', len(latitudes))
+        return len(latitudes)
+
+    def refresh_every(self, interval, stop):
+        """Refresh every interval seconds until the stop Event is set."""
+        while not stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception:
+                log.exception("Refreshing the tiles failed")
+
+
+class BigQueryTileSource(object):
+    """Tiles aggregated by BigQuery queries of the journeys table.
+
+    Tile queries filter on the geohash cells covering the tile, so a
+    table clustered on Geohash only reads the blocks around it. The
+    cursor is the newest UTCTime, in microseconds, so refreshes pick up
+    live rows; rows inserted with older times wait for the tile's TTL.
+    """
+
+    def __init__(self, bigquery, project, dataset, table, timeout=60.0,
+                 geohash_precision=9, max_cells=32):
+        self.bigquery = bigquery
+        self.project = project
+        self.table = '`{0}.{1}.{2}`'.format(project, dataset, table)
+        self.timeout = timeout
+        self.geohash_precision = geohash_precision
+        self.max_cells = max_cells
+
+    def query(self, sql):
+        """Rows of a standard SQL query, as lists of field values."""
+        jobs = self.bigquery.jobs()
+        response = jobs.query(projectId=self.project, body={
+            'query': sql,
+            'useLegacySql': False,
+            'timeoutMs': int(self.timeout * 1000),
+        }).execute(num_retries=3)
+        job_id = response['jobReference']['jobId']
+        rows = []
+        while True:
+            if response.get('jobComplete'):
+                rows.extend([field['v'] for field in row['f']]
+                            for row in response.get('rows', []))
+                if not response.get('pageToken'):
+                    return rows
+            response = jobs.getQueryResults(
+                projectId=self.project, jobId=job_id,
+                pageToken=response.get('pageToken'),
+                timeoutMs=int(self.timeout * 1000)).execute(num_retries=3)
+
+    def cursor(self):
+        rows = self.query("SELECT UNIX_MICROS(MAX(UTCTime)) FROM " +
+                          self.table)
+        return int(rows[0][0] or 0)
+
+    def tile(self, zoom, x, y, bins, bin_samples, until):
+        result = Tile(zoom, x, y, bins, bin_samples)
+        south, west, north, east = result.bounds
+        cells = geo_spatial.geohash_cover(south, west, north, east,
+                                          self.geohash_precision,
+                                          self.max_cells)
+        ranges = []
+        for start, end in geo_spatial.geohash_ranges(cells):
+            if end is None:
+                ranges.append("Geohash >= '{0}'".format(start))
+            else:
+                ranges.append("(Geohash >= '{0}' AND Geohash < '{1}')".format(
+                    start, end))
+        sql = """
+SELECT
+  LEAST({bins} - 1, CAST(FLOOR((Latitude - ({south!r})) / {lat_step!r}) AS INT64)) AS row,
+  LEAST({bins} - 1, CAST(FLOOR((Longitude - ({west!r})) / {lng_step!r}) AS INT64)) AS col,
+  COUNT(*), AVG(Latitude), AVG(Longitude),
+  ARRAY_AGG(FORMAT('%f,%f', Latitude, Longitude) LIMIT {bin_samples})
+FROM {table}
+WHERE ({ranges})
+  AND Latitude >= {south!r} AND Latitude < {north!r}
+  AND Longitude >= {west!r} AND Longitude < {east!r}
+  AND UTCTime <= TIMESTAMP_MICROS({until})
+GROUP BY row, col""".format(
+            bins=bins, bin_samples=bin_samples, table=self.table,
+            ranges=" OR ".join(ranges), south=south, west=west, north=north,
+            east=east, lat_step=(north - south) / bins,
+            lng_step=(east - west) / bins, until=int(until))
+        for row, column, count, latitude, longitude, samples in self.query(
+                sql):
+            result.add_bin(int(row), int(column), int(count),
+                           float(latitude), float(longitude),
+                           [tuple(float(value) for value in
+                                  sample['v'].split(','))
+                            for sample in samples])
+        return result
+
+    def changes(self, since):
+        rows = self.query("""
+SELECT Latitude, Longitude, UNIX_MICROS(UTCTime)
+FROM {table}
+WHERE UTCTime > TIMESTAMP_MICROS({since})
+  AND (JourneyDate IS NULL OR JourneyDate >= DATE(TIMESTAMP_MICROS({since})))
+""".format(table=self.table, since=int(since)))
+        if not rows:
+            return numpy.empty(0), numpy.empty(0), since
+        values = numpy.array(rows, dtype=float)
+        return values[:, 0], values[:, 1], int(values[:, 2].max())
+
+
+class TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            self.respond(200, geo_metrics.METRICS.render(),
+                         'text/plain; version=0.0.4')
+            return
+        match = TILE_PATH.match(path)
+        if not match:
+            self.send_error(404)
+            return
+        try:
+            body, hit = self.server.service.tile(
+                *[int(part) for part in match.groups()])
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except Exception:
+            log.exception("Loading tile %s failed", path)
+            self.send_error(502)
+            return
+        self.respond(200, body, 'application/json',
+                     {'X-Tile-Cache': 'hit' if hit else 'miss'})
+
+    def respond(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        # The viewer is opened from a file or another server.
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # A map view requests dozens of tiles at once.
+        pass
+
+
+class TileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 64
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], socket.error):
+            # The map moved on before the tile arrived.
+            log.debug("Tile request from %s disconnected", client_address[0])
+        else:
+            log.exception("Tile request from %s failed", client_address[0])
+
+
+def serve(port, service, host=''):
+    """Serve service's tiles on port from a daemon thread."""
+    server = TileServer((host, port), TileHandler)
+    server.service = service
+    thread = threading.Thread(target=server.serve_forever, name='tiles')
+    thread.daemon = True
+    thread.start()
+    return server
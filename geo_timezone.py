@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Offline replacement for the Maps Time Zone API.
+
+The timezone of a position comes from a point-in-polygon lookup over
+timezone boundary polygons, for example the GeoJSON release of
+https://github.com/evansiroky/timezone-boundary-builder, and its offsets at
+the fix's time come from the tz database via pytz. Responses have the same
+timeZoneId, rawOffset and dstOffset fields as the API.
+
+Usage:
+
+Compare the resolver with the Time Zone API on the sample trips:
+% python geo_timezone.py --boundaries combined.json --api-key 'Your-server-key'
+Leave out --api-key to time the resolver only.
+"""
+import argparse
+import datetime
+import glob
+import os
+import sys
+import time
+
+import pytz
+
+import geo_spatial
+
+
+_zones = {}
+
+
+def timezone_response(tzid, posix_time):
+    """A Time Zone API style response for a tz database ID at a time."""
+    zone = _zones.get(tzid)
+    if zone is None:
+        zone = _zones[tzid] = pytz.timezone(tzid)
+    utc_time = datetime.datetime.utcfromtimestamp(posix_time)
+    local_time = pytz.utc.localize(utc_time).astimezone(zone)
+    dst = local_time.dst() or datetime.timedelta(0)
+    raw = local_time.utcoffset() - dst
+    return {
+        'status': 'OK',
+        'timeZoneId': tzid,
+        'timeZoneName': local_time.tzname(),
+        'rawOffset': raw.days * 86400 + raw.seconds,
+        'dstOffset': dst.days * 86400 + dst.seconds,
+    }
+
+
+class TimezoneResolver(object):
+    """Resolves positions to timezones without calling the Maps API."""
+
+    def __init__(self, boundaries_path, bounds=None):
+        self.index = geo_spatial.load_polygon_index(
+            boundaries_path, 'tzid', bounds=bounds)
+
+    def timezone(self, latitude, longitude, posix_time):
+        """Return a Time Zone API style response, or None if not covered."""
+        tzid = self.index.lookup(latitude, longitude)
+        if tzid is None:
+            return None
+        return timezone_response(tzid, posix_time)
+
+
+def sample_fixes(rootdir):
+    """Latitude, longitude and POSIX time of every fix in the trip files."""
+    import config_geo_pubsub_push
+    points = []
+    for path in sorted(glob.glob(os.path.join(rootdir, '*.csv'))):
+        fixes, _ = config_geo_pubsub_push.read_trip_file(path)
+        points.extend(zip(fixes['latitude'].tolist(),
+                          fixes['longitude'].tolist(),
+                          fixes['epoch'].tolist()))
+    return points
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--boundaries", required=True,
+                        help="GeoJSON file of timezone boundary polygons.")
+    parser.add_argument("--fileloc", default="resources/data",
+                        help="input folder with csv files")
+    parser.add_argument("--api-key", help="Maps API server key; if given, "
+                        "the same points are also sent to the Time Zone API.")
+    parser.add_argument("--api-sample", type=int, default=100,
+                        help="Number of points to send to the API.")
+    args = parser.parse_args()
+
+    start = time.time()
+    resolver = TimezoneResolver(args.boundaries)
+    print "Loaded {0} timezone polygons in {1:.2f}s".format(
+        len(resolver.index), time.time() - start)
+
+    points = sample_fixes(args.fileloc)
+    start = time.time()
+    offline = [resolver.timezone(*point) for point in points]
+    elapsed = time.time() - start
+    print "Offline: {0} points in {1:.3f}s, {2:.3f} ms/point, {3} unresolved".format(
+        len(points), elapsed, elapsed * 1000 / max(len(points), 1),
+        offline.count(None))
+
+    if args.api_key:
+        import googlemaps
+        gmaps = googlemaps.Client(key=args.api_key)
+        sample = points[:args.api_sample]
+        start = time.time()
+        online = [gmaps.timezone((lat, lng), timestamp=posix_time)
+                  for lat, lng, posix_time in sample]
+        elapsed = time.time() - start
+        mismatches = 0
+        for api, local in zip(online, offline):
+            if local is None or (
+                    api['timeZoneId'] != local['timeZoneId'] or
+                    api['rawOffset'] + api['dstOffset'] !=
+                    local['rawOffset'] + local['dstOffset']):
+                mismatches += 1
+        print "API: {0} points in {1:.3f}s, {2:.3f} ms/point, {3} mismatches".format(
+            len(sample), elapsed, elapsed * 1000 / max(len(sample), 1),
+            mismatches)
+
+if __name__ == '__main__':
+    main(sys.argv)
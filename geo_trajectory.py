@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Reuse of enrichment results along each vehicle's trajectory.
+
+A vehicle reports its position every few seconds, so consecutive fixes are
+often close together or, at a red light, in the same place. Rather than
+looking everything up again, a fix can take a field of the enrichment
+(address, elevation or timezone) from the last fix of the same vehicle
+that had it looked up, if it is close enough to that fix in both distance
+and time. Each field has its own distance limit: an address is only good
+for a few metres, a timezone for kilometres.
+"""
+import collections
+import threading
+
+import geo_spatial
+import geo_timezone
+
+# Distance in metres within which each enrichment field is reused.
+DEFAULT_REUSE_METRES = {
+    'address_list': 25.0,
+    'elevation': 100.0,
+    'timezone': 5000.0,
+}
+
+
+def retime(field, value, posix_time):
+    """A reused value as it applies at posix_time.
+
+    Timezone offsets change with DST, so they are worked out again for the
+    time of the fix that reuses them.
+    """
+    if field == 'timezone' and value.get('timeZoneId'):
+        return geo_timezone.timezone_response(value['timeZoneId'], posix_time)
+    return value
+
+
+class TrajectoryCache(object):
+    """The last looked-up enrichment fields of each vehicle.
+
+    reuse_metres maps enrichment fields to the distance within which they
+    are reused; fields not in it are always looked up. A field is only
+    reused from a fix at most max_seconds earlier or later. State is kept
+    for up to max_vehicles vehicles, least recently seen dropped first.
+
+    Use plan() to find which fields of a batch of fixes can be reused,
+    look up the rest, then apply() to fill in the reused fields and
+    remember the new lookups.
+    """
+
+    def __init__(self, reuse_metres=None, max_seconds=120.0,
+                 max_vehicles=100000):
+        self.reuse_metres = dict(DEFAULT_REUSE_METRES
+                                 if reuse_metres is None else reuse_metres)
+        self.max_seconds = max_seconds
+        self.max_vehicles = max_vehicles
+        self.fields_reused = collections.Counter()
+        self.fields_looked_up = collections.Counter()
+        self._lock = threading.Lock()
+        # VehicleID -> {field: (latitude, longitude, posix_time, value)}
+        self._vehicles = collections.OrderedDict()
+
+    def plan(self, fixes):
+        """For each fix, a dict of the fields it can reuse.
+
+        Each field maps to ('state', value), a value from an earlier
+        batch, or ('fix', index), the lookup for another fix of this
+        batch. Fixes are taken in time order per vehicle, and each reuses
+        the last fix that had the field looked up, not one that reused it,
+        so errors don't build up along the trajectory.
+        """
+        plans = [{} for _ in fixes]
+        anchors = {}
+        order = sorted(range(len(fixes)), key=lambda index: (
+            fixes[index]['VehicleID'], fixes[index]['posix_time']))
+        with self._lock:
+            for index in order:
+                fix = fixes[index]
+                state = self._vehicles.get(fix['VehicleID'], {})
+                for field, limit in self.reuse_metres.items():
+                    anchor = anchors.get((fix['VehicleID'], field))
+                    if anchor is None and field in state:
+                        latitude, longitude, posix_time, value = state[field]
+                        anchor = (latitude, longitude, posix_time,
+                                  ('state', value))
+                    if anchor is not None and self._close(anchor, fix, limit):
+                        plans[index][field] = anchor[3]
+                    else:
+                        anchors[(fix['VehicleID'], field)] = (
+                            fix['Latitude'], fix['Longitude'],
+                            fix['posix_time'], ('fix', index))
+        return plans
+
+    def apply(self, fixes, plans, looked_up):
+        """Complete the enrichments of a batch planned with plan().
+
+        looked_up maps the index of every fix that needed a lookup to its
+        partial enrichment, or None if the lookup failed. Returns one
+        enrichment per fix, or None where a field it needed (its own or
+        the one it reuses) couldn't be looked up. Enrichments with reused
+        fields list them, sorted, under 'reused'.
+        """
+        results = []
+        for index, fix in enumerate(fixes):
+            plan = plans[index]
+            enrichment = {}
+            if index in looked_up:
+                enrichment = looked_up[index]
+            if enrichment is None:
+                results.append(None)
+                continue
+            enrichment = dict(enrichment)
+            for field, (source, value) in plan.items():
+                if source == 'fix':
+                    anchor = looked_up.get(value)
+                    if anchor is None:
+                        enrichment = None
+                        break
+                    value = anchor[field]
+                enrichment[field] = retime(field, value, fix['posix_time'])
+            if enrichment is not None and plan:
+                enrichment['reused'] = sorted(plan)
+            results.append(enrichment)
+
+        with self._lock:
+            for index, enrichment in looked_up.items():
+                if enrichment is not None:
+                    self._remember(fixes[index], enrichment, plans[index])
+            for plan, enrichment in zip(plans, results):
+                if enrichment is not None:
+                    self.fields_reused.update(plan.keys())
+                    self.fields_looked_up.update(
+                        field for field in self.reuse_metres
+                        if field not in plan)
+        return results
+
+    def report(self):
+        with self._lock:
+            return "Trajectory reuse: " + ", ".join(
+                "{0} {1}/{2}".format(
+                    field, self.fields_reused[field],
+                    self.fields_reused[field] + self.fields_looked_up[field])
+                for field in sorted(self.reuse_metres))
+
+    def _close(self, anchor, fix, limit):
+        latitude, longitude, posix_time, _ = anchor
+        if abs(fix['posix_time'] - posix_time) > self.max_seconds:
+            return False
+        return geo_spatial.distance_metres(
+            latitude, longitude, fix['Latitude'], fix['Longitude']) <= limit
+
+    def _remember(self, fix, enrichment, plan):
+        # Caller must hold self._lock.
+        vehicle = fix['VehicleID']
+        state = self._vehicles.pop(vehicle, {})
+        for field in self.reuse_metres:
+            if field in plan or field not in enrichment:
+                continue
+            if field in state and state[field][2] > fix['posix_time']:
+                continue
+            state[field] = (fix['Latitude'], fix['Longitude'],
+                            fix['posix_time'], enrichment[field])
+        self._vehicles[vehicle] = state
+        while len(self._vehicles) > self.max_vehicles:
+            self._vehicles.popitem(last=False)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Adjusts the pull worker's batch size, Maps API concurrency and BigQuery
+flush thresholds while it runs.
+
+Tuner.adjust() looks at what geo_metrics recorded since its last call:
+how full pulls came back, how long enriching a batch and inserting rows
+took, how busy the Maps API calls kept their threads and how many calls
+were throttled (OVER_QUERY_LIMIT, HTTP 429, timeouts, or given up at the
+batch deadline). From that it moves each setting within its bounds:
+
+  batch_size  (pull maxMessages, and fixes enriched together) grows while
+              there is a backlog, and halves when batches come close to
+              their deadline or calls are throttled;
+  concurrency (Maps API calls in flight) grows while the calls keep
+              nearly every thread busy, and shrinks when calls are
+              throttled;
+  max_rows, max_age
+              (sink flush thresholds) shrink max_age at light load so
+              rows are written and acked sooner, and grow both when rows
+              arrive faster than a flush takes them or inserts are slow,
+              so there are fewer, larger requests.
+
+Settings are only backed off after `sustain` congested intervals in a
+row, and once that many intervals in a row are healthy again they grow
+back towards their values before the back-off. Other failures, like an
+address the Geocoding API can't find or a row BigQuery rejects, say
+nothing about the load and don't change any setting.
+
+Every change is logged with the observations behind it.
+"""
+import logging
+import threading
+import time
+
+import geo_metrics
+
+log = logging.getLogger('geo_tuning')
+
+
+class Limiter(object):
+    """Lets at most limit callers hold a slot at once; the limit can be
+    changed at any time."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._condition = threading.Condition()
+
+    def set_limit(self, limit):
+        with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+    def acquire(self, timeout=None):
+        """Take a slot; False if none came free within timeout seconds."""
+        with self._condition:
+            if timeout is None:
+                while self.active >= self.limit:
+                    self._condition.wait()
+            else:
+                end = time.time() + timeout
+                while self.active >= self.limit:
+                    left = end - time.time()
+                    if left <= 0:
+                        return False
+                    self._condition.wait(left)
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+def clamp(value, bounds):
+    return max(bounds[0], min(bounds[1], value))
+
+
+class Tuner(object):
+    """Adjusts a pipeline's batch_size, its enricher's concurrency and its
+    sink's max_rows and max_age within bounds, a dict of (lowest,
+    highest) for each of them.
+
+    An interval is congested when more than max_throttle_rate of the Maps
+    API calls were throttled, or batches took more than deadline_fraction
+    of the enricher's deadline; settings are backed off after sustain
+    such intervals in a row, and recover after sustain healthy ones.
+    """
+
+    def __init__(self, pipeline, bounds, registry=geo_metrics.METRICS,
+                 max_throttle_rate=0.05, deadline_fraction=0.5, sustain=3):
+        self.pipeline = pipeline
+        self.enricher = pipeline.enricher
+        self.sink = pipeline.sink
+        self.bounds = bounds
+        self.registry = registry
+        self.max_throttle_rate = max_throttle_rate
+        self.deadline_fraction = deadline_fraction
+        self.sustain = sustain
+        # Congested, and healthy, intervals in a row.
+        self.congested = 0
+        self.healthy = 0
+        # Setting -> its value before it was last backed off.
+        self.ceilings = {}
+        self._last = registry.values()
+        self._last_time = time.time()
+        for setting in sorted(bounds):
+            registry.gauge('geo_tuning_setting',
+                           lambda setting=setting: self.setting(setting),
+                           setting=setting)
+
+    def setting(self, name):
+        if name == 'batch_size':
+            return self.pipeline.batch_size
+        if name == 'concurrency':
+            return self.enricher.concurrency
+        return getattr(self.sink, name)
+
+    def change(self, name, value):
+        if name == 'batch_size':
+            self.pipeline.batch_size = value
+        elif name == 'concurrency':
+            self.enricher.set_concurrency(value)
+        else:
+            setattr(self.sink, name, value)
+
+    def observe(self):
+        """What the metrics recorded since the last call."""
+        now = time.time()
+        values = self.registry.values()
+        elapsed = max(now - self._last_time, 1e-6)
+        last = self._last
+        self._last = values
+        self._last_time = now
+
+        def delta(name, position=None, **labels):
+            # Sum of the series of name that have labels.
+            total = 0.0
+            for (series, key), value in values.items():
+                if series != name or not set(labels.items()) <= set(key):
+                    continue
+                previous = last.get((series, key), 0)
+                if position is not None:
+                    value = value[position]
+                    previous = previous[position] if previous else 0
+                total += value - previous
+            return total
+
+        def mean(name, **labels):
+            count = delta(name, 0, **labels)
+            return delta(name, 1, **labels) / count if count else 0.0
+
+        pulls = delta('geo_stage_seconds', 0, stage='pull')
+        maps_calls = delta('geo_maps_calls_total')
+        return {
+            'seconds': elapsed,
+            # Messages per pull, as a fraction of the batch size.
+            'pull_fullness': (delta('geo_messages_total', event='pulled') /
+                              (pulls * self.pipeline.batch_size)
+                              if pulls else 0.0),
+            # Fixes pulled but not yet through the enrich stage.
+            'backlog': self.pipeline.unenriched,
+            'enrich_seconds': mean('geo_stage_seconds', stage='enrich'),
+            'insert_seconds': mean('geo_stage_seconds', stage='insert'),
+            # Mean number of Maps API calls in progress.
+            'calls_in_flight': delta('geo_maps_call_seconds', 1) / elapsed,
+            # Calls the API turned away or didn't answer in time, or that
+            # were given up on because their batch ran out of time.
+            'throttle_rate': (
+                (delta('geo_maps_calls_total', outcome='throttled') +
+                 delta('geo_maps_calls_total', outcome='deadline')) /
+                maps_calls if maps_calls else 0.0),
+            'row_rate': delta('geo_rows_total', outcome='inserted') / elapsed,
+        }
+
+    def decide(self, observed):
+        """The new value and reason for each setting that should change."""
+        bounds = self.bounds
+        decisions = {}
+
+        def propose(name, value, reason):
+            value = clamp(value, bounds[name])
+            if value != self.setting(name):
+                decisions[name] = (value, reason)
+
+        def back_off(name, value, reason):
+            self.ceilings[name] = max(self.ceilings.get(name, 0),
+                                      self.setting(name))
+            propose(name, value, reason)
+
+        def grow(name, value, reason):
+            if value > self.ceilings.get(name, value):
+                # Back past where it was backed off from.
+                del self.ceilings[name]
+            propose(name, value, reason)
+
+        deadline = self.enricher.deadline
+        throttled = observed['throttle_rate'] > self.max_throttle_rate
+        slow = observed['enrich_seconds'] > self.deadline_fraction * deadline
+        if throttled or slow:
+            self.congested += 1
+            self.healthy = 0
+        else:
+            self.congested = 0
+            self.healthy += 1
+        batch_size = self.pipeline.batch_size
+        concurrency = self.enricher.concurrency
+        if self.congested >= self.sustain:
+            # Start counting again, so the next back-off is also only
+            # after congestion that lasts.
+            self.congested = 0
+            reason = ("{0} congested intervals: {1:.0%} of Maps API calls "
+                      "throttled, batches took {2:.1f}s of a {3:.1f}s "
+                      "deadline".format(self.sustain,
+                                        observed['throttle_rate'],
+                                        observed['enrich_seconds'], deadline))
+            back_off('batch_size', batch_size // 2, reason)
+            if throttled:
+                back_off('concurrency', concurrency - max(concurrency // 4, 1),
+                         reason)
+        elif not self.congested:
+            recovering = self.healthy >= self.sustain
+            if (observed['pull_fullness'] >= 0.9 or
+                    observed['backlog'] >= batch_size or
+                    recovering and batch_size < self.ceilings.get(
+                        'batch_size', 0)):
+                grow('batch_size', batch_size + max(batch_size // 4, 1),
+                     "pulls {0:.0%} full with {1} fixes waiting, batches "
+                     "took {2:.1f}s of a {3:.1f}s deadline".format(
+                         observed['pull_fullness'], observed['backlog'],
+                         observed['enrich_seconds'], deadline))
+            if (observed['calls_in_flight'] >= 0.8 * concurrency or
+                    recovering and concurrency < self.ceilings.get(
+                        'concurrency', 0)):
+                grow('concurrency', concurrency + max(concurrency // 4, 1),
+                     "{0:.1f} of {1} calls in flight on average, {2:.0%} "
+                     "throttled".format(observed['calls_in_flight'],
+                                        concurrency,
+                                        observed['throttle_rate']))
+
+        sink = self.sink
+        # Rows that arrive in one max_age; a flush takes at most max_rows.
+        per_flush = observed['row_rate'] * sink.max_age
+        if (observed['insert_seconds'] > sink.max_age or
+                per_flush >= sink.max_rows):
+            reason = "{0:.1f} rows/s, inserts took {1:.2f}s".format(
+                observed['row_rate'], observed['insert_seconds'])
+            propose('max_rows', sink.max_rows * 2, reason)
+            propose('max_age', sink.max_age * 2, reason)
+        elif per_flush < sink.max_rows / 4.0:
+            propose('max_age', sink.max_age / 2,
+                    "{0:.1f} rows/s fill {1:.0%} of a {2}-row flush".format(
+                        observed['row_rate'], per_flush / sink.max_rows,
+                        sink.max_rows))
+        return decisions
+
+    def adjust(self):
+        """Apply and log the decisions for what was observed since the
+        last call; returns them."""
+        decisions = self.decide(self.observe())
+        for name in sorted(decisions):
+            value, reason = decisions[name]
+            log.info("Tuning %s %s -> %s: %s", name, self.setting(name),
+                     value, reason)
+            self.change(name, value)
+        return decisions
@@ -10,7 +10,9 @@
 # setup.sh
 mkdir /tmp/creds
 bq mk sandiego_freeways
-bq mk --schema geocoded_journeys.json sandiego_freeways.geocoded_journeys
+# Partitioned by day and clustered on the geohash cell, so map queries only
+# read the days and areas they ask for.
+bq mk --time_partitioning_field JourneyDate --clustering_fields Geohash --schema geocoded_journeys.json sandiego_freeways.geocoded_journeys
 mkdir /tmp/creds/data
 cp data/* /tmp/creds/data/
 cp setup.yaml /tmp/creds/
@@ -0,0 +1,96 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import shutil
+
+import pytest
+
+import config_geo_backfill as backfill
+import config_geo_pubsub_pull as pull
+import geo_fakes
+import geo_schema
+
+TRIP_FILE = 'resources/data/Mobile-GPS-Trip1.csv'
+CHUNK_SIZE = 20
+
+
+class InterruptedEnricher(pull.Enricher):
+    """Stops the run, like Ctrl-C would, at the interrupt_at'th chunk."""
+
+    def __init__(self, interrupt_at=None):
+        super(InterruptedEnricher, self).__init__(geo_fakes.FakeMaps(), 4)
+        self.interrupt_at = interrupt_at
+        self.chunks = 0
+
+    def enrich(self, fixes):
+        self.chunks += 1
+        if self.chunks == self.interrupt_at:
+            raise KeyboardInterrupt()
+        return super(InterruptedEnricher, self).enrich(fixes)
+
+
+def run(trip_files, output, enricher):
+    try:
+        return backfill.backfill(trip_files, str(output), enricher,
+                                 geo_schema.load_schema(), CHUNK_SIZE)
+    finally:
+        enricher.close()
+
+
+def rows(path):
+    with open(str(path)) as rows_file:
+        return [json.loads(line) for line in rows_file]
+
+
+@pytest.fixture
+def trip_file(tmpdir):
+    path = tmpdir.join('data', 'Mobile-GPS-Trip1.csv')
+    path.dirpath().ensure(dir=True)
+    shutil.copy(TRIP_FILE, str(path))
+    return str(path)
+
+
+def test_interrupted_run_resumes_at_its_checkpoint(tmpdir, trip_file):
+    expected = tmpdir.join('expected')
+    full = InterruptedEnricher()
+    assert run([trip_file], expected, full) == 0
+
+    output = tmpdir.join('output')
+    with pytest.raises(KeyboardInterrupt):
+        run([trip_file], output, InterruptedEnricher(interrupt_at=3))
+    checkpoint = backfill.Checkpoint(str(output))
+    entry = checkpoint.progress(trip_file)
+    assert entry['offset'] == 2 * CHUNK_SIZE
+    assert not output.join('Mobile-GPS-Trip1.json').exists()
+
+    resumed = InterruptedEnricher()
+    assert run([trip_file], output, resumed) == 0
+    # Only the chunks after the checkpoint were enriched again.
+    assert resumed.chunks == full.chunks - 2
+    assert rows(output.join('Mobile-GPS-Trip1.json')) == rows(
+        expected.join('Mobile-GPS-Trip1.json'))
+    assert backfill.Checkpoint(str(output)).done(trip_file)
+
+
+def test_done_files_are_skipped_until_they_change(tmpdir, trip_file):
+    output = tmpdir.join('output')
+    run([trip_file], output, InterruptedEnricher())
+    again = InterruptedEnricher()
+    run([trip_file], output, again)
+    assert again.chunks == 0
+    with open(trip_file, 'a') as appended:
+        appended.write('$GPRMC,171209.63,V,,,,,,,041110,0,W,A*1C\n')
+    changed = InterruptedEnricher()
+    run([trip_file], output, changed)
+    assert changed.chunks > 0
@@ -0,0 +1,168 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import base64
+import socket
+import time
+
+import pytest
+
+import config_geo_pubsub_pull as pull
+import geo_fakes
+import geo_leases
+
+TOPIC = 'projects/test/topics/traffic'
+SUBSCRIPTION = 'projects/test/subscriptions/traffic'
+MESSAGES = 40
+
+
+def add_rows(sink, count):
+    for number in range(count):
+        sink.add({'VehicleID': 'trip1', 'index': number},
+                 'insert-{0}'.format(number), 'ack-{0}'.format(number))
+
+
+def test_one_failing_row_holds_up_few_others():
+    bigquery = geo_fakes.FakeBigQuery(row_error_rate=0.02, seed=3)
+    sink = pull.BigQueryRowSink(bigquery, max_age=0, max_retry_delay=0)
+    add_rows(sink, 200)
+    acked = sink.flush()
+    # A request of 200 rows gets through whole only 2% of the time, so
+    # without splitting, a flush would hardly ever write any of them.
+    assert len(acked) >= 60
+    flushes = 1
+    while len(sink) and flushes < 10:
+        acked.extend(sink.flush())
+        flushes += 1
+    assert flushes <= 5
+    assert sorted(acked) == sorted('ack-{0}'.format(number)
+                                   for number in range(200))
+    assert bigquery.row_count() == 200
+    assert sink.rows_failed == 0
+
+
+def test_rows_that_keep_failing_are_given_up_on_final_flush():
+    bigquery = geo_fakes.FakeBigQuery(row_error_rate=1.0)
+    sink = pull.BigQueryRowSink(bigquery, max_age=0)
+    add_rows(sink, 10)
+    assert sink.flush() == []
+    assert sink.failed_ack_ids == []
+    assert len(sink) == 10
+    assert sink.flush(final=True) == []
+    assert sorted(sink.failed_ack_ids) == sorted(
+        'ack-{0}'.format(number) for number in range(10))
+    assert not len(sink)
+
+
+def test_failed_requests_are_retried():
+    bigquery = geo_fakes.FakeBigQuery(error_rate=1.0)
+    sink = pull.BigQueryRowSink(bigquery, max_age=0, max_retry_delay=0)
+    add_rows(sink, 5)
+    assert sink.flush() == []
+    bigquery.error_rate = 0.0
+    assert len(sink.flush()) == 5
+    assert bigquery.row_count() == 5
+
+
+def publish(broker, count):
+    broker.create_subscription(TOPIC, SUBSCRIPTION)
+    broker.publish(TOPIC, {'messages': [{
+        'data': base64.b64encode('trip1,32.7{0:02d},-117.16,10,90'.format(
+            number)),
+        'attributes': {'timestamp': '2016-05-11 20:53:{0:02d}'.format(
+            number % 60)},
+    } for number in range(count)]}).execute()
+
+
+def run_pipeline(broker, bigquery, timeout=30):
+    """Run a pull pipeline until the broker has no backlog or a stage
+    dies; returns it stopped."""
+    enricher = pull.Enricher(geo_fakes.FakeMaps(), 4)
+    sink = pull.BigQueryRowSink(bigquery, max_age=0.1, max_retry_delay=0.1)
+    pipeline = pull.PullPipeline(
+        lambda: broker, SUBSCRIPTION,
+        {'returnImmediately': False, 'maxMessages': 10}, enricher, sink,
+        geo_leases.Leases(), row_log_every=0)
+    pipeline.start()
+    end = time.time() + timeout
+    while (time.time() < end and broker.backlog(SUBSCRIPTION) and
+           not pipeline.failed):
+        time.sleep(0.05)
+    pipeline.stop()
+    assert pipeline.wait(timeout)
+    enricher.close()
+    return pipeline
+
+
+class FailingInserts(geo_fakes.FakeBigQuery):
+    """Raises error from the first `failures` insertAll requests."""
+
+    def __init__(self, error, failures):
+        super(FailingInserts, self).__init__()
+        self.error = error
+        self.failures = failures
+
+    def insertAll(self, **kwargs):
+        request = super(FailingInserts, self).insertAll(**kwargs)
+        if self.failures:
+            self.failures -= 1
+
+            def fail():
+                raise self.error
+            request.function = fail
+        return request
+
+
+@pytest.fixture
+def broker():
+    broker = geo_fakes.FakePubSub(pull_wait=0.1)
+    publish(broker, MESSAGES)
+    yield broker
+    broker.close()
+
+
+def test_pipeline_writes_every_message(broker):
+    bigquery = geo_fakes.FakeBigQuery()
+    pipeline = run_pipeline(broker, bigquery)
+    assert pipeline.failed is None
+    assert bigquery.row_count() == MESSAGES
+    assert broker.backlog(SUBSCRIPTION) == 0
+
+
+def test_connection_errors_are_retried(broker):
+    bigquery = FailingInserts(socket.error(104, 'Connection reset'), 2)
+    pipeline = run_pipeline(broker, bigquery)
+    assert bigquery.failures == 0
+    assert pipeline.failed is None
+    assert bigquery.row_count() == MESSAGES
+
+
+def test_a_dying_stage_stops_the_pipeline(broker):
+    bigquery = FailingInserts(RuntimeError('bug'), 1)
+    start = time.time()
+    pipeline = run_pipeline(broker, bigquery)
+    assert time.time() - start < 15
+    assert pipeline.failed == 'sink_stage'
+    assert pipeline.acked.is_set()
+    # Nothing was written, and nothing is acked, so it is all redelivered.
+    assert bigquery.row_count() == 0
+    assert broker.backlog(SUBSCRIPTION) == MESSAGES
+
+
+@pytest.mark.parametrize('value, expected', [
+    (True, True), (False, False), ('true', True), ('Yes', True), ('1', True),
+    (1, True), ('false', False), ('no', False), ('0', False), (0, False),
+    ('', None), (None, None)])
+def test_env_flag(monkeypatch, value, expected):
+    monkeypatch.setitem(pull.cfg, 'env', {'FLAG': value})
+    assert pull.env_flag('FLAG', None) is expected
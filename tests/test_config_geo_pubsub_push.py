@@ -0,0 +1,153 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import base64
+import sys
+
+import pytest
+from apiclient import errors
+
+import config_geo_pubsub_push as push
+import geo_fakes
+
+TOPIC = 'projects/test/topics/traffic'
+SUBSCRIPTION = 'projects/test/subscriptions/traffic'
+
+
+def pulled_data(broker, count):
+    response = broker.pull(SUBSCRIPTION, {
+        'returnImmediately': True, 'maxMessages': count}).execute()
+    return [base64.b64decode(received['message']['data'])
+            for received in response.get('receivedMessages', [])]
+
+
+@pytest.fixture
+def broker():
+    broker = geo_fakes.FakePubSub()
+    broker.create_subscription(TOPIC, SUBSCRIPTION)
+    return broker
+
+
+def test_messages_are_sent_in_batches(broker):
+    publisher = push.BatchPublisher(lambda: broker, TOPIC, max_messages=10,
+                                    max_latency=2, max_in_flight=2)
+    for number in range(25):
+        publisher.publish('fix {0}'.format(number), ordering_key='trip1')
+    publisher.close()
+    assert publisher.messages_sent == 25
+    assert publisher.requests_sent == 3
+    assert broker.calls['publish'] == 3
+    # One ordering key keeps to one lane, so the order is kept.
+    assert pulled_data(broker, 100) == ['fix {0}'.format(number)
+                                        for number in range(25)]
+
+
+def test_a_batch_is_sent_after_max_latency(broker):
+    publisher = push.BatchPublisher(lambda: broker, TOPIC, max_latency=0.05)
+    publisher.publish('fix')
+    publisher.drain()
+    assert publisher.messages_sent == 1
+    publisher.close()
+
+
+def test_too_large_message_is_refused(broker):
+    publisher = push.BatchPublisher(lambda: broker, TOPIC, max_bytes=100)
+    with pytest.raises(ValueError):
+        publisher.publish('x' * 100)
+    publisher.close()
+
+
+def test_failed_publishes_are_recorded_and_raised_on_close(broker):
+    broker.error_rate = 1.0
+    publisher = push.BatchPublisher(lambda: broker, TOPIC, max_messages=5,
+                                    max_latency=2, max_in_flight=1)
+    for number in range(7):
+        publisher.publish('fix {0}'.format(number))
+    with pytest.raises(errors.HttpError):
+        publisher.close()
+    assert len(publisher.errors) == 2
+    assert publisher.messages_failed == 7
+    assert publisher.messages_sent == 0
+    assert '2 failed requests of 7 messages' in publisher.report()
+
+
+TRIP_LINES = [
+    '$GPRMC,171209.63,A,3315.2707,N,11717.9659,W,20.762,7.382,041110,0,W,A*1C\n',
+    '$GPRMC,171212.63,V,3315.2836,N,11717.9630,W,10.614,9.595,041110,0,W,A*19\n',
+    '$GPGGA,171212.63,3315.2836,N,11717.9630,W,1,08,0.9,545.4,M\n',
+    '$GPRMC,171230.63,A,3315.2884,X,11717.9616,W,8.356,5.204,041110,0,W,A*2D\n',
+    '$GPRMC,171233.63,A,,N,11717.9600,W,20.302,8.176,041110,0,W,A*1E\n',
+    '$GPRMC,171233\n',
+    '\n',
+    '$GPRMC,000001.00,A,0130.0000,S,00030.0000,E,1.5,180.0,311299,0,W,A*00\n',
+]
+
+
+def test_parse_trip_lines_keeps_only_valid_fixes():
+    fixes, rejected = push.parse_trip_lines(TRIP_LINES)
+    # Blank lines are neither fixes nor rejected rows.
+    assert rejected == 5
+    assert list(fixes['latitude']) == pytest.approx(
+        [33 + 15.2707 / 60, -1.5])
+    assert list(fixes['longitude']) == pytest.approx(
+        [-(117 + 17.9659 / 60), 0.5])
+    assert list(fixes['speed']) == pytest.approx([20.762, 1.5])
+    assert list(fixes['bearing']) == pytest.approx([7.382, 180.0])
+    assert list(push.format_timestamps(fixes['epoch'])) == [
+        push.create_timestamp('171209', '041110'),
+        push.create_timestamp('000001', '311299')]
+
+
+def test_parse_trip_lines_without_fixes():
+    fixes, rejected = push.parse_trip_lines(['$GPRMC,171233\n'])
+    assert rejected == 1
+    assert all(len(fixes[field]) == 0 for field in push.FIX_FIELDS)
+    assert push.parse_trip_lines([])[1] == 0
+
+
+def run_main(monkeypatch, tmpdir, broker, workers):
+    for trip in range(3):
+        tmpdir.join('Mobile-GPS-Trip{0}.csv'.format(trip)).write(
+            'header\n' + ''.join(TRIP_LINES))
+    monkeypatch.setattr(push, 'create_pubsub_client', lambda: broker)
+    monkeypatch.setattr('sys.argv', [
+        'config_geo_pubsub_push.py', '--fileloc', str(tmpdir),
+        '--topic', TOPIC, '--max-latency', '0.1',
+        '--workers', str(workers)])
+    return push.main(sys.argv)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_main_exits_zero_when_everything_is_published(
+        monkeypatch, tmpdir, broker, workers):
+    assert run_main(monkeypatch, tmpdir, broker, workers) == 0
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_main_exits_non_zero_when_a_publish_fails(
+        monkeypatch, tmpdir, broker, workers):
+    broker.error_rate = 1.0
+    assert run_main(monkeypatch, tmpdir, broker, workers) == 1
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_main_exits_non_zero_when_a_worker_raises(
+        monkeypatch, tmpdir, broker, workers):
+    read_trip_file = push.read_trip_file
+
+    def failing_read(path):
+        if path.endswith('Trip1.csv'):
+            raise IOError('unreadable')
+        return read_trip_file(path)
+    monkeypatch.setattr(push, 'read_trip_file', failing_read)
+    assert run_main(monkeypatch, tmpdir, broker, workers) == 1
@@ -0,0 +1,126 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import base64
+import json
+
+import numpy
+
+import geo_batch
+import geo_message
+
+
+def received(message_id, data, attributes=None):
+    return {'ackId': 'ack-' + message_id, 'message': {
+        'messageId': message_id, 'data': base64.b64encode(data),
+        'attributes': attributes or {}}}
+
+
+def csv_message(message_id, line, timestamp='2016-05-11 20:53:20'):
+    return received(message_id, line, {'timestamp': timestamp})
+
+
+def binary_message(message_id, vehicles, columns):
+    return received(message_id, geo_message.encode(vehicles, columns),
+                    {geo_message.FORMAT_ATTRIBUTE: geo_message.BINARY_FORMAT})
+
+
+def test_decode_both_formats():
+    batch, rejected = geo_batch.decode_batch([
+        csv_message('1', 'trip1,32.71,-117.16,10.5,90'),
+        binary_message('2', ['trip2', 'trip3'], {
+            'epoch': [1463000000.0, 1463000001.0],
+            'latitude': [32.72, 32.73],
+            'longitude': [-117.17, -117.18],
+            'speed': [1.0, float('nan')],
+            'bearing': [2.0, 3.0],
+        }),
+    ])
+    assert rejected == []
+    assert batch.vehicle_id.tolist() == ['trip1', 'trip2', 'trip3']
+    assert batch.message_id.tolist() == ['1', '2', '2']
+    assert batch.ack_id.tolist() == ['ack-1', 'ack-2', 'ack-2']
+    assert batch.index.tolist() == [0, 0, 1]
+    # CSV timestamps are read as UTC.
+    assert batch.epoch[0] == 1463000000.0
+    assert batch[0]['UTCTime'] == '2016-05-11 20:53:20'
+    assert batch[2]['Speed'] is None
+    assert batch.fixes_per_ack_id() == {'ack-1': 1, 'ack-2': 2}
+
+
+def test_undecodable_messages_are_rejected_alone():
+    good = csv_message('1', 'trip1,32.71,-117.16,10.5,90')
+    not_base64 = {'ackId': 'ack-2', 'message': {'messageId': '2',
+                                                'data': 'abc'}}
+    no_timestamp = received('3', 'trip1,32.71,-117.16,10.5,90')
+    short = csv_message('4', 'trip1,32.71')
+    bad_binary = received('5', 'GFX', {'format': 'fixes'})
+    batch, rejected = geo_batch.decode_batch(
+        [good, not_base64, no_timestamp, short, bad_binary])
+    assert batch.message_id.tolist() == ['1']
+    assert [message['message']['messageId'] for message, _ in rejected] == [
+        '2', '3', '4', '5']
+    assert rejected[0][1] == "data is not base64"
+    assert rejected[1][1] == rejected[2][1] == \
+        "not a CSV fix with a timestamp"
+
+
+def test_a_bad_fix_rejects_its_whole_message():
+    batch, rejected = geo_batch.decode_batch([
+        csv_message('1', 'trip1,91.0,-117.16,10.5,90'),
+        csv_message('2', ' ,32.71,-117.16,10.5,90'),
+        csv_message('3', 'trip1,32.71,-117.16,10.5,90', timestamp='never'),
+        csv_message('4', 'trip1,32.71,-117.16,,'),
+        binary_message('5', ['trip2', 'trip2'], {
+            'epoch': [1463000000.0, 1463000001.0],
+            'latitude': [32.72, float('nan')],
+            'longitude': [-117.17, -117.18],
+            'speed': [1.0, 1.0],
+            'bearing': [2.0, 3.0],
+        }),
+    ])
+    # Unknown speed and bearing are fine.
+    assert batch.message_id.tolist() == ['4']
+    assert numpy.isnan(batch.speed[0])
+    assert [message['message']['messageId'] for message, _ in rejected] == [
+        '1', '2', '3', '5']
+
+
+def test_empty_pull():
+    batch, rejected = geo_batch.decode_batch([])
+    assert len(batch) == 0
+    assert rejected == []
+
+
+def test_take_and_concatenate():
+    batch, _ = geo_batch.decode_batch([
+        csv_message(str(number), 'trip{0},32.7,-117.1,1,2'.format(number))
+        for number in range(4)])
+    odd = batch.take(numpy.array([1, 3]))
+    assert odd.message_id.tolist() == ['1', '3']
+    both = geo_batch.concatenate([odd, batch.take(numpy.array([0]))])
+    assert both.vehicle_id.tolist() == ['trip1', 'trip3', 'trip0']
+    assert len(geo_batch.concatenate([])) == 0
+
+
+def test_quarantine_appends_one_line_per_message(tmpdir):
+    path = str(tmpdir.join('quarantine.jsonl'))
+    message = received('7', 'garbage')
+    quarantine = geo_batch.Quarantine(path)
+    quarantine.add(message, "not a CSV fix with a timestamp")
+    geo_batch.Quarantine(path).add(message, "again")
+    assert quarantine.count == 1
+    lines = [json.loads(line) for line in open(path)]
+    assert [line['reason'] for line in lines] == [
+        "not a CSV fix with a timestamp", "again"]
+    assert lines[0]['message'] == message['message']
@@ -0,0 +1,82 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sqlite3
+
+import geo_cache
+
+# Positions in three different cells of a precision 8 geohash.
+FIRST = (32.7150, -117.1600)
+SECOND = (32.7250, -117.1600)
+THIRD = (32.7350, -117.1600)
+
+
+def test_hits_and_misses():
+    cache = geo_cache.SpatialCache('geocode')
+    assert cache.get(*FIRST) is None
+    cache.put(FIRST[0], FIRST[1], {'address': '600 Market St'})
+    # A position a few metres away is in the same cell.
+    assert cache.get(32.71501, -117.16001) == {'address': '600 Market St'}
+    assert cache.get(*SECOND) is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 2)
+    assert stats['hit_rate'] == 1.0 / 3
+
+
+def test_least_recently_used_is_evicted():
+    cache = geo_cache.SpatialCache('geocode', capacity=2)
+    cache.put(FIRST[0], FIRST[1], 'first')
+    cache.put(SECOND[0], SECOND[1], 'second')
+    assert cache.get(*FIRST) == 'first'
+    cache.put(THIRD[0], THIRD[1], 'third')
+    assert cache.get(*SECOND) is None
+    assert cache.get(*FIRST) == 'first'
+    assert cache.get(*THIRD) == 'third'
+    assert cache.stats()['evictions'] == 1
+
+
+def test_processes_share_values_through_the_file(tmpdir):
+    path = str(tmpdir.join('cache', 'maps.sqlite'))
+    first = geo_cache.SpatialCache('geocode', path=path, commit_every=1)
+    second = geo_cache.SpatialCache('geocode', path=path, commit_every=1)
+    first.put(FIRST[0], FIRST[1], {'address': '600 Market St'})
+    assert second.get(*FIRST) == {'address': '600 Market St'}
+    assert second.stats()['disk_hits'] == 1
+    first.close()
+    second.close()
+
+
+def test_evicted_values_are_found_on_disk(tmpdir):
+    cache = geo_cache.SpatialCache('geocode', capacity=1,
+                                   path=str(tmpdir.join('maps.sqlite')))
+    cache.put(FIRST[0], FIRST[1], 'first')
+    cache.put(SECOND[0], SECOND[1], 'second')
+    assert cache.get(*FIRST) == 'first'
+    assert cache.stats()['disk_hits'] == 1
+    cache.close()
+
+
+class LockedDatabase(object):
+
+    def execute(self, *args):
+        raise sqlite3.OperationalError('database is locked')
+
+
+def test_a_locked_file_is_a_miss():
+    cache = geo_cache.SpatialCache('geocode', path=':memory:')
+    cache._db = LockedDatabase()
+    assert cache.get(*FIRST) is None
+    assert cache.stats()['misses'] == 1
+    # Writes that fail are still cached in memory.
+    cache.put(FIRST[0], FIRST[1], 'first')
+    assert cache.get(*FIRST) == 'first'
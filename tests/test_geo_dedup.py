@@ -0,0 +1,103 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sqlite3
+
+import geo_dedup
+import geo_metrics
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_keys_are_forgotten_after_the_window():
+    clock = Clock()
+    seen = geo_dedup.SeenSet(window=100, clock=clock)
+    seen.add(['1-0', '1-1'])
+    assert seen.seen(['1-0', '1-1', '2-0']) == set(['1-0', '1-1'])
+    clock.now += 101
+    assert seen.seen(['1-0']) == set()
+
+
+def test_workers_share_keys_through_the_file(tmpdir):
+    path = str(tmpdir.join('seen.sqlite'))
+    clock = Clock()
+    first = geo_dedup.SeenSet(path, window=100, clock=clock)
+    second = geo_dedup.SeenSet(path, window=100, clock=clock)
+    first.add(['1-0'])
+    assert second.seen(['1-0', '2-0']) == set(['1-0'])
+    assert second.stats()['disk_hits'] == 1
+    clock.now += 101
+    assert second.seen(['1-0']) == set()
+    first.close()
+    second.close()
+
+
+def test_capacity_bounds_memory_but_not_the_file(tmpdir):
+    seen = geo_dedup.SeenSet(str(tmpdir.join('seen.sqlite')), capacity=2)
+    seen.add(['a', 'b', 'c'])
+    assert seen.stats()['size'] == 2
+    assert seen.seen(['a', 'b', 'c']) == set(['a', 'b', 'c'])
+    assert seen.stats()['disk_hits'] == 1
+    seen.close()
+
+
+def test_expired_keys_are_pruned_from_the_file(tmpdir):
+    path = str(tmpdir.join('seen.sqlite'))
+    clock = Clock()
+    seen = geo_dedup.SeenSet(path, window=100, prune_interval=0, clock=clock)
+    seen.add(['old'])
+    clock.now += 101
+    seen.add(['new'])
+    seen.close()
+    keys = sqlite3.connect(path).execute('SELECT key FROM seen').fetchall()
+    assert keys == [('new',)]
+
+
+class LockedDatabase(object):
+
+    def executemany(self, *args):
+        raise sqlite3.OperationalError('database is locked')
+
+
+def test_failed_writes_are_counted_and_kept_in_memory():
+    seen = geo_dedup.SeenSet(':memory:')
+    seen._db = LockedDatabase()
+    key = ('geo_seen_write_errors_total', ())
+    before = geo_metrics.METRICS.values().get(key, 0)
+    seen.add(['1-0'])
+    assert geo_metrics.METRICS.values()[key] == before + 1
+    assert seen.seen(['1-0']) == set(['1-0'])
+
+
+class LockedReads(object):
+
+    def execute(self, *args):
+        raise sqlite3.OperationalError('database is locked')
+
+
+def test_failed_reads_are_counted_as_misses():
+    seen = geo_dedup.SeenSet(':memory:')
+    seen.add(['1-0'])
+    seen._db = LockedReads()
+    key = ('geo_seen_read_errors_total', ())
+    before = geo_metrics.METRICS.values().get(key, 0)
+    assert seen.seen(['1-0', '2-0']) == set(['1-0'])
+    assert geo_metrics.METRICS.values()[key] == before + 1
+    assert seen.stats()['misses'] == 1
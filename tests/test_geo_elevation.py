@@ -0,0 +1,66 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import numpy
+import pytest
+
+import geo_elevation
+
+SAMPLES = 1201  # SRTM3
+
+
+def write_tile(tile_dir, lat_floor, lng_floor, void=None):
+    """An SRTM3 tile whose height rises 1200 m to the north and 2400 m to
+    the east of its south-west corner, so interpolation is exact."""
+    rows, columns = numpy.mgrid[0:SAMPLES, 0:SAMPLES]
+    heights = (SAMPLES - 1 - rows) + 2 * columns
+    if void is not None:
+        heights[void] = geo_elevation.HGT_VOID
+    heights.astype('>i2').tofile(str(tile_dir.join(
+        geo_elevation.tile_name(lat_floor, lng_floor))))
+
+
+def test_tile_name():
+    assert geo_elevation.tile_name(32, -118) == 'N32W118.hgt'
+    assert geo_elevation.tile_name(-1, 5) == 'S01E005.hgt'
+
+
+def test_elevations_are_interpolated(tmpdir):
+    write_tile(tmpdir, 32, -118)
+    dem = geo_elevation.DemElevation(str(tmpdir))
+    heights = dem.elevations([32.0, 32.5, 32.25, 32.9999, 32.5001],
+                             [-118.0, -117.5, -117.25, -117.0001, -117.5001])
+    assert heights.tolist() == pytest.approx(
+        [0.0, 1800.0, 2100.0, 3600.0, 1800.0], abs=0.5)
+
+
+def test_missing_tiles_and_voids_are_nan(tmpdir):
+    # The sample at the centre of the tile has no data.
+    write_tile(tmpdir, 32, -118, void=(600, 600))
+    dem = geo_elevation.DemElevation(str(tmpdir))
+    heights = dem.elevations([32.5, 32.5001, 32.25, 40.5],
+                             [-117.5, -117.5001, -117.25, -117.5])
+    assert numpy.isnan(heights[[0, 1, 3]]).all()
+    assert heights[2] == pytest.approx(2100.0)
+
+
+def test_open_tiles_are_bounded(tmpdir):
+    write_tile(tmpdir, 32, -118)
+    write_tile(tmpdir, 33, -118)
+    dem = geo_elevation.DemElevation(str(tmpdir), max_open_tiles=1)
+    for _ in range(2):
+        dem.elevations([32.5], [-117.5])
+        dem.elevations([33.5], [-117.5])
+    assert dem.tiles_opened == 4
+    dem.elevations([33.5, 33.6], [-117.5, -117.5])
+    assert dem.tiles_opened == 4
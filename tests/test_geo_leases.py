@@ -0,0 +1,86 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+
+import pytest
+
+import geo_leases
+
+
+class Clock(object):
+    """Stands in for the time module in geo_leases."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(geo_leases, 'time', clock)
+    return clock
+
+
+def test_room_is_limited_by_messages_and_bytes(clock):
+    leases = geo_leases.Leases(max_messages=3, max_bytes=100)
+    leases.add('a', 10)
+    leases.add('b', 10)
+    assert leases.room() == 1
+    leases.add('c', 80)
+    assert leases.room() == 0
+    leases.remove(['a', 'c'])
+    assert leases.room() == 2
+    leases.add('d', 100)
+    # Under max_messages, but max_bytes is full.
+    assert (len(leases), leases.room()) == (2, 0)
+
+
+def test_wait_for_room_wakes_up_on_remove():
+    leases = geo_leases.Leases(max_messages=1)
+    leases.add('a', 10)
+    assert leases.wait_for_room(0.01) == 0
+    timer = threading.Timer(0.05, leases.remove, [['a']])
+    timer.start()
+    assert leases.wait_for_room(5) == 1
+    timer.join()
+
+
+def test_expiring_leases_are_extended(clock):
+    leases = geo_leases.Leases(ack_deadline=10, lease_seconds=60)
+    leases.add('a', 10)
+    clock.now += 5
+    leases.add('b', 10)
+    assert leases.expiring(margin=2) == []
+    clock.now += 3
+    assert leases.expiring(margin=2) == ['a']
+    # a now runs out 60 seconds from here; b still at its first deadline.
+    clock.now += 5
+    assert leases.expiring(margin=2) == ['b']
+    clock.now += 57
+    assert leases.expiring(margin=2) == ['a']
+
+
+def test_messages_held_too_long_are_dropped(clock):
+    leases = geo_leases.Leases(ack_deadline=10, lease_seconds=60,
+                               max_lease=100)
+    leases.add('a', 10)
+    clock.now += 9
+    assert leases.expiring(margin=2) == ['a']
+    clock.now += 95
+    assert leases.expiring(margin=2) == []
+    assert leases.dropped == 1
+    assert len(leases) == 0
@@ -0,0 +1,82 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import numpy
+import pytest
+
+import geo_message
+
+COLUMNS = {
+    'epoch': [1463000000.0, 1463000001.0, 1463000002.0],
+    'latitude': [32.71, 32.72, 32.73],
+    'longitude': [-117.16, -117.17, -117.18],
+    'speed': [10.0, float('nan'), 12.5],
+    'bearing': [90.0, 180.0, float('nan')],
+}
+VEHICLES = ['trip2', 'trip1', 'trip2']
+
+
+def test_round_trip():
+    vehicle_ids, records = geo_message.decode(
+        geo_message.encode(VEHICLES, COLUMNS))
+    assert [vehicle_ids[vehicle] for vehicle in records['vehicle']] == \
+        VEHICLES
+    for field in geo_message.FIELDS:
+        numpy.testing.assert_array_equal(records[field], COLUMNS[field])
+
+
+def test_empty_message():
+    vehicle_ids, records = geo_message.decode(geo_message.encode(
+        [], dict((field, []) for field in geo_message.FIELDS)))
+    assert vehicle_ids == []
+    assert len(records) == 0
+
+
+def test_is_binary():
+    assert geo_message.is_binary({'format': 'fixes'})
+    assert not geo_message.is_binary({'timestamp': '2016-05-11 20:53:20'})
+    assert not geo_message.is_binary(None)
+
+
+@pytest.mark.parametrize('data, message', [
+    ('GF', 'shorter than its header'),
+    ('CSV' + geo_message.encode(VEHICLES, COLUMNS)[3:], 'Not a binary'),
+    (geo_message.encode(VEHICLES, COLUMNS)[:-1], 'Expected 3 records'),
+    (geo_message.encode(VEHICLES, COLUMNS)[:geo_message.HEADER.size + 3],
+     'truncated in its vehicle IDs'),
+])
+def test_invalid_messages(data, message):
+    with pytest.raises(geo_message.MessageError) as error:
+        geo_message.decode(data)
+    assert message in str(error.value)
+
+
+def test_unsupported_version():
+    data = geo_message.encode(VEHICLES, COLUMNS)
+    with pytest.raises(geo_message.MessageError):
+        geo_message.decode(data[:3] + chr(geo_message.VERSION + 1) + data[4:])
+
+
+def test_unknown_vehicle():
+    data = bytearray(geo_message.encode(VEHICLES, COLUMNS))
+    # The first record's vehicle, after the header and 'trip1', 'trip2'.
+    data[geo_message.HEADER.size + 12] = 7
+    with pytest.raises(geo_message.MessageError) as error:
+        geo_message.decode(str(data))
+    assert 'unknown vehicle' in str(error.value)
+
+
+def test_vehicle_id_too_long():
+    with pytest.raises(ValueError):
+        geo_message.encode(['x' * 256], dict(
+            (field, values[:1]) for field, values in COLUMNS.items()))
@@ -0,0 +1,70 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+
+import pytest
+
+import geo_postal
+
+
+def square(south, west, north, east):
+    return {'type': 'Polygon', 'coordinates': [[
+        [west, south], [east, south], [east, north], [west, north],
+        [west, south]]]}
+
+
+@pytest.fixture
+def postal_codes(tmpdir):
+    path = tmpdir.join('zcta.geojson')
+    path.write(json.dumps({'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'properties': {'ZCTA5CE10': '92101'},
+         'geometry': square(32.70, -117.18, 32.73, -117.14)},
+        {'type': 'Feature', 'properties': {'ZCTA5CE10': '92102'},
+         'geometry': square(32.70, -117.14, 32.73, -117.10)},
+    ]}))
+    return str(path)
+
+
+@pytest.fixture
+def addresses(tmpdir):
+    path = tmpdir.join('addresses.csv')
+    path.write('LON,LAT,NUMBER,STREET,UNIT,CITY,REGION,POSTCODE\n'
+               '-117.1600,32.7150,600,Market St,,San Diego,CA,92101\n'
+               '-117.1200,32.7150,1200,Island Ave,,San Diego,CA,92102\n'
+               'bad,row,,,,,,\n')
+    return str(path)
+
+
+def test_postal_codes_only(postal_codes):
+    geocoder = geo_postal.OfflineGeocoder(postal_codes)
+    assert geocoder.lookup([32.715, 32.715, 33.0],
+                           [-117.16, -117.12, -117.16]) == [
+        ('92101', None), ('92102', None), (None, None)]
+
+
+def test_nearest_address_within_max_distance(postal_codes, addresses):
+    geocoder = geo_postal.OfflineGeocoder(postal_codes, addresses=addresses,
+                                          max_distance=50.0)
+    assert len(geocoder.addresses) == 2
+    # 0.0002 degrees of latitude is about 22 metres; 0.002 about 220.
+    assert geocoder.lookup([32.7152, 32.717], [-117.16, -117.12]) == [
+        ('92101', '600 Market St, San Diego, CA 92101'), ('92102', None)]
+
+
+def test_bounds_limit_what_is_loaded(postal_codes, addresses):
+    geocoder = geo_postal.OfflineGeocoder(
+        postal_codes, addresses=addresses,
+        bounds=(32.6, -117.2, 32.8, -117.15))
+    assert len(geocoder.postal_index) == 1
+    assert geocoder.addresses == ['600 Market St, San Diego, CA 92101']
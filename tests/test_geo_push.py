@@ -0,0 +1,98 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import base64
+import httplib
+import json
+
+import pytest
+
+import config_geo_pubsub_pull as pull
+import geo_fakes
+import geo_push
+
+ENVELOPE = json.dumps({
+    'message': {
+        'data': base64.b64encode('trip1,32.715,-117.16,10,90'),
+        'attributes': {'timestamp': '2016-05-11 20:53:00'},
+        'messageId': '1',
+    },
+    'subscription': 'projects/test/subscriptions/traffic-push',
+})
+
+
+def push(server, path='/push?token=secret', body=ENVELOPE):
+    connection = httplib.HTTPConnection('localhost', server.server_port,
+                                        timeout=10)
+    connection.request('POST', path, body,
+                       {'Content-Type': 'application/json'})
+    status = connection.getresponse().status
+    connection.close()
+    return status
+
+
+@pytest.fixture
+def serve():
+    """Start a PushPipeline writing to a FakeBigQuery and serve it."""
+    started = []
+
+    def serve(bigquery=None, **options):
+        bigquery = bigquery or geo_fakes.FakeBigQuery()
+        enricher = pull.Enricher(geo_fakes.FakeMaps(), 4)
+        sink = pull.BigQueryRowSink(bigquery, max_age=0.05)
+        pipeline = pull.PushPipeline(enricher, sink, row_log_every=0,
+                                     **options)
+        pipeline.start()
+        server = geo_push.serve(0, pipeline, token='secret',
+                                host='localhost')
+        started.append((server, pipeline, enricher))
+        return server, pipeline, bigquery
+    yield serve
+    for server, pipeline, enricher in started:
+        server.shutdown()
+        server.server_close()
+        pipeline.stop()
+        pipeline.wait(10)
+        enricher.close()
+
+
+def test_written_message_is_acked_with_204(serve):
+    server, _, bigquery = serve()
+    assert push(server) == 204
+    assert bigquery.row_count() == 1
+
+
+def test_message_over_max_outstanding_is_turned_away_with_429(serve):
+    server, _, bigquery = serve(max_outstanding=0)
+    assert push(server) == 429
+    assert bigquery.row_count() == 0
+
+
+def test_slow_message_is_answered_with_503(serve):
+    server, _, _ = serve(bigquery=geo_fakes.FakeBigQuery(latency=2.0),
+                         timeout=0.2)
+    assert push(server) == 503
+
+
+def test_stopping_pipeline_answers_503(serve):
+    server, pipeline, _ = serve()
+    pipeline.stop()
+    assert push(server) == 503
+
+
+def test_bad_requests(serve):
+    server, _, bigquery = serve()
+    assert push(server, path='/push') == 403
+    assert push(server, path='/other?token=secret') == 404
+    assert push(server, body='{"subscription": "x"}') == 400
+    assert bigquery.row_count() == 0
@@ -0,0 +1,68 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import pytest
+
+import geo_quota
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('quota.sqlite'))
+
+
+def test_daily_quota_is_exhausted(path):
+    quota = geo_quota.QuotaManager(path, {'geocode': {'qps': 100,
+                                                      'daily': 3}})
+    quota.acquire('geocode', 2)
+    assert not quota.try_acquire('geocode', 2)
+    quota.acquire('geocode')
+    # No wait helps once the day's calls are used up.
+    with pytest.raises(geo_quota.QuotaExceeded):
+        quota.acquire('geocode', timeout=10)
+    assert quota.headroom('geocode', within=60) == 0
+    assert quota.report() == 'Maps API calls today: geocode 3/3'
+    quota.close()
+
+
+def test_no_daily_limit(path):
+    quota = geo_quota.QuotaManager(path, {'timezone': {'qps': 1000,
+                                                       'daily': 0}})
+    for _ in range(5):
+        quota.acquire('timezone', 200, timeout=1)
+    assert quota.usage() == {'timezone': 1000}
+    assert quota.report() == 'Maps API calls today: timezone 1000'
+    quota.close()
+
+
+def test_bucket_is_shared_through_the_file(path):
+    limits = {'elevation': {'qps': 2, 'daily': 0}}
+    first = geo_quota.QuotaManager(path, limits)
+    second = geo_quota.QuotaManager(path, limits)
+    assert first.try_acquire('elevation', 2)
+    assert not second.try_acquire('elevation')
+    with pytest.raises(geo_quota.QuotaExceeded):
+        second.acquire('elevation', timeout=0.1)
+    # Half a second refills one token at 2 qps.
+    second.acquire('elevation', timeout=1)
+    first.close()
+    second.close()
+
+
+def test_over_limit_empties_the_bucket(path):
+    quota = geo_quota.QuotaManager(path, {'geocode': {'qps': 1,
+                                                      'daily': 0}})
+    assert quota.headroom('geocode') == 1
+    quota.over_limit('geocode')
+    assert not quota.try_acquire('geocode')
+    quota.close()
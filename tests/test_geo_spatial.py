@@ -0,0 +1,110 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import random
+
+import numpy
+
+import geo_spatial
+
+
+def in_ranges(cell, ranges):
+    return any(start <= cell and (end is None or cell < end)
+               for start, end in ranges)
+
+
+def test_geohash_known_values():
+    assert geo_spatial.geohash(57.64911, 10.40744, 11) == 'u4pruydqqvj'
+    assert geo_spatial.geohash(42.6, -5.6, 5) == 'ezs42'
+
+
+def test_geohash_prefixes_are_the_enclosing_cells():
+    rng = random.Random(1)
+    for _ in range(100):
+        latitude = rng.uniform(-90, 90)
+        longitude = rng.uniform(-180, 180)
+        cell = geo_spatial.geohash(latitude, longitude, 9)
+        assert geo_spatial.geohash(latitude, longitude, 4) == cell[:4]
+
+
+def test_geohash_cell_size():
+    assert geo_spatial.geohash_cell_size(1) == (45.0, 45.0)
+    assert geo_spatial.geohash_cell_size(2) == (5.625, 11.25)
+
+
+def test_geohash_next():
+    assert geo_spatial.geohash_next('9q') == '9r'
+    assert geo_spatial.geohash_next('0z') == '10'
+    assert geo_spatial.geohash_next('zz') is None
+
+
+def test_geohash_ranges_merge_consecutive_cells():
+    assert geo_spatial.geohash_ranges(['9q', '9r', '9x']) == [
+        ('9q', '9s'), ('9x', '9y')]
+    assert geo_spatial.geohash_ranges(['zz']) == [('zz', None)]
+
+
+def test_geohash_cover_contains_every_point_of_the_rectangle():
+    rng = random.Random(2)
+    for south, west, north, east in [(32.6, -117.3, 32.9, -116.9),
+                                     (32.71, -117.17, 32.72, -117.16),
+                                     (-0.5, -0.5, 0.5, 0.5)]:
+        cells = geo_spatial.geohash_cover(south, west, north, east,
+                                          max_cells=32)
+        assert cells == sorted(cells)
+        assert len(cells) <= 32
+        ranges = geo_spatial.geohash_ranges(cells)
+        for _ in range(200):
+            cell = geo_spatial.geohash(rng.uniform(south, north),
+                                       rng.uniform(west, east), 9)
+            assert in_ranges(cell, ranges)
+
+
+def test_geohash_cover_uses_the_finest_precision_that_fits():
+    cells = geo_spatial.geohash_cover(32.71, -117.17, 32.72, -117.16,
+                                      precision=9, max_cells=32)
+    finer = geo_spatial.geohash_cover(32.71, -117.17, 32.72, -117.16,
+                                      precision=9, max_cells=1000)
+    assert len(set(len(cell) for cell in cells)) == 1
+    assert len(finer[0]) > len(cells[0])
+
+
+# A square with a square hole, as (lng, lat) rings.
+OUTER = [(-117.2, 32.6), (-117.0, 32.6), (-117.0, 32.8), (-117.2, 32.8),
+         (-117.2, 32.6)]
+HOLE = [(-117.15, 32.65), (-117.05, 32.65), (-117.05, 32.75),
+        (-117.15, 32.75), (-117.15, 32.65)]
+
+
+def test_points_in_ring_matches_point_in_ring():
+    ring = numpy.array(OUTER)
+    rng = random.Random(3)
+    latitudes = numpy.array([rng.uniform(32.5, 32.9) for _ in range(200)])
+    longitudes = numpy.array([rng.uniform(-117.3, -116.9)
+                              for _ in range(200)])
+    inside = geo_spatial.points_in_ring(longitudes, latitudes, ring)
+    assert inside.dtype == bool
+    assert inside.tolist() == [
+        geo_spatial.point_in_ring(longitude, latitude, ring)
+        for longitude, latitude in zip(longitudes, latitudes)]
+    assert inside.any() and not inside.all()
+
+
+def test_polygon_index_skips_holes():
+    index = geo_spatial.PolygonIndex(cell_degrees=0.1)
+    index.add('92101', [OUTER, HOLE])
+    assert index.lookup(32.62, -117.18) == '92101'
+    assert index.lookup(32.7, -117.1) is None
+    assert index.lookup(33.0, -117.1) is None
+    assert index.lookup_many([32.62, 32.7, 33.0], [-117.18, -117.1, -117.1]) \
+        == ['92101', None, None]
@@ -0,0 +1,89 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+
+import pytest
+
+import geo_fakes
+import geo_tiles
+
+ZOOM = 12
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def san_diego_tile():
+    xs, ys = geo_tiles.tile_xy([32.715], [-117.16], ZOOM)
+    return ZOOM, int(xs[0]), int(ys[0])
+
+
+def test_tile_bounds_contain_the_position():
+    zoom, x, y = san_diego_tile()
+    south, west, north, east = geo_tiles.tile_bounds(zoom, x, y)
+    assert south < 32.715 < north and west < -117.16 < east
+    # Positions past the poles and the antimeridian clamp to edge tiles.
+    xs, ys = geo_tiles.tile_xy([85.1, -85.1], [-180.0, 180.0], 1)
+    assert (xs.tolist(), ys.tolist()) == ([0, 1], [0, 1])
+
+
+def test_tiles_expire_after_the_ttl():
+    clock = Clock()
+    cache = geo_tiles.TileCache(ttl=60, clock=clock)
+    key = san_diego_tile()
+    cache.put(key, geo_tiles.Tile(*key))
+    clock.now += 60
+    assert cache.get(key) is not None
+    clock.now += 1
+    assert cache.get(key) is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['expired']) == (1, 1, 1)
+    assert len(cache) == 0
+
+
+def test_least_recently_used_tile_is_evicted():
+    cache = geo_tiles.TileCache(capacity=2)
+    for y in range(3):
+        cache.put((ZOOM, 0, y), geo_tiles.Tile(ZOOM, 0, y))
+    assert cache.get((ZOOM, 0, 0)) is None
+    assert cache.get((ZOOM, 0, 2)) is not None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_service_loads_missing_tiles_and_refreshes_cached_ones():
+    source = geo_fakes.FakeTileSource()
+    source.add([32.715, 32.716], [-117.16, -117.16])
+    clock = Clock()
+    service = geo_tiles.TileService(source, geo_tiles.TileCache(
+        ttl=60, clock=clock))
+    key = san_diego_tile()
+    body, cached = service.tile(*key)
+    assert (json.loads(body)['count'], cached) == (2, False)
+    source.add([32.717], [-117.16])
+    assert service.refresh() == 1
+    body, cached = service.tile(*key)
+    assert (json.loads(body)['count'], cached) == (3, True)
+    assert source.calls['tile'] == 1
+    # Once expired, the tile is loaded again.
+    clock.now += 61
+    assert service.tile(*key)[1] is False
+    assert source.calls['tile'] == 2
+    with pytest.raises(ValueError):
+        service.tile(ZOOM, 2 ** ZOOM, 0)
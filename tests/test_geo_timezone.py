@@ -0,0 +1,69 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+
+import pytest
+
+import geo_timezone
+
+# 2016-01-15 20:00 and 2016-07-15 19:00 UTC.
+WINTER = 1452888000
+SUMMER = 1468609200
+
+
+def square(south, west, north, east):
+    return {'type': 'Polygon', 'coordinates': [[
+        [west, south], [east, south], [east, north], [west, north],
+        [west, south]]]}
+
+
+@pytest.fixture
+def boundaries(tmpdir):
+    path = tmpdir.join('timezones.geojson')
+    path.write(json.dumps({'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'properties': {'tzid': 'America/Los_Angeles'},
+         'geometry': square(32.0, -118.0, 34.0, -114.5)},
+        {'type': 'Feature', 'properties': {'tzid': 'America/Phoenix'},
+         'geometry': square(32.0, -114.5, 34.0, -111.0)},
+    ]}))
+    return str(path)
+
+
+def test_timezone_response_follows_dst():
+    assert geo_timezone.timezone_response(
+        'America/Los_Angeles', WINTER) == {
+            'status': 'OK', 'timeZoneId': 'America/Los_Angeles',
+            'timeZoneName': 'PST', 'rawOffset': -28800, 'dstOffset': 0}
+    summer = geo_timezone.timezone_response('America/Los_Angeles', SUMMER)
+    assert (summer['rawOffset'], summer['dstOffset']) == (-28800, 3600)
+    assert summer['timeZoneName'] == 'PDT'
+
+
+def test_resolver_looks_up_the_polygon(boundaries):
+    resolver = geo_timezone.TimezoneResolver(boundaries)
+    san_diego = resolver.timezone(32.715, -117.16, SUMMER)
+    assert san_diego['timeZoneId'] == 'America/Los_Angeles'
+    assert san_diego['dstOffset'] == 3600
+    # Arizona doesn't observe DST.
+    phoenix = resolver.timezone(33.45, -112.07, SUMMER)
+    assert phoenix['timeZoneId'] == 'America/Phoenix'
+    assert (phoenix['rawOffset'], phoenix['dstOffset']) == (-25200, 0)
+    assert resolver.timezone(40.0, -117.16, SUMMER) is None
+
+
+def test_bounds_limit_what_is_loaded(boundaries):
+    resolver = geo_timezone.TimezoneResolver(
+        boundaries, bounds=(32.5, -117.5, 33.0, -116.5))
+    assert len(resolver.index) == 1
+    assert resolver.timezone(33.45, -112.07, SUMMER) is None
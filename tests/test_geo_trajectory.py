@@ -0,0 +1,81 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import geo_trajectory
+
+# 2016-01-15 20:00 UTC, in winter time in San Diego.
+WINTER = 1452888000
+# 2016-07-15 19:00 UTC, in summer time.
+SUMMER = 1468609200
+# 0.0001 degrees of latitude is about 11 metres.
+STEP = 0.0001
+
+
+def fix(vehicle, posix_time, north=0):
+    return {'VehicleID': vehicle, 'posix_time': posix_time,
+            'Latitude': 32.715 + north * STEP, 'Longitude': -117.16}
+
+
+def enrichment(name):
+    return {'address_list': [name], 'elevation': [{'elevation': 10.0}],
+            'timezone': {'status': 'OK',
+                         'timeZoneId': 'America/Los_Angeles'}}
+
+
+def test_nearby_fixes_reuse_what_their_limits_allow():
+    cache = geo_trajectory.TrajectoryCache()
+    # 11 m, 220 m and 11 km north of the first fix.
+    fixes = [fix('1', WINTER), fix('1', WINTER + 5, 1),
+             fix('1', WINTER + 10, 20), fix('1', WINTER + 15, 1000)]
+    plans = cache.plan(fixes)
+    assert plans[0] == {}
+    assert sorted(plans[1]) == ['address_list', 'elevation', 'timezone']
+    assert plans[2] == {'timezone': ('fix', 0)}
+    assert plans[3] == {}
+
+
+def test_reused_fields_are_filled_in_and_listed():
+    cache = geo_trajectory.TrajectoryCache()
+    fixes = [fix('1', WINTER), fix('1', WINTER + 5, 1)]
+    plans = cache.plan(fixes)
+    results = cache.apply(fixes, plans, {0: enrichment('first')})
+    assert results[1]['address_list'] == ['first']
+    assert results[1]['reused'] == ['address_list', 'elevation', 'timezone']
+    # The offsets are worked out for the reusing fix.
+    assert results[1]['timezone']['rawOffset'] == -8 * 3600
+    assert 'reused' not in results[0]
+    assert cache.report() == ("Trajectory reuse: address_list 1/2, "
+                              "elevation 1/2, timezone 1/2")
+
+
+def test_a_failed_lookup_fails_the_fixes_that_reuse_it():
+    cache = geo_trajectory.TrajectoryCache()
+    fixes = [fix('1', WINTER), fix('1', WINTER + 5, 1), fix('2', WINTER)]
+    plans = cache.plan(fixes)
+    results = cache.apply(fixes, plans, {0: None, 2: enrichment('other')})
+    assert results[:2] == [None, None]
+    assert results[2]['address_list'] == ['other']
+
+
+def test_later_batches_reuse_recent_fixes_only():
+    cache = geo_trajectory.TrajectoryCache(max_seconds=120)
+    first = [fix('1', SUMMER - 60)]
+    cache.apply(first, cache.plan(first), {0: enrichment('first')})
+    recent = [fix('1', SUMMER, 1)]
+    results = cache.apply(recent, cache.plan(recent), {})
+    assert results[0]['address_list'] == ['first']
+    assert results[0]['timezone']['dstOffset'] == 3600
+    late = [fix('1', SUMMER + 300, 1)]
+    assert cache.plan(late) == [{}]
+    # Another vehicle in the same place reuses nothing.
+    assert cache.plan([fix('2', SUMMER, 1)]) == [{}]
@@ -0,0 +1,125 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import pytest
+
+import geo_metrics
+import geo_tuning
+
+BOUNDS = {
+    'batch_size': (10, 1000),
+    'concurrency': (4, 50),
+    'max_rows': (50, 500),
+    'max_age': (0.25, 5.0),
+}
+
+
+class Enricher(object):
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.deadline = 4.0
+
+    def set_concurrency(self, concurrency):
+        self.concurrency = concurrency
+
+
+class Sink(object):
+    max_rows = 500
+    max_age = 5.0
+
+
+class Pipeline(object):
+
+    def __init__(self, batch_size=100, concurrency=20):
+        self.batch_size = batch_size
+        self.enricher = Enricher(concurrency)
+        self.sink = Sink()
+        self.unenriched = 0
+
+
+@pytest.fixture
+def registry():
+    return geo_metrics.Registry()
+
+
+@pytest.fixture
+def pipeline():
+    return Pipeline()
+
+
+def interval(registry, tuner, **outcomes):
+    """Record Maps API calls by outcome, then let the tuner adjust."""
+    for outcome, calls in outcomes.items():
+        registry.inc('geo_maps_calls_total', calls, outcome=outcome)
+    return tuner.adjust()
+
+
+def settings(pipeline):
+    return pipeline.batch_size, pipeline.enricher.concurrency
+
+
+def test_failed_calls_that_arent_throttled_change_nothing(registry, pipeline):
+    tuner = geo_tuning.Tuner(pipeline, BOUNDS, registry)
+    for _ in range(10):
+        interval(registry, tuner, ok=50, error=50)
+    assert settings(pipeline) == (100, 20)
+
+
+def test_a_short_burst_of_throttling_changes_nothing(registry, pipeline):
+    tuner = geo_tuning.Tuner(pipeline, BOUNDS, registry, sustain=3)
+    for _ in range(3):
+        interval(registry, tuner, ok=80, throttled=20)
+        interval(registry, tuner, ok=100)
+    assert settings(pipeline) == (100, 20)
+
+
+def test_backs_off_after_sustained_throttling(registry, pipeline):
+    tuner = geo_tuning.Tuner(pipeline, BOUNDS, registry, sustain=3)
+    interval(registry, tuner, ok=80, throttled=20)
+    interval(registry, tuner, ok=80, deadline=20)
+    assert settings(pipeline) == (100, 20)
+    interval(registry, tuner, ok=80, throttled=20)
+    assert settings(pipeline) == (50, 15)
+    # The next back-off also waits for sustained throttling.
+    interval(registry, tuner, ok=80, throttled=20)
+    interval(registry, tuner, ok=80, throttled=20)
+    assert settings(pipeline) == (50, 15)
+    interval(registry, tuner, ok=80, throttled=20)
+    assert settings(pipeline) == (25, 12)
+
+
+def test_never_backs_off_below_the_bounds(registry):
+    pipeline = Pipeline(batch_size=10, concurrency=4)
+    tuner = geo_tuning.Tuner(pipeline, BOUNDS, registry, sustain=1)
+    for _ in range(5):
+        interval(registry, tuner, throttled=100)
+    assert settings(pipeline) == (10, 4)
+
+
+def test_recovers_once_throttling_stops(registry, pipeline):
+    tuner = geo_tuning.Tuner(pipeline, BOUNDS, registry, sustain=3)
+    for _ in range(3):
+        interval(registry, tuner, ok=50, throttled=50)
+    assert settings(pipeline) == (50, 15)
+    for _ in range(2):
+        interval(registry, tuner, ok=100)
+    assert settings(pipeline) == (50, 15)
+    for _ in range(10):
+        interval(registry, tuner, ok=100)
+    batch_size, concurrency = settings(pipeline)
+    assert batch_size >= 100 and concurrency >= 20
+    # Once back, it stays put without a backlog or busy calls.
+    for _ in range(5):
+        interval(registry, tuner, ok=100)
+    assert settings(pipeline) == (batch_size, concurrency)